@@ -0,0 +1,110 @@
+import hashlib
+from logging import INFO, getLogger
+from pathlib import Path
+
+import orjson
+
+logger = getLogger(__name__)
+logger.setLevel(INFO)
+
+
+class ChecksumCache:
+    """保存済みファイルの MD5 をキャッシュする
+
+    ファイルパスをキーに (size, mtime_ns, md5, media_md5) を JSON ファイルへ保存する
+    size と mtime_ns が記録時から変わっていなければ、ファイルを読まずに記録した md5 を返す
+    media_md5 はそのファイルを保存済みとして受け入れたときの API 上の md5 で、
+    配信用に変換された画像のように md5 が一致しないファイルの受け入れを記録するのに使う
+    """
+
+    cache_path: Path
+    cache_dict: dict[str, dict]
+    is_dirty: bool
+    chunk_size: int = 1024 * 1024
+
+    def __init__(self, cache_path: Path) -> None:
+        self.cache_path = cache_path
+        self.cache_dict = {}
+        self.is_dirty = False
+        if self.cache_path.exists():
+            try:
+                self.cache_dict = orjson.loads(self.cache_path.read_bytes())
+            except orjson.JSONDecodeError:
+                logger.warning(f"Checksum cache is broken, ignored : {str(self.cache_path)}")
+
+    @classmethod
+    def hash_file(cls, filepath: Path) -> "hashlib._Hash":
+        """ファイルを chunk_size ごとに読み込んだ md5 のハッシュオブジェクトを返す
+
+        ダウンロードを再開する場合は、返したオブジェクトを受信したチャンクで更新し続ける
+        """
+        hasher = hashlib.md5()
+        with filepath.open("rb") as f:
+            while chunk := f.read(cls.chunk_size):
+                hasher.update(chunk)
+        return hasher
+
+    @classmethod
+    def compute(cls, filepath: Path) -> str:
+        """ファイルの md5 を計算する"""
+        return cls.hash_file(filepath).hexdigest()
+
+    def get(self, filepath: Path) -> dict | None:
+        """記録時からファイルが変わっていなければ記録した内容を返す、そうでなければ None を返す"""
+        entry = self.cache_dict.get(filepath.as_posix())
+        if entry is None or not filepath.exists():
+            return None
+        stat = filepath.stat()
+        if entry["size"] != stat.st_size or entry["mtime_ns"] != stat.st_mtime_ns:
+            return None
+        return entry
+
+    def set(self, filepath: Path, md5: str, media_md5: str = "") -> None:
+        stat = filepath.stat()
+        self.cache_dict[filepath.as_posix()] = {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "md5": md5,
+            "media_md5": media_md5,
+        }
+        self.is_dirty = True
+
+    def discard(self, filepath: Path) -> None:
+        if self.cache_dict.pop(filepath.as_posix(), None) is not None:
+            self.is_dirty = True
+
+    def md5(self, filepath: Path) -> str:
+        """ファイルの md5 を返す、キャッシュが有効ならファイルを読まない"""
+        if entry := self.get(filepath):
+            return entry["md5"]
+        md5 = self.compute(filepath)
+        self.set(filepath, md5)
+        return md5
+
+    def is_accepted(self, filepath: Path, media_md5: str) -> bool:
+        """ファイルが変わっておらず、media_md5 のメディアとして記録済みか"""
+        entry = self.get(filepath)
+        if entry is None:
+            return False
+        return media_md5 in (entry["md5"], entry.get("media_md5", ""))
+
+    def save(self) -> None:
+        """変更があればキャッシュを書き出す"""
+        if not self.is_dirty:
+            return
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = self.cache_path.with_name(f"{self.cache_path.name}.tmp")
+        temp_path.write_bytes(orjson.dumps(self.cache_dict))
+        temp_path.replace(self.cache_path)
+        self.is_dirty = False
+
+
+if __name__ == "__main__":
+    import logging.config
+    import sys
+
+    logging.config.fileConfig("./log/logging.ini", disable_existing_loggers=False)
+    checksum_cache = ChecksumCache(Path("./cache/checksum_cache.json"))
+    for arg in sys.argv[1:]:
+        print(f"{checksum_cache.md5(Path(arg))}  {arg}")
+    checksum_cache.save()
@@ -1,93 +1,322 @@
+import asyncio
 import time
+from dataclasses import dataclass, field
+from datetime import datetime
 from logging import getLogger
 from pathlib import Path
 
+import orjson
+
 from misskey_crawler.crawler.downloader import Downloader
 from misskey_crawler.crawler.fetcher import Fetcher
+from misskey_crawler.crawler.record_staging import RecordStaging
+from misskey_crawler.crawler.retention import RetentionPolicy
+from misskey_crawler.crawler.valueobject.crawled_page import CrawledPage
 from misskey_crawler.crawler.valueobject.fetched_info import FetchedInfo
+from misskey_crawler.db.backfill_window_db import BackfillWindowDB
+from misskey_crawler.db.base import Database
+from misskey_crawler.db.crawl_state_db import CrawlStateDB
 from misskey_crawler.db.media_db import MediaDB
+from misskey_crawler.db.media_file_db import MediaFileDB
+from misskey_crawler.db.model import BackfillWindow, CrawlState, Media, Note, Reaction, User
 from misskey_crawler.db.note_db import NoteDB
 from misskey_crawler.db.reaction_db import ReactionDB
 from misskey_crawler.db.user_db import UserDB
+from misskey_crawler.util.misskey_id import max_id, min_id
 
 logger = getLogger(__name__)
 
 
+@dataclass
+class AccountStats:
+    """アカウントごとのクロール統計
+
+    error はアカウントの fetch -> parse を中断した例外、最後まで取得できた場合は None
+    """
+
+    page_num: int = 0
+    reaction_num: int = 0
+    media_num: int = 0
+    started_at: float = field(default_factory=lambda: time.time())
+    error: Exception | None = None
+
+    def throughput(self) -> float:
+        """DB に反映したリアクションの実効スループット [reaction/sec]"""
+        elapsed = time.time() - self.started_at
+        if elapsed <= 0:
+            return 0.0
+        return self.reaction_num / elapsed
+
+
 class Crawler:
-    fetcher: Fetcher
+    fetcher_list: list[Fetcher]
+    downloader: Downloader
+    database: Database
     reaction_db: ReactionDB
     note_db: NoteDB
     user_db: UserDB
     media_db: MediaDB
+    crawl_state_db: CrawlStateDB
+    backfill_window_db: BackfillWindowDB
+    retention_policy: RetentionPolicy
+    stats_dict: dict[str, AccountStats]
     config_path: Path = Path("./config/config.json")
+    queue_size: int = 4
 
     def __init__(self) -> None:
         logger.info("Crawler init -> start")
-        self.fetcher = Fetcher(self.config_path)
+        self.fetcher_list = Fetcher.create_list(self.config_path)
         self.downloader = Downloader(self.config_path)
+        config_dict = orjson.loads(self.config_path.read_bytes())
+        self.database = Database.get(pragma_dict=config_dict.get("db", {}).get("pragma", {}))
         self.reaction_db = ReactionDB()
         self.note_db = NoteDB()
         self.user_db = UserDB()
         self.media_db = MediaDB()
+        self.crawl_state_db = CrawlStateDB()
+        self.backfill_window_db = BackfillWindowDB()
+        self.retention_policy = RetentionPolicy(self.downloader, MediaFileDB(), self.media_db)
+        self.stats_dict = {}
         logger.info("Crawler init -> done")
 
-    def run(self) -> None:
+    @staticmethod
+    def split_records(fetched_list: list[FetchedInfo]) -> tuple[list[Reaction], list[Note], list[User], list[Media]]:
+        """FetchedInfo をそれぞれのレコードのリストに分解する
+
+        重複するレコードは RecordStaging で自然キーごとに1つにまとめ、後のもので上書きする
+        メディアのないノートへのリアクションは、メディアを除いたレコードのみを含める
+        """
+        staging = RecordStaging()
+        staging.add_list(fetched_list)
+        return staging.to_lists()
+
+    def select_last_reaction_id(self, account: str) -> str:
+        """アカウントごとのカーソルとなる、最後に取得したリアクションIDを返す"""
+        last_reaction_id = self.crawl_state_db.select_last_reaction_id(account)
+        if last_reaction_id == "" and len(self.fetcher_list) == 1:
+            # 単一アカウントの設定から移行した直後は Reaction テーブルから引き継ぐ
+            # アカウントを記録する前のリアクションも、このアカウントのものとする
+            self.reaction_db.assign_legacy_account(account)
+            last_reaction = self.reaction_db.select_last_record()
+            if last_reaction:
+                last_reaction_id = last_reaction.reaction_id
+        return last_reaction_id
+
+    async def fetch_stage(
+        self, fetcher: Fetcher, account: str, last_reaction_id: str, is_backfill: bool, output_queue: asyncio.Queue
+    ) -> None:
+        """API からページ単位でエントリを取得して次のステージへ流す
+
+        前回のクロールに未完了の時間窓があれば、反映済みのカーソルから取得を再開する
+        バックフィルと初回実行では、リアクション履歴を時間窓に分けて並行に取得する
+        それ以外はカーソル以降の新しいリアクションを取得する
+        """
+        window_list = []
+        if not fetcher.is_debug:
+            window_list = await asyncio.to_thread(self.backfill_window_db.select_unfinished, account)
+            if window_list:
+                logger.info(f"{account} : Resume backfill, {len(window_list)} time window(s) left.")
+            elif is_backfill or last_reaction_id == "":
+                window_list = await fetcher.plan_backfill_windows(account)
+                if window_list:
+                    await asyncio.to_thread(self.save_backfill_windows, account, window_list)
+
+        if window_list:
+            await fetcher.fetch_window_entry_pages(window_list, output_queue)
+        if not window_list or (last_reaction_id and not is_backfill):
+            # 中断した時間窓を再開した場合も、続けてカーソル以降の新しいリアクションを取得する
+            async for fetched_entry_list in fetcher.fetch_entry_pages(last_reaction_id, is_backfill):
+                await output_queue.put((fetched_entry_list, "", False))
+        await output_queue.put(None)
+
+    def save_backfill_windows(self, account: str, window_list: list[BackfillWindow]) -> None:
+        """前回のバックフィルの時間窓を新しい計画で置き換える"""
+        with self.database.transaction():
+            self.backfill_window_db.delete_by_account(account)
+            self.backfill_window_db.upsert(window_list)
+
+    async def parse_stage(
+        self, fetcher: Fetcher, account: str, input_queue: asyncio.Queue, output_queue: asyncio.Queue
+    ) -> None:
+        """エントリを FetchedInfo に解析し、レコードごとに分解して次のステージへ流す"""
+        while (item := await input_queue.get()) is not None:
+            fetched_entry_list, window_key, is_window_done = item
+            fetched_list = await asyncio.to_thread(fetcher.create_fetched_info_list, fetched_entry_list)
+            entry_id_list = [entry["id"] for entry in fetched_entry_list]
+            page = CrawledPage(
+                account,
+                max_id(entry_id_list),
+                *self.split_records(fetched_list),
+                window_key,
+                is_window_done,
+                min_id(entry_id_list) if window_key else "",
+            )
+            await output_queue.put(page)
+
+    async def account_stage(self, fetcher: Fetcher, is_backfill: bool, output_queue: asyncio.Queue) -> None:
+        """1アカウント分の fetch -> parse を動かす
+
+        アカウントの取得に失敗しても他のアカウントは止めず、例外をログとアカウントの統計に記録して終了する
+        失敗するまでに次のステージへ流したページはそのまま DB に反映する
+        """
+        account = fetcher.account_name or f"@?@{fetcher.misskey.instance_name}"
+        try:
+            account = await fetcher.get_account_name()
+            last_reaction_id = await asyncio.to_thread(self.select_last_reaction_id, account)
+            if last_reaction_id:
+                logger.info(f"{account} : Last reaction id is '{last_reaction_id}'.")
+            else:
+                logger.info(f"{account} : Last reaction is not exist, first run.")
+            self.stats_dict[account] = AccountStats()
+
+            parse_queue = asyncio.Queue(maxsize=self.queue_size)
+            async with asyncio.TaskGroup() as task_group:
+                task_group.create_task(self.fetch_stage(fetcher, account, last_reaction_id, is_backfill, parse_queue))
+                task_group.create_task(self.parse_stage(fetcher, account, parse_queue, output_queue))
+        except Exception as e:
+            error = e.exceptions[0] if isinstance(e, ExceptionGroup) else e
+            logger.error(f"{account} : {error.__class__.__name__}, crawl of this account failed.", exc_info=error)
+            self.stats_dict.setdefault(account, AccountStats()).error = error
+
+    async def producer_stage(self, is_backfill: bool, output_queue: asyncio.Queue) -> None:
+        """全アカウントの fetch -> parse を並行に動かし、共有のダウンロードステージへ流す"""
+        async with asyncio.TaskGroup() as task_group:
+            for fetcher in self.fetcher_list:
+                task_group.create_task(self.account_stage(fetcher, is_backfill, output_queue))
+        await output_queue.put(None)
+
+    async def download_stage(self, input_queue: asyncio.Queue, output_queue: asyncio.Queue) -> None:
+        """ページに含まれるメディアを、全ページで共有するワーカーに渡してダウンロードする
+
+        ワーカーとレーン、同時に取得中のバイト数の上限はページをまたいで共有するので、
+        前のページのメディアを取得している間にも次のページのメディアを取得し始める
+        ページの並びは complete_stage で保つ
+        保存期間の上限を超えて直後に削除されるメディアはダウンロードしない
+        """
+        complete_queue = asyncio.Queue(maxsize=self.queue_size)
+        async with asyncio.TaskGroup() as task_group:
+            task_group.create_task(self.downloader.serve())
+            task_group.create_task(self.complete_stage(complete_queue, output_queue))
+            while (page := await input_queue.get()) is not None:
+                logger.info(f"{page.account} : Num of new media is {len(page.media_list)}.")
+                media_list = await asyncio.to_thread(self.retention_policy.select_downloadable, page)
+                future = await self.downloader.submit(media_list)
+                await complete_queue.put((page, future))
+            await self.downloader.close_lanes()
+            await complete_queue.put(None)
+
+    async def complete_stage(self, input_queue: asyncio.Queue, output_queue: asyncio.Queue) -> None:
+        """ページのダウンロードの完了を受け取った順に待って次のステージへ流す
+
+        ページごとに保存期間の上限を超えた古いメディアを削除する
+        """
+        while (item := await input_queue.get()) is not None:
+            page, future = item
+            await future
+            await asyncio.to_thread(self.retention_policy.apply, page)
+            await output_queue.put(page)
+        await output_queue.put(None)
+
+    def upsert(self, page: CrawledPage) -> None:
+        """ページのレコードとアカウントのカーソルを1つのトランザクションで DB に反映する
+
+        途中で失敗した場合はページ全体がロールバックされ、カーソルも進まない
+        時間窓のページなら、同じトランザクションで時間窓のカーソルを進め、最後のページなら完了にする
+        """
+        logger.info("DB control -> start.")
+        last_reaction_id = max_id([self.crawl_state_db.select_last_reaction_id(page.account), page.last_reaction_id])
+        with self.database.transaction():
+            # メディアのないノートだけのページもあるため、空のリストは反映しない
+            for record_db, record_list in [
+                (self.reaction_db, page.reaction_list),
+                (self.note_db, page.note_list),
+                (self.user_db, page.user_list),
+                (self.media_db, page.media_list),
+            ]:
+                if record_list:
+                    record_db.upsert(record_list)
+
+            # ページの反映と同じトランザクションでアカウントのカーソルを進める
+            self.crawl_state_db.upsert(CrawlState(page.account, last_reaction_id, datetime.now().isoformat()))
+            if page.window_key:
+                self.backfill_window_db.advance(page.window_key, page.window_cursor_id, page.is_window_done)
+        logger.info("DB control -> done.")
+
+    async def upsert_stage(self, input_queue: asyncio.Queue) -> int:
+        """ダウンロードが済んだページのレコードを DB に反映する
+
+        レコードにできるエントリがないページも、カーソルを進めるために反映する
+
+        Returns:
+            int: DB に反映したページ数
+        """
+        page_num = 0
+        while (page := await input_queue.get()) is not None:
+            if page.last_reaction_id or page.window_key:
+                await asyncio.to_thread(self.upsert, page)
+            stats = self.stats_dict.setdefault(page.account, AccountStats())
+            stats.page_num += 1
+            stats.reaction_num += len(page.reaction_list)
+            stats.media_num += len(page.media_list)
+            page_num += 1
+        return page_num
+
+    async def pipeline(self, is_backfill: bool = False) -> int:
+        """fetch -> parse -> download -> upsert の各ステージを並行に動かす
+
+        fetch と parse はアカウントごとに並行に動き、download と upsert は全アカウントで共有する
+        ステージ間は上限付きのキューでつなぐため、取得件数によらずメモリに載るのは
+        キューごとに高々 queue_size ページ分となる
+        API の呼び出しとメディアのダウンロードは同じイベントループ上で並行に実行される
+        保存期間の上限があれば、開始前に MediaFile に記録されていない既存のファイルを記録する
+
+        Returns:
+            int: 処理したページ数
+        """
+        download_queue = asyncio.Queue(maxsize=self.queue_size)
+        upsert_queue = asyncio.Queue(maxsize=self.queue_size)
+        try:
+            await asyncio.to_thread(self.retention_policy.seed)
+            async with asyncio.TaskGroup() as task_group:
+                task_group.create_task(self.producer_stage(is_backfill, download_queue))
+                task_group.create_task(self.download_stage(download_queue, upsert_queue))
+                upsert_task = task_group.create_task(self.upsert_stage(upsert_queue))
+        finally:
+            for fetcher in self.fetcher_list:
+                await fetcher.aclose()
+            await self.downloader.aclose()
+        return upsert_task.result()
+
+    def log_stats(self) -> None:
+        for account, stats in self.stats_dict.items():
+            logger.info(
+                f"{account} : {stats.page_num} page(s), {stats.reaction_num} reaction(s), "
+                f"{stats.media_num} media, throughput {stats.throughput():.2f} [reaction/sec]."
+            )
+            if stats.error is not None:
+                logger.info(f"{account} : Failed with {stats.error.__class__.__name__} : {stats.error}")
+        for fetcher in self.fetcher_list:
+            fetcher.misskey.scheduler.log_stats(fetcher.account_name)
+        self.downloader.log_stats()
+
+    def run(self, is_backfill: bool = False) -> None:
         logger.info("Crawler run -> start")
-        instance_name = self.fetcher.misskey.instance_name
-
-        # reaction_id をもとに最後につけたリアクションを取得
-        last_reaction_id = ""
-        last_reaction = self.reaction_db.select_last_record()
-        if last_reaction:
-            last_reaction_id = last_reaction.reaction_id
-            last_note_id = last_reaction.note_id
-            last_note_url = f"https://{instance_name}/notes/{last_note_id}"
-            logger.info(f"Last reaction id is '{last_reaction_id}'.")
-            logger.info(f"Last note url is '{last_note_url}'.")
-        else:
-            logger.info(f"Last reaction is not exist, first run.")
-
-        # fetch
+        if is_backfill:
+            logger.info(f"Backfill mode, fetch whole reaction history.")
+
+        # fetch -> parse -> download -> upsert
+        logger.info(f"Num of accounts is {len(self.fetcher_list)}.")
+        logger.info(f"Save base path : {str(self.downloader.save_base_path)}")
         start_time = time.time()
-        fetched_list: list[FetchedInfo] = self.fetcher.fetch(last_reaction_id)
+        try:
+            page_num = asyncio.run(self.pipeline(is_backfill))
+        finally:
+            self.database.close()
         elapsed_time = time.time() - start_time
-        logger.info(f"Fetching : {elapsed_time} [sec].")
-        if len(fetched_list) == 0:
+        logger.info(f"Crawling : {elapsed_time} [sec], {page_num} page(s).")
+        self.log_stats()
+        if page_num == 0:
             logger.info("No reaction created from last reaction.")
-            logger.info("Crawler run -> done")
-            return
-
-        # FetchedInfo をそれぞれのリストに分解
-        reaction_list, note_list, user_list, media_list = [], [], [], []
-        for fetched_record in fetched_list:
-            records = fetched_record.get_records()
-            for record in records:
-                reaction, note, user, media = record
-                if reaction not in reaction_list:
-                    reaction_list.append(reaction)
-                if note not in note_list:
-                    note_list.append(note)
-                if user not in user_list:
-                    user_list.append(user)
-                if media not in media_list:
-                    media_list.append(media)
-
-        # メディアダウンロード・保存
-        # seen = []
-        # media_list = [media for media in media_list if media not in seen and not seen.append(media)]
-        logger.info(f"Num of new media is {len(media_list)}.")
-        start_time = time.time()
-        self.downloader.download(media_list)
-        elapsed_time = time.time() - start_time
-        logger.info(f"Download : {elapsed_time} [sec].")
-
-        # DB操作
-        logger.info("DB control -> start.")
-        self.reaction_db.upsert(reaction_list)
-        self.note_db.upsert(note_list)
-        self.user_db.upsert(user_list)
-        self.media_db.upsert(media_list)
-        logger.info("DB control -> done.")
         logger.info("Crawler run -> done")
 
 
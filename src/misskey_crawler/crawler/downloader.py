@@ -1,53 +1,662 @@
 import asyncio
+import hashlib
+import os
 import pprint
+import shutil
+from collections import deque
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass, field
 from logging import INFO, getLogger
 from pathlib import Path
 
 import httpx
 import orjson
 
+from misskey_crawler.crawler.checksum_cache import ChecksumCache
 from misskey_crawler.db.model import Media
 
 logger = getLogger(__name__)
 logger.setLevel(INFO)
 
+# 配信用に変換したファイル (webpublic) を url で返すことがある画像の種類
+WEBPUBLIC_TYPE_SET = frozenset([
+    "image/jpeg",
+    "image/png",
+    "image/webp",
+    "image/avif",
+    "image/bmp",
+    "image/svg+xml",
+])
+
+
+class ChecksumMismatchError(Exception):
+    """ダウンロードしたメディアの md5 が API の値と一致しない"""
+
+    def __init__(self, url: str, expected: str, actual: str) -> None:
+        self.url = url
+        self.expected = expected
+        self.actual = actual
+        super().__init__(f"{url} : md5 mismatch, expected '{expected}' but got '{actual}'.")
+
+
+@dataclass
+class ConnectionStats:
+    """メディアホストごとの接続統計
+
+    request_num は送信したリクエスト数、connection_num は新規に張った TCP 接続数
+    """
+
+    request_num: int = 0
+    connection_num: int = 0
+
+    def reused_num(self) -> int:
+        """既存の接続を再利用したリクエスト数"""
+        return max(self.request_num - self.connection_num, 0)
+
+
+class ByteBudget:
+    """同時にダウンロード中のバイト数を limit までに制限する
+
+    limit のうち reserve_ratio の割合は小さいファイルだけが使える枠とし、大きいファイルは残りの枠を使う
+    大きいファイルが取得中でも、小さいファイルは自分の枠で待たずに取得を始められる
+    ファイルはチャンクごとにディスクへ書き出すのでメモリはファイルサイズによらず、
+    大きいファイル1つが確保するのは大きいファイルの枠を slot_num で割った分までとする
+    slot_num をワーカー数にしておけば、大きいファイル同士が枠を待ってワーカーを止めることはない
+    limit が0以下なら制限しない
+    """
+
+    limit: int
+    slot_num: int
+    in_flight: int
+    small_in_flight: int
+    large_in_flight: int
+    peak: int
+    reserve_ratio: float = 0.25
+
+    def __init__(self, limit: int, slot_num: int = 1) -> None:
+        self.limit = limit
+        self.slot_num = max(slot_num, 1)
+        self.in_flight = 0
+        self.small_in_flight = 0
+        self.large_in_flight = 0
+        self.peak = 0
+        self.condition = asyncio.Condition()
+
+    @property
+    def small_limit(self) -> int:
+        """小さいファイルだけが使える枠"""
+        return int(self.limit * self.reserve_ratio)
+
+    @property
+    def large_limit(self) -> int:
+        """大きいファイルが使える枠"""
+        return self.limit - self.small_limit
+
+    async def acquire(self, size: int, is_large: bool = False) -> int:
+        """size バイト分の枠を、is_large に応じた枠から確保する、確保できるまで待機する
+
+        小さいファイルは枠を超える場合、他に取得中の小さいファイルがなくなってから取得する
+        大きいファイルは large_limit / slot_num を超える分は確保しない
+
+        Returns:
+            int: 確保したバイト数、is_large とともに release に渡す
+        """
+        if self.limit <= 0:
+            return 0
+        size = max(size, 0)
+        async with self.condition:
+            if is_large:
+                size = min(size, self.large_limit // self.slot_num)
+                await self.condition.wait_for(lambda: self.large_in_flight + size <= self.large_limit)
+                self.large_in_flight += size
+            else:
+                size = min(size, self.small_limit)
+                await self.condition.wait_for(
+                    lambda: self.small_in_flight == 0 or self.small_in_flight + size <= self.small_limit
+                )
+                self.small_in_flight += size
+            self.in_flight += size
+            self.peak = max(self.peak, self.in_flight)
+        return size
+
+    async def release(self, size: int, is_large: bool = False) -> None:
+        if size <= 0:
+            return
+        async with self.condition:
+            if is_large:
+                self.large_in_flight -= size
+            else:
+                self.small_in_flight -= size
+            self.in_flight -= size
+            self.condition.notify_all()
+
+
+@dataclass
+class DownloadBatch:
+    """submit に渡した1回分のメディアの完了を通知する
+
+    remaining は未完了のメディア数、すべて完了したら future を完了させる
+    失敗したメディアがあれば、最初の例外を future に設定する
+    """
+
+    future: asyncio.Future
+    remaining: int
+    error_list: list[Exception] = field(default_factory=list)
+
+    def done(self, error: Exception | None = None) -> None:
+        if error is not None:
+            self.error_list.append(error)
+        self.remaining -= 1
+        if self.remaining > 0 or self.future.done():
+            return
+        if self.error_list:
+            self.future.set_exception(self.error_list[0])
+        else:
+            self.future.set_result(None)
+
+
+class DownloadLanes:
+    """ワーカーが取り出すメディアを、小さいファイルと大きいファイルの2つのレーンに分けて保持する
+
+    close したあとは、両方のレーンが空になった時点で get が None を返す
+    """
+
+    small_deque: deque[tuple[Media, DownloadBatch]]
+    large_deque: deque[tuple[Media, DownloadBatch]]
+    is_closed: bool
+
+    def __init__(self) -> None:
+        self.small_deque = deque()
+        self.large_deque = deque()
+        self.is_closed = False
+        self.condition = asyncio.Condition()
+
+    async def extend(
+        self, small_list: list[tuple[Media, DownloadBatch]], large_list: list[tuple[Media, DownloadBatch]]
+    ) -> None:
+        async with self.condition:
+            self.small_deque.extend(small_list)
+            self.large_deque.extend(large_list)
+            self.condition.notify_all()
+
+    async def get(self, prefer_large: bool) -> tuple[Media, DownloadBatch] | None:
+        """メディアを1つ取り出す、prefer_large なら大きいファイルのレーンから優先して取り出す
+
+        どちらのレーンも空なら、メディアが追加されるか close されるまで待機する
+        """
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.small_deque or self.large_deque or self.is_closed)
+            deque_list = [self.large_deque, self.small_deque] if prefer_large else [self.small_deque, self.large_deque]
+            for item_deque in deque_list:
+                if item_deque:
+                    return item_deque.popleft()
+            return None
+
+    async def close(self) -> None:
+        async with self.condition:
+            self.is_closed = True
+            self.condition.notify_all()
+
 
 class Downloader:
     save_base_path: Path
     save_num: int
+    save_bytes: int
+    http2: bool
+    max_workers: int
+    max_connections: int
+    max_connections_per_host: int
+    keepalive_expiry: float
+    chunk_size: int
+    max_retries: int
+    content_addressed: bool
+    large_threshold: int
+    large_workers: int
+    byte_budget: ByteBudget
+    checksum_cache: ChecksumCache
+    client: httpx.AsyncClient | None
+    host_semaphore_dict: dict[str, asyncio.Semaphore]
+    md5_lock_dict: dict[str, asyncio.Lock]
+    connection_stats_dict: dict[str, ConnectionStats]
+    lanes: DownloadLanes | None
+    dedup_num: int
+    store_dirname: str = ".store"
 
     def __init__(self, config_path: Path) -> None:
         logger.info("Downloader init -> start")
         config_dict = orjson.loads(config_path.read_bytes())
         self.save_base_path = Path(config_dict["misskey"]["save_base_path"])
         self.save_num = int(config_dict["misskey"]["save_num"])
+        self.save_bytes = int(config_dict["misskey"].get("save_bytes", -1))
+
+        download_dict = config_dict["misskey"].get("download", {})
+        self.http2 = bool(download_dict.get("http2", True))
+        self.max_workers = int(download_dict.get("max_workers", 16))
+        self.max_connections = int(download_dict.get("max_connections", 32))
+        self.max_connections_per_host = int(download_dict.get("max_connections_per_host", 8))
+        self.keepalive_expiry = float(download_dict.get("keepalive_expiry", 30.0))
+        self.chunk_size = int(download_dict.get("chunk_size", 64 * 1024))
+        self.max_retries = int(download_dict.get("max_retries", 3))
+        self.content_addressed = bool(download_dict.get("content_addressed", False))
+        self.large_threshold = int(download_dict.get("large_threshold", 8 * 1024 * 1024))
+        self.large_workers = int(download_dict.get("large_workers", 2))
+        self.byte_budget = ByteBudget(
+            int(download_dict.get("max_inflight_bytes", 256 * 1024 * 1024)),
+            min(self.max_workers, self.max_connections),
+        )
+        self.checksum_cache = ChecksumCache(self.save_base_path / ".checksum_cache.json")
+        self.client = None
+        self.host_semaphore_dict = {}
+        self.md5_lock_dict = {}
+        self.connection_stats_dict = {}
+        self.lanes = None
+        self.dedup_num = 0
 
         self.save_base_path.mkdir(parents=True, exist_ok=True)
         logger.info("Downloader init -> done")
 
-    async def worker(self, media: Media) -> None:
-        transport = httpx.AsyncHTTPTransport(retries=5)
-        timeout = httpx.Timeout(5, read=60)
-        async with httpx.AsyncClient(follow_redirects=True, timeout=timeout, transport=transport) as client:
-            url = media.url
-            filename = media.get_filename()
-            filepath = self.save_base_path / filename
-            if filepath.exists():
-                return
+    def get_client(self) -> httpx.AsyncClient:
+        """実行全体で共有する接続プール付きのクライアントを返す
+
+        同じメディアホストへの接続は keep-alive で使い回し、
+        http2 が有効ならホストごとに1本の接続上でリクエストを多重化する
+        """
+        if self.client is None:
+            limits = httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_connections,
+                keepalive_expiry=self.keepalive_expiry,
+            )
+            transport = httpx.AsyncHTTPTransport(retries=5, http2=self.http2, limits=limits)
+            timeout = httpx.Timeout(5, read=60)
+            self.client = httpx.AsyncClient(follow_redirects=True, timeout=timeout, transport=transport)
+        return self.client
+
+    def get_host_semaphore(self, host: str) -> asyncio.Semaphore:
+        """ホストごとの同時接続数を max_connections_per_host に制限するセマフォを返す"""
+        if host not in self.host_semaphore_dict:
+            self.host_semaphore_dict[host] = asyncio.Semaphore(self.max_connections_per_host)
+        return self.host_semaphore_dict[host]
+
+    @staticmethod
+    def get_tracer(stats: ConnectionStats) -> Callable[[str, dict], Awaitable[None]]:
+        """httpcore の trace 拡張に渡すコールバックを返す
+
+        新規接続とリクエスト送信のイベントを数え、接続の再利用状況を stats に記録する
+        """
+
+        async def trace(event_name: str, info: dict) -> None:
+            if event_name == "connection.connect_tcp.complete":
+                stats.connection_num += 1
+            elif event_name.endswith(".send_request_headers.started"):
+                stats.request_num += 1
+
+        return trace
+
+    @staticmethod
+    def get_part_path(filepath: Path) -> Path:
+        """ダウンロード途中のデータを保持する .part ファイルのパス"""
+        return filepath.with_name(f"{filepath.name}.part")
 
-            response = await client.get(url)
+    @staticmethod
+    def get_meta_path(filepath: Path) -> Path:
+        """.part ファイルの取得元と検証子を記録するサイドカーファイルのパス"""
+        return filepath.with_name(f"{filepath.name}.part.json")
+
+    @staticmethod
+    def get_validator(response: httpx.Response) -> str:
+        """If-Range に使える検証子を返す
+
+        弱い ETag は If-Range に使えないため、強い ETag、Last-Modified の順に参照する
+        どちらもなければ空文字列を返し、その .part は再開対象にしない
+        """
+        etag = response.headers.get("ETag", "")
+        if etag and not etag.startswith("W/"):
+            return etag
+        return response.headers.get("Last-Modified", "")
+
+    def load_part(self, filepath: Path, url: str) -> tuple[int, str]:
+        """再開できる .part があれば、そのサイズと If-Range に使う検証子を返す
+
+        Returns:
+            tuple[int, str]: (再開位置, 検証子)、再開できなければ (0, "")
+        """
+        part_path = self.get_part_path(filepath)
+        meta_path = self.get_meta_path(filepath)
+        if not (part_path.exists() and meta_path.exists()):
+            return 0, ""
+        try:
+            meta_dict = orjson.loads(meta_path.read_bytes())
+        except orjson.JSONDecodeError:
+            return 0, ""
+        validator = meta_dict.get("validator", "")
+        if meta_dict.get("url") != url or validator == "":
+            return 0, ""
+        return part_path.stat().st_size, validator
+
+    def discard_part(self, filepath: Path) -> None:
+        self.get_part_path(filepath).unlink(missing_ok=True)
+        self.get_meta_path(filepath).unlink(missing_ok=True)
+
+    @staticmethod
+    def is_resumed(response: httpx.Response, offset: int) -> bool:
+        """レスポンスが offset からの続きを返しているか"""
+        if offset <= 0 or response.status_code != httpx.codes.PARTIAL_CONTENT:
+            return False
+        content_range = response.headers.get("Content-Range", "")
+        return content_range.startswith(f"bytes {offset}-")
+
+    @staticmethod
+    def is_converted(media: Media, file_size: int) -> bool:
+        """file_size のファイルが、media の配信用に変換されたファイル (webpublic) か
+
+        Misskey は WEBPUBLIC_TYPE_SET の画像を配信用に変換して url で返すことがあり、
+        そのファイルは API の size と md5 に一致しない
+        それ以外の種類のメディアでサイズが異なるものは、変換ではなく破損とみなす
+        """
+        return media.size >= 0 and file_size != media.size and media.type in WEBPUBLIC_TYPE_SET
+
+    def is_saved(self, media: Media, filepath: Path) -> bool:
+        """filepath に media が保存済みか
+
+        md5 が分からないメディアは存在するだけで保存済みとする
+        そうでなければ記録済みのチェックサムかファイルの md5 で判定する
+        配信用に変換されたファイルは fetch が受け入れたときにチェックサムを記録するので、
+        記録のないファイルでサイズが異なる場合は、途中で切れたものとしてファイルを読まずに未保存とする
+        """
+        if not filepath.exists():
+            return False
+        if media.md5 == "":
+            return True
+        if self.checksum_cache.is_accepted(filepath, media.md5):
+            return True
+        if media.size >= 0 and filepath.stat().st_size != media.size:
+            return False
+        return self.checksum_cache.md5(filepath) == media.md5
+
+    def verify(self, media: Media, part_path: Path, md5: str) -> None:
+        """ダウンロードした .part を API の size と md5 で検証する
+
+        配信用に変換されたファイルは md5 を検証しない
+        それ以外は md5 が一致しなければ、途中で切れたものも含めて破損とみなす
+
+        Raises:
+            ChecksumMismatchError: md5 が一致しない場合
+        """
+        if media.md5 == "" or media.size < 0:
+            return
+        if self.is_converted(media, part_path.stat().st_size):
+            return
+        if md5 != media.md5:
+            raise ChecksumMismatchError(media.url, media.md5, md5)
+
+    async def fetch(self, client: httpx.AsyncClient, media: Media, filepath: Path, stats: ConnectionStats) -> bool:
+        """1回のリクエストで media を取得して filepath に保存する
+
+        .part があれば Range と If-Range をつけて続きから取得する
+        サーバが Range に対応していない、または検証子が変わっていた場合は 200 で全体が返るので最初から書き直す
+        md5 は受信しながら計算し、検証に通ったものだけを filepath にリネームする
+
+        Returns:
+            bool: 保存できたら True、416 を受けて .part を破棄した場合は False
+
+        Raises:
+            ChecksumMismatchError: md5 が一致しない場合、.part は破棄する
+        """
+        url = media.url
+        part_path = self.get_part_path(filepath)
+        offset, validator = self.load_part(filepath, url)
+        headers = {}
+        if offset > 0:
+            headers = {"Range": f"bytes={offset}-", "If-Range": validator}
+
+        extensions = {"trace": self.get_tracer(stats)}
+        async with client.stream("GET", url, headers=headers, extensions=extensions) as response:
+            if response.status_code == httpx.codes.REQUESTED_RANGE_NOT_SATISFIABLE:
+                logger.info(f"{url} : Range not satisfiable, discard partial file.")
+                self.discard_part(filepath)
+                return False
             response.raise_for_status()
+            hasher = hashlib.md5()
+            if self.is_resumed(response, offset):
+                # 続きから取得する場合は受信済みの部分を先にハッシュしておく
+                hasher = await asyncio.to_thread(ChecksumCache.hash_file, part_path)
+            else:
+                offset = 0
+                meta_dict = {"url": url, "validator": self.get_validator(response)}
+                self.get_meta_path(filepath).write_bytes(orjson.dumps(meta_dict))
+            await self.save_stream(response, part_path, offset, hasher)
+
+        md5 = hasher.hexdigest()
+        try:
+            self.verify(media, part_path, md5)
+        except ChecksumMismatchError:
+            self.discard_part(filepath)
+            raise
+        os.replace(part_path, filepath)
+        self.get_meta_path(filepath).unlink(missing_ok=True)
+        self.checksum_cache.set(filepath, md5, media.md5)
+        return True
+
+    async def retrieve(self, media: Media, filepath: Path) -> None:
+        """media を filepath にダウンロードする
+
+        トランスポートエラーで中断した場合は .part を残したまま max_retries 回まで続きから再開する
+        リトライ上限に達しても .part は残すので、次回の実行でも続きから取得できる
+        md5 が一致しなかった場合も同じ回数まで最初から取得し直す
+        取得中は media.size 分の枠を、ファイルの大きさに応じた byte_budget の枠から確保しておく
+        """
+        url = media.url
+        client = self.get_client()
+        host = httpx.URL(url).host
+        stats = self.connection_stats_dict.setdefault(host, ConnectionStats())
+        is_large = self.is_large(media)
+        reserved = await self.byte_budget.acquire(media.size if media.size >= 0 else self.large_threshold, is_large)
+        try:
+            attempt = 0
+            while True:
+                try:
+                    async with self.get_host_semaphore(host):
+                        if await self.fetch(client, media, filepath, stats):
+                            return
+                    continue
+                except (httpx.TransportError, ChecksumMismatchError) as e:
+                    if attempt >= self.max_retries:
+                        raise
+                    delay = min(2**attempt, 30)
+                    logger.warning(f"{url} : {e.__class__.__name__}, retry after {delay} [sec].")
+                await asyncio.sleep(delay)
+                attempt += 1
+        finally:
+            await self.byte_budget.release(reserved, is_large)
+
+    def get_store_path(self, media: Media) -> Path:
+        """コンテンツアドレス方式のストア上のパス .store/{md5 の先頭2文字}/{md5}{拡張子}"""
+        suffix = Path(media.get_filename()).suffix
+        return self.save_base_path / self.store_dirname / media.md5[:2] / f"{media.md5}{suffix}"
 
-            filepath.write_bytes(response.content)
+    def get_md5_lock(self, md5: str) -> asyncio.Lock:
+        """同じ md5 のメディアを並行して取得しないためのロックを返す"""
+        if md5 not in self.md5_lock_dict:
+            self.md5_lock_dict[md5] = asyncio.Lock()
+        return self.md5_lock_dict[md5]
+
+    def link(self, store_path: Path, filepath: Path) -> None:
+        """ストア上のファイルを指すファイルを filepath に作る
+
+        ハードリンク、シンボリックリンク、コピーの順に試す
+        ハードリンクとコピーはストアと同じ内容なので、記録済みのチェックサムも引き継ぐ
+        """
+        filepath.unlink(missing_ok=True)
+        try:
+            os.link(store_path, filepath)
+        except OSError:
+            try:
+                filepath.symlink_to(store_path.resolve())
+                return
+            except OSError:
+                shutil.copy2(store_path, filepath)
+        if entry := self.checksum_cache.get(store_path):
+            self.checksum_cache.set(filepath, entry["md5"], entry.get("media_md5", ""))
+
+    async def worker(self, media: Media) -> None:
+        """メディアを1つダウンロードする
+
+        content_addressed が有効なら、実体は md5 をキーにしたストアに1度だけ保存し、
+        ノートごとのファイル名はストア上のファイルへのリンクにする
+        ストアに保存済みのメディアは取得しない
+        """
+        url = media.url
+        filename = media.get_filename()
+        filepath = self.save_base_path / filename
+        if await asyncio.to_thread(self.is_saved, media, filepath):
+            return
+        if filepath.exists():
+            logger.info(f"{url} : Saved file does not match md5, download again.")
+
+        if not (self.content_addressed and media.md5):
+            await self.retrieve(media, filepath)
+            return
+
+        store_path = self.get_store_path(media)
+        async with self.get_md5_lock(media.md5):
+            if await asyncio.to_thread(self.is_saved, media, store_path):
+                self.dedup_num += 1
+            else:
+                store_path.parent.mkdir(parents=True, exist_ok=True)
+                await self.retrieve(media, store_path)
+        await asyncio.to_thread(self.link, store_path, filepath)
+
+    async def save_stream(
+        self, response: httpx.Response, part_path: Path, offset: int = 0, hasher: "hashlib._Hash | None" = None
+    ) -> None:
+        """レスポンスボディを chunk_size ごとに .part ファイルへ書き込む
+
+        offset が 0 なら .part を切り詰めて最初から、0 より大きければ末尾に追記する
+        hasher が指定されていれば書き込んだチャンクでハッシュを更新する
+        完了後のリネームは呼び出し側で行う、.part は保存先と同じディレクトリにあるので os.replace はアトミックになる
+        """
+        mode = "ab" if offset > 0 else "wb"
+        with part_path.open(mode) as f:
+            async for chunk in response.aiter_bytes(self.chunk_size):
+                f.write(chunk)
+                if hasher is not None:
+                    hasher.update(chunk)
+
+    def is_large(self, media: Media) -> bool:
+        """大きいファイルのレーンで扱うか、サイズが分からないものも大きいファイルとして扱う"""
+        return media.size < 0 or media.size >= self.large_threshold
+
+    def get_lanes(self) -> DownloadLanes:
+        """serve のワーカーと submit で共有するレーンを返す、close したレーンは serve の終了時に破棄する"""
+        if self.lanes is None:
+            self.lanes = DownloadLanes()
+        return self.lanes
+
+    async def run_lane_worker(self, lanes: DownloadLanes, prefer_large: bool) -> None:
+        """レーンからメディアを取り出してダウンロードする、失敗しても次のメディアの取得を続ける"""
+        while (item := await lanes.get(prefer_large)) is not None:
+            media, batch = item
+            try:
+                await self.worker(media)
+            except Exception as e:
+                logger.warning(f"{media.url} : {e.__class__.__name__}, download failed.")
+                batch.done(e)
+                continue
+            batch.done()
+
+    async def serve(self) -> None:
+        """submit されたメディアを固定数のワーカーでダウンロードする
+
+        ワーカーは close_lanes が呼ばれてレーンが空になるまで動き続けるので、
+        submit を何回に分けて呼んでも、ワーカー数と同時に取得中のバイト数の上限は全体で共有される
+        全体の同時実行数はワーカー数(max_workers と max_connections の小さい方)、
+        ホストごとの同時実行数は max_connections_per_host で制限する
+        メディアはサイズで2つのレーンに分け、大きいファイルを優先するワーカーは large_workers 個とする
+        残りのワーカーは小さいファイルがなくなってから大きいファイルを手伝うので、
+        小さいファイルが残っている間に大きいファイルを同時に取得するのは高々 large_workers 個で、
+        大きいファイルが小さいファイルを待たせることはない
+        """
+        lanes = self.get_lanes()
+        worker_num = min(self.max_workers, self.max_connections)
+        large_worker_num = min(self.large_workers, max(worker_num - 1, 0))
+        try:
+            async with asyncio.TaskGroup() as task_group:
+                for i in range(worker_num):
+                    task_group.create_task(self.run_lane_worker(lanes, i < large_worker_num))
+        finally:
+            if self.lanes is lanes:
+                self.lanes = None
+
+    async def submit(self, media_list: list[Media]) -> asyncio.Future:
+        """メディアをレーンに追加して、すべてのダウンロードが済んだら完了する future を返す
+
+        失敗したメディアがあっても残りのダウンロードは続け、future には最初の例外を設定する
+        """
+        future = asyncio.get_running_loop().create_future()
+        if not media_list:
+            future.set_result(None)
+            return future
+        batch = DownloadBatch(future, len(media_list))
+        small_list: list[tuple[Media, DownloadBatch]] = []
+        large_list: list[tuple[Media, DownloadBatch]] = []
+        for media in media_list:
+            if self.is_large(media):
+                large_list.append((media, batch))
+            else:
+                small_list.append((media, batch))
+        await self.get_lanes().extend(small_list, large_list)
+        return future
+
+    async def close_lanes(self) -> None:
+        """これ以上 submit しないことを serve のワーカーに伝える、レーンに残ったメディアは取得してから終了する"""
+        await self.get_lanes().close()
 
     async def excute(self, media_list: list[Media]) -> None:
-        task_list = [self.worker(media) for media in media_list]
-        await asyncio.gather(*task_list)
+        """media_list だけをダウンロードするワーカーを動かし、すべて済むまで待つ
+
+        同時実行数とレーンの扱いは serve と同じ
+        失敗したメディアがあっても残りのダウンロードは続け、最後に最初の例外を送出する
+        """
+        async with asyncio.TaskGroup() as task_group:
+            task_group.create_task(self.serve())
+            future = await self.submit(media_list)
+            await self.close_lanes()
+        await future
+
+    async def aclose(self) -> None:
+        """共有クライアントを閉じてチェックサムのキャッシュを書き出す、クライアントとロック、レーンは次の実行で作り直す"""
+        if self.client is not None:
+            await self.client.aclose()
+        self.client = None
+        self.host_semaphore_dict = {}
+        self.md5_lock_dict = {}
+        self.lanes = None
+        self.byte_budget.condition = asyncio.Condition()
+        self.checksum_cache.save()
+
+    def log_stats(self) -> None:
+        for host, stats in self.connection_stats_dict.items():
+            logger.info(
+                f"{host} : {stats.request_num} request(s) over {stats.connection_num} connection(s), "
+                f"{stats.reused_num()} reused."
+            )
+        if self.content_addressed:
+            logger.info(f"Content addressed store : {self.dedup_num} media deduplicated.")
+        if self.byte_budget.limit > 0:
+            logger.info(f"Peak in-flight : {self.byte_budget.peak} / {self.byte_budget.limit} [bytes].")
+
+    async def _download(self, media_list: list[Media]) -> None:
+        try:
+            await self.excute(media_list)
+        finally:
+            await self.aclose()
 
     def download(self, media_list: list[Media]) -> None:
         logger.info("Downloader download -> start")
         logger.info(f"Save base path : {str(self.save_base_path)} -> start")
-        asyncio.run(self.excute(media_list))
+        asyncio.run(self._download(media_list))
+        self.log_stats()
         logger.info("Downloader download -> done")
 
 
@@ -66,8 +675,8 @@ if __name__ == "__main__":
         "md5": "",
         "size": -1,
         "url": "https://s3.arkjp.net/misskey/937f6abf-be32-4601-84dc-4fae22637b72.jpg",
-        "created_at": "",
-        "registered_at": "",
+        "created_at": 0,
+        "registered_at": 0,
     }
     media1 = Media.create(media_dict1)
     media_dict2 = {
@@ -78,8 +687,8 @@ if __name__ == "__main__":
         "md5": "",
         "size": -1,
         "url": "https://s3.arkjp.net/misskey/50f2bf8e-e0ec-4906-a232-15266031cd44.jpg",
-        "created_at": "",
-        "registered_at": "",
+        "created_at": 0,
+        "registered_at": 0,
     }
     media2 = Media.create(media_dict2)
     response = downloader.download([media1, media2])
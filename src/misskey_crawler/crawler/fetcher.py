@@ -1,12 +1,19 @@
+import asyncio
 import pprint
+from collections.abc import AsyncIterator
 from datetime import datetime
 from logging import INFO, getLogger
 from pathlib import Path
+from typing import Self
 
 import orjson
 
 from misskey_crawler.crawler.valueobject.fetched_info import FetchedInfo
+from misskey_crawler.db.model import BackfillWindow
 from misskey_crawler.misskey_manager.misskey_manager import MisskeyManager
+from misskey_crawler.misskey_manager.request_scheduler import RequestScheduler
+from misskey_crawler.util import to_epoch_ms
+from misskey_crawler.util.misskey_id import decode_time, detect_format, encode_boundary_list, max_id, min_id
 
 logger = getLogger(__name__)
 logger.setLevel(INFO)
@@ -15,59 +22,262 @@ logger.setLevel(INFO)
 class Fetcher:
     misskey: MisskeyManager
     is_debug: bool
+    account_index: int
+    account_name: str = ""
     cache_path = Path("./cache/")
+    page_limit: int = 100
+    window_num: int = 16
+    window_workers: int = 4
+    window_buffer_size: int = 4
 
-    def __init__(self, config_path: Path, is_debug: bool = False) -> None:
+    def __init__(self, config_path: Path, is_debug: bool = False, account_index: int = 0) -> None:
         logger.info("Fetcher init -> start")
         config_dict = orjson.loads(config_path.read_bytes())
-        instance_name = config_dict["misskey"]["instance"]
-        token = config_dict["misskey"]["token"]
-        self.misskey = MisskeyManager(instance_name, token)
+        account_dict = self.get_account_list(config_dict)[account_index]
+        instance_name = account_dict["instance"]
+        token = account_dict["token"]
+        rate_limit_dict = config_dict["misskey"].get("rate_limit", {}) | account_dict.get("rate_limit", {})
+        scheduler = RequestScheduler.create(rate_limit_dict)
+        self.misskey = MisskeyManager(instance_name, token, scheduler)
         self.is_debug = is_debug
+        self.account_index = account_index
+
+        backfill_dict = config_dict["misskey"].get("backfill", {})
+        self.window_num = int(backfill_dict.get("window_num", self.window_num))
+        self.window_workers = int(backfill_dict.get("window_workers", self.window_workers))
+        self.window_buffer_size = int(backfill_dict.get("window_buffer_size", self.window_buffer_size))
 
         self.cache_path.mkdir(parents=True, exist_ok=True)
         logger.info("Fetcher init -> done")
 
-    def fetch(self, last_since_id: str = "") -> list[FetchedInfo]:
-        logger.info("Fetcher fetch -> start")
-        fetched_entry_list: list[dict] = []
-        if not self.is_debug:
-            logger.info("Fetch from misskey API -> start")
-            fetched_entry_list = self.misskey.notes_with_reactions(limit=100, last_since_id=last_since_id)
-            logger.info("Fetch from misskey API -> done")
-
-            if len(fetched_entry_list) > 0:
-                logger.info("Saving Cache -> start")
-                date_str = datetime.now().strftime("%Y%m%d%H%M%S")  # YYYYMMDDhhmmss
-                cache_filename = f"{date_str}_notes_with_reactions.json"
-                save_path = self.cache_path / cache_filename
-                save_path.write_bytes(orjson.dumps({"result": fetched_entry_list}, option=orjson.OPT_INDENT_2))
-                logger.info(f"Saved for {str(save_path)}.")
-                logger.info("Saving Cache -> done")
-        else:
-            logger.info("Fetch from cache file -> start")
-            load_paths: list[Path] = [p for p in self.cache_path.glob("*notes_with_reactions.json*")]
-            if len(load_paths) == 0:
-                raise ValueError("Cache file is not exist.")
-            load_path: Path = load_paths[-1]
-            fetched_entry_list: list[dict] = orjson.loads(load_path.read_bytes()).get("result")
-            logger.info(f"Loaded from {str(load_path)}.")
-            logger.info("Fetch from cache file -> done")
-        fetched_entry_list.reverse()
+    @staticmethod
+    def get_account_list(config_dict: dict) -> list[dict]:
+        """設定からクロール対象のアカウントのリストを取得する
+
+        "accounts" があればそのリストを、なければ "instance" と "token" の組1つを返す
+        """
+        misskey_dict = config_dict["misskey"]
+        if "accounts" in misskey_dict:
+            return misskey_dict["accounts"]
+        return [{"instance": misskey_dict["instance"], "token": misskey_dict["token"]}]
+
+    @classmethod
+    def create_list(cls, config_path: Path) -> list[Self]:
+        """設定に記載されたアカウントごとに Fetcher を生成する"""
+        config_dict = orjson.loads(config_path.read_bytes())
+        account_num = len(cls.get_account_list(config_dict))
+        return [cls(config_path, account_index=i) for i in range(account_num)]
+
+    async def get_account_name(self) -> str:
+        """@username@instance 形式のアカウント名を返す"""
+        user_dict = await self.misskey.i()
+        self.account_name = f"@{user_dict['username']}@{self.misskey.instance_name}"
+        return self.account_name
+
+    def _save_cache(self, fetched_entry_list: list[dict], page_index: int) -> None:
+        logger.info("Saving Cache -> start")
+        date_str = datetime.now().strftime("%Y%m%d%H%M%S")  # YYYYMMDDhhmmss
+        cache_filename = f"{date_str}_{self.account_index}_{page_index:04}_notes_with_reactions.json"
+        save_path = self.cache_path / cache_filename
+        save_path.write_bytes(orjson.dumps({"result": fetched_entry_list}, option=orjson.OPT_INDENT_2))
+        logger.info(f"Saved for {str(save_path)}.")
+        logger.info("Saving Cache -> done")
+
+    def _load_cache(self) -> list[dict]:
+        logger.info("Fetch from cache file -> start")
+        load_paths: list[Path] = [p for p in self.cache_path.glob("*notes_with_reactions.json*")]
+        if len(load_paths) == 0:
+            raise ValueError("Cache file is not exist.")
+        load_path: Path = load_paths[-1]
+        fetched_entry_list: list[dict] = orjson.loads(load_path.read_bytes()).get("result")
+        logger.info(f"Loaded from {str(load_path)}.")
+        logger.info("Fetch from cache file -> done")
+        return fetched_entry_list
+
+    async def fetch_entry_pages(self, last_since_id: str = "", is_backfill: bool = False) -> AsyncIterator[list[dict]]:
+        """リアクションのエントリをページ単位で取得するジェネレータ
+
+        last_since_id が指定されていれば sinceId をたどって新しい方向へ、
+        指定されていない(初回実行)か is_backfill が指定されていれば
+        untilId をたどって最新から最古の方向へ、取得結果が空になるかカーソルが進まなくなるまでページングする
+
+        Args:
+            last_since_id (str): 前回取得した最後のリアクションID
+            is_backfill (bool): True なら last_since_id を無視してリアクション履歴全体をさかのぼる
+
+        Yields:
+            list[dict]: 1ページ分のリアクションエントリ
+        """
+        if self.is_debug:
+            yield self._load_cache()
+            return
+
+        is_forward = last_since_id != "" and not is_backfill
+        cursor_id = last_since_id if is_forward else ""
+        page_index = 0
+        while True:
+            logger.info(f"Fetch from misskey API (page {page_index}) -> start")
+            if is_forward:
+                fetched_entry_list = await self.misskey.notes_with_reactions(
+                    limit=self.page_limit, last_since_id=cursor_id
+                )
+            else:
+                fetched_entry_list = await self.misskey.notes_with_reactions(
+                    limit=self.page_limit, last_until_id=cursor_id
+                )
+            logger.info(f"Fetch from misskey API (page {page_index}) -> done")
+            if len(fetched_entry_list) == 0:
+                break
+
+            self._save_cache(fetched_entry_list, page_index)
+            yield fetched_entry_list
+
+            # 次ページのカーソル：新しい方向なら最も新しいID、さかのぼる方向なら最も古いID
+            # サーバは末尾より前でも page_limit 未満のページを返すことがあるため、件数では終わりを判定しない
+            reaction_id_list = [entry["id"] for entry in fetched_entry_list]
+            next_cursor_id = max_id(reaction_id_list) if is_forward else min_id(reaction_id_list)
+            if next_cursor_id == cursor_id:
+                break
+            cursor_id = next_cursor_id
+            page_index += 1
+
+    async def plan_backfill_windows(self, account: str) -> list[BackfillWindow]:
+        """リアクション履歴を時間窓に分割する
+
+        最新のリアクションの日時からアカウントの作成日時までを window_num 個の等しい長さの窓に分け、
+        境界に合成 ID を使う、窓は新しい順に並べる
+        ID の形式が判定できない場合は境界のない1つの窓を返し、リアクションがない場合は空リストを返す
+
+        Args:
+            account (str): アカウント名、時間窓のキーに使う
+
+        Returns:
+            list[BackfillWindow]: 未完了の時間窓のリスト
+        """
+        newest_entry_list = await self.misskey.notes_with_reactions(limit=1)
+        if len(newest_entry_list) == 0:
+            return []
+        newest_id = newest_entry_list[0]["id"]
+        now_date = datetime.now().isoformat()
+        try:
+            id_format = detect_format(newest_id)
+        except ValueError:
+            logger.warning(f"{account} : Unknown reaction id format, backfill in a single time window.")
+            return [BackfillWindow(account, "", "", False, now_date)]
 
+        user_dict = await self.misskey.i()
+        until_ms = decode_time(newest_id, id_format) + 1
+        since_ms = min(to_epoch_ms(user_dict["createdAt"]), until_ms) - 1
+        window_num = max(self.window_num, 1)
+        boundary_list = [since_ms + (until_ms - since_ms) * i // window_num for i in range(window_num + 1)]
+        boundary_list[-1] = until_ms
+
+        boundary_id_list = encode_boundary_list(boundary_list, id_format)
+
+        window_list = []
+        for since_id, until_id in zip(boundary_id_list, boundary_id_list[1:]):
+            if since_id == until_id:
+                continue
+            window_list.append(BackfillWindow(account, since_id, until_id, False, now_date))
+        window_list.reverse()
+        return window_list
+
+    async def fetch_window_entry_pages(self, window_list: list[BackfillWindow], output_queue: asyncio.Queue) -> None:
+        """時間窓ごとのリアクションのエントリを並行に取得し、窓の順にページ単位で output_queue に入れる
+
+        窓の中は sinceId を窓の下端に固定して untilId を新しい方から古い方へたどり、
+        取得結果が空になるかカーソルが進まなくなったら窓の最後とする
+        反映済みのカーソルがある窓は、カーソルより古い方から取得を再開する
+        window_workers 個の窓を同時に取得し、API の呼び出しはレートリミッタで制限される
+        先頭以外の窓は高々 window_buffer_size ページを先読みして待つ
+        窓は取得を始めた順にワーカーを得るため、先頭の窓の取得が後ろの窓に妨げられることはない
+
+        窓を取得するタスクはこのコルーチンの中で完結し、呼び出し側のタスクがキャンセルされると
+        すべて取り消されてから戻る
+        ジェネレータにしないのは、TaskGroup の中で yield すると途中で閉じたときに
+        GeneratorExit が例外グループとして送出され、取得タスクが残るため
+
+        Args:
+            window_list (list[BackfillWindow]): 取得する時間窓のリスト
+            output_queue (asyncio.Queue): (1ページ分のエントリ, 時間窓のキー, 窓の最後のページか) を入れるキュー
+                                          空の窓は空のページを1つ入れる
+        """
+        semaphore = asyncio.Semaphore(max(self.window_workers, 1))
+        queue_list: list[asyncio.Queue] = [asyncio.Queue(maxsize=max(self.window_buffer_size, 1)) for _ in window_list]
+        page_index = 0
+
+        async def fetch_window(window: BackfillWindow, queue: asyncio.Queue) -> None:
+            nonlocal page_index
+            async with semaphore:
+                cursor_id = window.cursor_id or window.until_id
+                while True:
+                    fetched_entry_list = await self.misskey.notes_with_reactions(
+                        limit=self.page_limit, last_since_id=window.since_id, last_until_id=cursor_id
+                    )
+                    if not fetched_entry_list:
+                        await queue.put(([], True))
+                        return
+                    self._save_cache(fetched_entry_list, page_index)
+                    page_index += 1
+                    # 窓の途中でも page_limit 未満のページが返ることがあるため、件数では窓の終わりを判定しない
+                    next_cursor_id = min_id(entry["id"] for entry in fetched_entry_list)
+                    is_done = next_cursor_id == cursor_id
+                    await queue.put((fetched_entry_list, is_done))
+                    if is_done:
+                        return
+                    cursor_id = next_cursor_id
+
+        logger.info(f"Fetch {len(window_list)} time window(s) from misskey API -> start")
+        async with asyncio.TaskGroup() as task_group:
+            for window, queue in zip(window_list, queue_list):
+                task_group.create_task(fetch_window(window, queue))
+            for window, queue in zip(window_list, queue_list):
+                while True:
+                    fetched_entry_list, is_done = await queue.get()
+                    await output_queue.put((fetched_entry_list, window.window_key, is_done))
+                    if is_done:
+                        break
+        logger.info(f"Fetch {len(window_list)} time window(s) from misskey API -> done")
+
+    def create_fetched_info_list(self, fetched_entry_list: list[dict]) -> list[FetchedInfo]:
         logger.info("Create FetchedInfo -> start")
         fetched_info_list = []
-        for entry in fetched_entry_list:
+        for entry in reversed(fetched_entry_list):
             try:
-                fetched_info = FetchedInfo.create(entry, self.misskey.instance_name)
+                fetched_info = FetchedInfo.create(entry, self.misskey.instance_name, self.account_name)
             except Exception as e:
                 logger.error(e)
                 continue
             fetched_info_list.append(fetched_info)
         logger.info("Create FetchedInfo -> done")
-        logger.info("Fetcher fetch -> done")
         return fetched_info_list
 
+    async def fetch_pages(
+        self, last_since_id: str = "", is_backfill: bool = False
+    ) -> AsyncIterator[list[FetchedInfo]]:
+        """ページ単位で FetchedInfo のリストを返すジェネレータ
+
+        ページングの方向は fetch_entry_pages を参照
+        1ページずつ取得・解析して返すため、取得件数によらずメモリ使用量は一定
+
+        Args:
+            last_since_id (str): 前回取得した最後のリアクションID
+            is_backfill (bool): True ならリアクション履歴全体を最新から最古の方向にさかのぼる
+
+        Yields:
+            list[FetchedInfo]: 1ページ分の FetchedInfo のリスト
+        """
+        logger.info("Fetcher fetch -> start")
+        async for fetched_entry_list in self.fetch_entry_pages(last_since_id, is_backfill):
+            yield self.create_fetched_info_list(fetched_entry_list)
+        logger.info("Fetcher fetch -> done")
+
+    async def fetch(self, last_since_id: str = "", is_backfill: bool = False) -> list[FetchedInfo]:
+        return [fetched_info async for page in self.fetch_pages(last_since_id, is_backfill) for fetched_info in page]
+
+    async def aclose(self) -> None:
+        await self.misskey.aclose()
+
 
 if __name__ == "__main__":
     import logging.config
@@ -77,7 +287,7 @@ if __name__ == "__main__":
     cache_path = Path("./cache/")
 
     fetcher = Fetcher(config_path, is_debug=True)
-    response = fetcher.fetch()
+    response = asyncio.run(fetcher.fetch())
     (cache_path / "notes_with_reactions.json").write_bytes(
         orjson.dumps({"result": response}, option=orjson.OPT_INDENT_2)
     )
@@ -0,0 +1,123 @@
+from collections import Counter
+from collections.abc import Hashable, Iterable
+
+from misskey_crawler.crawler.valueobject.fetched_info import FetchedInfo
+from misskey_crawler.db.model import Media, Note, Reaction, User
+
+
+class RecordStaging:
+    """DB に反映する前のレコードを、モデルごとの自然キーをキーとする辞書に集める
+
+    キーは各モデルの __eq__ と同じく、Reaction は (account, note_id)、Note は note_id、
+    User は user_id、Media は (media_id, note_id) とする
+    同じキーのレコードは後から追加したもので上書きし、並びは最初に追加した順を保つ
+    重複の判定は辞書の参照のみで、レコード数に対して線形の時間で集められる
+    add_counter には追加したレコード数を、merge_counter には上書きしたレコード数をモデルの種類ごとに数える
+    """
+
+    reaction_dict: dict[Hashable, Reaction]
+    note_dict: dict[Hashable, Note]
+    user_dict: dict[Hashable, User]
+    media_dict: dict[Hashable, Media]
+    add_counter: Counter[str]
+    merge_counter: Counter[str]
+
+    def __init__(self) -> None:
+        self.reaction_dict = {}
+        self.note_dict = {}
+        self.user_dict = {}
+        self.media_dict = {}
+        self.add_counter = Counter()
+        self.merge_counter = Counter()
+
+    def __len__(self) -> int:
+        return len(self.reaction_dict) + len(self.note_dict) + len(self.user_dict) + len(self.media_dict)
+
+    def _merge(self, record_dict: dict, key: Hashable, record, kind: str) -> None:
+        if key in record_dict:
+            self.merge_counter[kind] += 1
+        record_dict[key] = record
+        self.add_counter[kind] += 1
+
+    def add(self, fetched_info: FetchedInfo) -> None:
+        """FetchedInfo のレコードを追加する、メディアのないノートへのリアクションはメディアを除いて追加する"""
+        for reaction, note, user, media in fetched_info.get_records():
+            self._merge(self.reaction_dict, (reaction.account, reaction.note_id), reaction, "reaction")
+            self._merge(self.note_dict, note.note_id, note, "note")
+            self._merge(self.user_dict, user.user_id, user, "user")
+            if media is not None:
+                self._merge(self.media_dict, (media.media_id, media.note_id), media, "media")
+
+    def add_list(self, fetched_list: Iterable[FetchedInfo]) -> None:
+        for fetched_info in fetched_list:
+            self.add(fetched_info)
+
+    def to_lists(self) -> tuple[list[Reaction], list[Note], list[User], list[Media]]:
+        """集めたレコードをモデルごとのリストにして返す"""
+        return (
+            list(self.reaction_dict.values()),
+            list(self.note_dict.values()),
+            list(self.user_dict.values()),
+            list(self.media_dict.values()),
+        )
+
+    def clear(self) -> None:
+        self.reaction_dict.clear()
+        self.note_dict.clear()
+        self.user_dict.clear()
+        self.media_dict.clear()
+        self.add_counter.clear()
+        self.merge_counter.clear()
+
+
+if __name__ == "__main__":
+    # リストの所属判定による重複排除と、RecordStaging の処理時間を比べる
+    import sys
+    import time
+
+    def make_fetched_list(record_num: int, user_num: int = 100) -> list[FetchedInfo]:
+        """record_num 件のリアクションを、user_num 人のユーザのノートに2件ずつのメディアをつけて作る"""
+        fetched_list = []
+        for i in range(record_num):
+            note_id = f"note_{i:08}"
+            reaction = Reaction("@user@misskey.io", note_id, f"reaction_{i:08}", "👍", 0, 0)
+            note = Note(note_id, f"user_{i % user_num:04}", "", "", 0, 0)
+            user = User(f"user_{i % user_num:04}", "name", "username", "", False, False, 0)
+            media_list = [Media(note_id, f"media_{i:08}_{j}", "", "image/png", "", 0, "", 0, 0) for j in range(2)]
+            fetched_list.append(FetchedInfo(reaction, note, user, media_list))
+        return fetched_list
+
+    def split_by_list(fetched_list: list[FetchedInfo]) -> tuple:
+        reaction_list, note_list, user_list, media_list = [], [], [], []
+        for fetched_info in fetched_list:
+            for reaction, note, user, media in fetched_info.get_records():
+                if reaction not in reaction_list:
+                    reaction_list.append(reaction)
+                if note not in note_list:
+                    note_list.append(note)
+                if user not in user_list:
+                    user_list.append(user)
+                if media not in media_list:
+                    media_list.append(media)
+        return reaction_list, note_list, user_list, media_list
+
+    def split_by_staging(fetched_list: list[FetchedInfo]) -> tuple:
+        staging = RecordStaging()
+        staging.add_list(fetched_list)
+        return staging.to_lists()
+
+    size_list = [int(arg) for arg in sys.argv[1:]] or [500, 1_000, 2_000, 10_000, 100_000, 200_000]
+    list_limit = 2_000
+    for size in size_list:
+        fetched_list = make_fetched_list(size)
+        start_time = time.perf_counter()
+        staged = split_by_staging(fetched_list)
+        staging_sec = time.perf_counter() - start_time
+        line = f"{size:>8} records : staging {staging_sec:8.3f} [sec]"
+        if size <= list_limit:
+            start_time = time.perf_counter()
+            listed = split_by_list(fetched_list)
+            list_sec = time.perf_counter() - start_time
+            assert [len(records) for records in listed] == [len(records) for records in staged]
+            line += f", list {list_sec:8.3f} [sec]"
+        print(line)
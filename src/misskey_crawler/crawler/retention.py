@@ -0,0 +1,213 @@
+from datetime import datetime
+from logging import INFO, getLogger
+from pathlib import Path
+
+from misskey_crawler.crawler.downloader import Downloader
+from misskey_crawler.crawler.valueobject.crawled_page import CrawledPage
+from misskey_crawler.db.media_db import MediaDB
+from misskey_crawler.db.media_file_db import MediaFileDB
+from misskey_crawler.db.model import Media, MediaFile
+from misskey_crawler.util import JST, to_epoch_ms
+
+logger = getLogger(__name__)
+logger.setLevel(INFO)
+
+
+class RetentionPolicy:
+    """save_num と save_bytes に従って保存済みメディアを古い順に削除する
+
+    保存したファイルは MediaFile テーブルに記録し、リアクション日時が古いものから削除する
+    件数と合計サイズは集計クエリで、削除対象は created_at のインデックスで求めるので、
+    ディレクトリを走査することはない
+    save_num、save_bytes が0以下なら、その上限は設けない
+    save_bytes はノートごとのファイルサイズの合計で判定する
+    ストアで重複排除している場合は実際のディスク使用量より大きくなる
+    """
+
+    downloader: Downloader
+    media_file_db: MediaFileDB
+    media_db: MediaDB
+    batch_size: int = 100
+    seed_chunk_size: int = 1000
+
+    def __init__(self, downloader: Downloader, media_file_db: MediaFileDB, media_db: MediaDB) -> None:
+        self.downloader = downloader
+        self.media_file_db = media_file_db
+        self.media_db = media_db
+
+    @property
+    def save_base_path(self) -> Path:
+        return self.downloader.save_base_path
+
+    @property
+    def is_enabled(self) -> bool:
+        return self.downloader.save_num > 0 or self.downloader.save_bytes > 0
+
+    @staticmethod
+    def get_created_at_dict(page: CrawledPage) -> dict[str, int]:
+        """ノートIDごとの、メディアを含むノートへのリアクション日時"""
+        return {reaction.note_id: reaction.created_at for reaction in page.reaction_list}
+
+    def select_downloadable(self, page: CrawledPage) -> list[Media]:
+        """ページのメディアのうち、ダウンロードしてもすぐに削除されないものを返す
+
+        上限に達していて、リアクション日時が残っている最も古いファイルより古いメディアは、
+        保存した直後に evict で削除されるので取得しない
+        バックフィルで古いリアクションを遡る場合に、削除するだけのダウンロードを省く
+        """
+        if not self.is_enabled or not page.media_list:
+            return page.media_list
+        count, total = self.media_file_db.select_total()
+        oldest_list = self.media_file_db.select_oldest(1)
+        if not oldest_list:
+            return page.media_list
+        horizon = oldest_list[0].created_at
+        created_at_dict = self.get_created_at_dict(page)
+        media_list: list[Media] = []
+        for media in page.media_list:
+            created_at = created_at_dict.get(media.note_id, media.created_at)
+            if created_at < horizon and self.is_over(count + 1, total + max(media.size, 0)):
+                continue
+            media_list.append(media)
+        if skipped_num := len(page.media_list) - len(media_list):
+            logger.info(f"Retention : {skipped_num} media older than the eviction horizon skipped.")
+        return media_list
+
+    def make_record(self, media: Media, created_at: int, registered_at: int) -> MediaFile | None:
+        """media の保存済みのファイルのレコードを作る、ファイルがなければ None を返す"""
+        filepath = self.save_base_path / media.get_filename()
+        if not filepath.exists():
+            return None
+        store_path = ""
+        if self.downloader.content_addressed and media.md5:
+            store_path = self.downloader.get_store_path(media).relative_to(self.save_base_path).as_posix()
+        return MediaFile(
+            filepath.relative_to(self.save_base_path).as_posix(),
+            media.note_id,
+            media.media_id,
+            media.md5,
+            filepath.stat().st_size,
+            store_path,
+            created_at,
+            registered_at,
+        )
+
+    def register(self, page: CrawledPage) -> list[MediaFile]:
+        """ページのメディアのうち保存済みのファイルを記録する
+
+        Returns:
+            list[MediaFile]: 記録したレコード
+        """
+        created_at_dict = self.get_created_at_dict(page)
+        registered_at = to_epoch_ms(datetime.now(JST))
+        record_list: list[MediaFile] = []
+        for media in page.media_list:
+            record = self.make_record(media, created_at_dict.get(media.note_id, media.created_at), registered_at)
+            if record is not None:
+                record_list.append(record)
+        if record_list:
+            self.media_file_db.upsert(record_list)
+        return record_list
+
+    def seed(self) -> int:
+        """MediaFile が空なら、MediaFile に記録する前に保存したファイルを Media のレコードから記録する
+
+        既存のファイルも保存期間の上限の対象にするため、上限があるときにだけ行う
+        created_at はノートへの最も新しいリアクション日時とし、リアクションがなければメディアの日時とする
+        ファイル名を決められないメディアは保存されていないので記録しない
+
+        Returns:
+            int: 記録したレコード数
+        """
+        if not self.is_enabled or self.media_file_db.select_total()[0] > 0:
+            return 0
+        registered_at = to_epoch_ms(datetime.now(JST))
+        seed_num = 0
+        after_id = 0
+        while row_list := self.media_db.select_with_reaction_created_at(after_id, self.seed_chunk_size):
+            after_id = row_list[-1][0].id
+            record_list: list[MediaFile] = []
+            for media, created_at in row_list:
+                try:
+                    record = self.make_record(
+                        media, media.created_at if created_at is None else created_at, registered_at
+                    )
+                except ValueError:
+                    continue
+                if record is not None:
+                    record_list.append(record)
+            if record_list:
+                self.media_file_db.upsert(record_list)
+                seed_num += len(record_list)
+        if seed_num:
+            logger.info(f"Retention : {seed_num} saved media file(s) recorded.")
+        return seed_num
+
+    def is_over(self, count: int, total: int) -> bool:
+        save_num = self.downloader.save_num
+        save_bytes = self.downloader.save_bytes
+        return (save_num > 0 and count > save_num) or (save_bytes > 0 and total > save_bytes)
+
+    def remove(self, record_list: list[MediaFile]) -> None:
+        """ファイルとレコードを削除する、どのレコードからも参照されなくなったストア上のファイルも削除する
+
+        削除したファイルの記録済みのチェックサムも破棄する
+        """
+        checksum_cache = self.downloader.checksum_cache
+        for record in record_list:
+            filepath = self.save_base_path / record.path
+            filepath.unlink(missing_ok=True)
+            checksum_cache.discard(filepath)
+        self.media_file_db.delete(record_list)
+        for store_path in {record.store_path for record in record_list if record.store_path}:
+            if self.media_file_db.count_by_store_path(store_path) == 0:
+                (self.save_base_path / store_path).unlink(missing_ok=True)
+                checksum_cache.discard(self.save_base_path / store_path)
+
+    def evict(self) -> list[MediaFile]:
+        """上限を超えている分だけ古い順に削除する
+
+        Returns:
+            list[MediaFile]: 削除したレコード
+        """
+        count, total = self.media_file_db.select_total()
+        evicted_list: list[MediaFile] = []
+        while self.is_over(count, total):
+            oldest_list = self.media_file_db.select_oldest(self.batch_size)
+            if not oldest_list:
+                break
+            record_list: list[MediaFile] = []
+            for record in oldest_list:
+                if not self.is_over(count, total):
+                    break
+                record_list.append(record)
+                count -= 1
+                total -= record.size
+            self.remove(record_list)
+            evicted_list.extend(record_list)
+        return evicted_list
+
+    def apply(self, page: CrawledPage) -> list[MediaFile]:
+        """ダウンロードが済んだページのファイルを記録し、上限を超えていれば古い順に削除する
+
+        Returns:
+            list[MediaFile]: 削除したレコード
+        """
+        if not self.is_enabled:
+            return []
+        self.register(page)
+        evicted_list = self.evict()
+        if evicted_list:
+            logger.info(f"Retention : {len(evicted_list)} media file(s) evicted.")
+        return evicted_list
+
+
+if __name__ == "__main__":
+    import logging.config
+
+    logging.config.fileConfig("./log/logging.ini", disable_existing_loggers=False)
+    config_path = Path("./config/config.json")
+    retention_policy = RetentionPolicy(Downloader(config_path), MediaFileDB(), MediaDB())
+    count, total = retention_policy.media_file_db.select_total()
+    print(f"{count} file(s), {total} bytes.")
+    retention_policy.evict()
@@ -0,0 +1,23 @@
+from dataclasses import dataclass
+
+from misskey_crawler.db.model import Media, Note, Reaction, User
+
+
+@dataclass(frozen=True)
+class CrawledPage:
+    """パイプラインのステージ間で受け渡す1ページ分のレコード
+
+    account はページを取得したアカウント名、last_reaction_id はページ内で最新のリアクションID
+    時間窓に分けたバックフィルでは window_key にページを含む時間窓のキーを、
+    is_window_done に窓の最後のページかを、window_cursor_id にページ内で最も古いリアクションIDを入れる
+    """
+
+    account: str
+    last_reaction_id: str
+    reaction_list: list[Reaction]
+    note_list: list[Note]
+    user_list: list[User]
+    media_list: list[Media]
+    window_key: str = ""
+    is_window_done: bool = False
+    window_cursor_id: str = ""
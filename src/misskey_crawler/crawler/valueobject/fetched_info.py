@@ -1,13 +1,109 @@
 import pprint
+from collections.abc import Callable
 from dataclasses import dataclass
 from datetime import datetime
+from operator import itemgetter
 from pathlib import Path
-from typing import Self
+from typing import Any, Self
 
 import orjson
 
 from misskey_crawler.db.model import Media, Note, Reaction, User
-from misskey_crawler.util import find_values, to_jst
+from misskey_crawler.util import JST, find_values, to_epoch_ms
+
+
+def normalize_date_at(date_at_str: str) -> int:
+    return to_epoch_ms(datetime.fromisoformat(date_at_str))
+
+
+# エントリのフィールドのスキーマ、{レコードのフィールド名: "." 区切りのキーのパス、または (パス, 変換関数)}
+REACTION_SCHEMA: dict[str, str | tuple[str, Callable]] = {
+    "reaction_id": "id",
+    "type": "type",
+    "created_at": ("createdAt", normalize_date_at),
+}
+NOTE_SCHEMA: dict[str, str | tuple[str, Callable]] = {
+    "note_id": "note.id",
+    "user_id": "note.userId",
+    "text": "note.text",
+    "created_at": ("note.createdAt", normalize_date_at),
+}
+USER_SCHEMA: dict[str, str | tuple[str, Callable]] = {
+    "user_id": "note.userId",
+    "name": "note.user.name",
+    "username": "note.user.username",
+    "avatar_url": "note.user.avatarUrl",
+    "is_bot": "note.user.isBot",
+    "is_cat": "note.user.isCat",
+}
+# note.files の要素からのパス
+MEDIA_SCHEMA: dict[str, str | tuple[str, Callable]] = {
+    "media_id": "id",
+    "name": "name",
+    "type": "type",
+    "md5": "md5",
+    "size": "size",
+    "url": "url",
+    "created_at": ("createdAt", normalize_date_at),
+}
+
+
+def compile_path(path: str) -> Callable[[Any], Any]:
+    """キーを "." でつないだパスを、辞書を順にたどるアクセサにする
+
+    キーがない場合や途中の値が辞書でない場合は KeyError か TypeError を送出する
+    """
+    getter_list = [itemgetter(key) for key in path.split(".")]
+    if len(getter_list) == 1:
+        return getter_list[0]
+
+    def get(obj: Any) -> Any:
+        for getter in getter_list:
+            obj = getter(obj)
+        return obj
+
+    return get
+
+
+def compile_schema(schema: dict[str, str | tuple[str, Callable]]) -> Callable[[dict], dict]:
+    """スキーマを、エントリからレコードのフィールドの辞書を作るパーサにする
+
+    同じ辞書から読むキーは1つの itemgetter でまとめて読む
+    """
+    group_dict: dict[str, list[tuple[str, str, Callable | None]]] = {}
+    for name, field in schema.items():
+        path, convert = field if isinstance(field, tuple) else (field, None)
+        parent_path, _, key = path.rpartition(".")
+        group_dict.setdefault(parent_path, []).append((name, key, convert))
+
+    getter_list = []
+    name_list = []
+    convert_list = []
+    for parent_path, item_list in group_dict.items():
+        parent_getter = compile_path(parent_path) if parent_path else None
+        key_list = [key for _, key, _ in item_list]
+        # 1つのキーの itemgetter は値をタプルで返さないため、キーを重ねてタプルで返させる
+        key_getter = itemgetter(*key_list) if len(key_list) > 1 else itemgetter(key_list[0], key_list[0])
+        getter_list.append((parent_getter, key_getter, len(key_list)))
+        name_list.extend(name for name, _, _ in item_list)
+        convert_list.extend((name, convert) for name, _, convert in item_list if convert is not None)
+
+    def parse(obj: dict) -> dict:
+        value_list = []
+        for parent_getter, key_getter, key_num in getter_list:
+            value_list.extend(key_getter(obj if parent_getter is None else parent_getter(obj))[:key_num])
+        field_dict = dict(zip(name_list, value_list))
+        for name, convert in convert_list:
+            field_dict[name] = convert(field_dict[name])
+        return field_dict
+
+    return parse
+
+
+parse_reaction = compile_schema(REACTION_SCHEMA)
+parse_note = compile_schema(NOTE_SCHEMA)
+parse_user = compile_schema(USER_SCHEMA)
+parse_media = compile_schema(MEDIA_SCHEMA)
 
 
 @dataclass(frozen=True)
@@ -17,26 +113,52 @@ class FetchedInfo:
     user: User
     media_list: list[Media]
 
-    def get_records(self) -> list[tuple[Reaction, Note, User, Media]]:
+    def get_records(self) -> list[tuple[Reaction, Note, User, Media | None]]:
+        """(リアクション, ノート, ユーザ, メディア) の組をメディアごとに返す
+
+        メディアのないノートへのリアクションも記録するため、メディアを None とした組を1つ返す
+        """
+        if not self.media_list:
+            return [(self.reaction, self.note, self.user, None)]
         return [(self.reaction, self.note, self.user, media) for media in self.media_list]
 
     @classmethod
-    def create(cls, fetched_dict: dict, instance_name: str = "") -> Self:
-        def normalize_date_at(date_at_str: str) -> str:
-            result = to_jst(datetime.fromisoformat(date_at_str)).isoformat()
-            if result.endswith("+00:00"):
-                result = result[:-6]
-            return result
-
-        registered_at = datetime.now().isoformat()
+    def create(cls, fetched_dict: dict, instance_name: str = "", account: str = "") -> Self:
+        """エントリからレコードを作る、account はリアクションしたアカウント名
+
+        コンパイル済みのスキーマで固定のキーを直接読む
+        キーがない、値が null や辞書でないなど、直接読めないエントリは create_by_find_values で作り直し、
+        そちらと同じ結果または例外を返す
+        """
+        try:
+            registered_at = to_epoch_ms(datetime.now(JST))
+            note_field_dict = parse_note(fetched_dict)
+            note_id = note_field_dict["note_id"]
+            media_list = [
+                Media(note_id=note_id, registered_at=registered_at, **parse_media(media_dict))
+                for media_dict in fetched_dict["note"].get("files", [])
+            ]
+            reaction = Reaction(
+                account=account, note_id=note_id, registered_at=registered_at, **parse_reaction(fetched_dict)
+            )
+            note = Note(url=f"https://{instance_name}/notes/{note_id}", registered_at=registered_at, **note_field_dict)
+            user_field_dict = parse_user(fetched_dict)
+            user_field_dict["name"] = user_field_dict["name"] or user_field_dict["username"]
+            user = User(registered_at=registered_at, **user_field_dict)
+        except (KeyError, TypeError, AttributeError, ValueError):
+            return cls.create_by_find_values(fetched_dict, instance_name, account)
+        return FetchedInfo(reaction, note, user, media_list)
+
+    @classmethod
+    def create_by_find_values(cls, fetched_dict: dict, instance_name: str = "", account: str = "") -> Self:
+        """find_values でキーを探してエントリからレコードを作る"""
+        registered_at = to_epoch_ms(datetime.now(JST))
         note_dict = find_values(fetched_dict, "note", True, [""])
         note_id = find_values(note_dict, "id", True, [""])
 
-        media_dicts = []
-        try:
-            media_dicts = find_values(note_dict, "files", True, [""])
-        except ValueError:
-            raise ValueError("Note entry has no media.")
+        # テキストのみのノートには files がないことがあるため、メディアのないノートとして扱う
+        files_list = find_values(note_dict, "files", False, [""])
+        media_dicts = files_list[0] if files_list else []
 
         media_list = []
         for media_dict in media_dicts:
@@ -64,6 +186,7 @@ class FetchedInfo:
         reaction_type = find_values(fetched_dict, "type", True, [""])
         reaction_created_at = normalize_date_at(find_values(fetched_dict, "createdAt", True, [""]))
         reaction = Reaction.create({
+            "account": account,
             "note_id": note_id,
             "reaction_id": reaction_id,
             "type": reaction_type,
@@ -114,3 +237,43 @@ if __name__ == "__main__":
     for entry in fetched_entry_list[:3]:
         fetched_info = FetchedInfo.create(entry)
         pprint.pprint(fetched_info)
+
+    # find_values とコンパイル済みのスキーマで、1エントリあたりの処理時間を比べる
+    import time
+
+    def read_by_find_values(entry: dict) -> None:
+        note_dict = find_values(entry, "note", True, [""])
+        user_dict = find_values(note_dict, "user", True, [""])
+        for key in ["id", "type"]:
+            find_values(entry, key, True, [""])
+        for key in ["id", "userId", "text"]:
+            find_values(note_dict, key, True, [""])
+        for key in ["name", "username", "avatarUrl", "isBot", "isCat"]:
+            find_values(user_dict, key, True, [""])
+        normalize_date_at(find_values(entry, "createdAt", True, [""]))
+        normalize_date_at(find_values(note_dict, "createdAt", True, [""]))
+        for media_dict in find_values(note_dict, "files", True, [""]):
+            for key in ["id", "name", "type", "md5", "size", "url"]:
+                find_values(media_dict, key, True, [""])
+            normalize_date_at(find_values(media_dict, "createdAt", True, [""]))
+
+    def read_by_schema(entry: dict) -> None:
+        parse_reaction(entry)
+        parse_note(entry)
+        parse_user(entry)
+        for media_dict in entry["note"].get("files", []):
+            parse_media(media_dict)
+
+    bench_entry_list = [entry for entry in fetched_entry_list if "files" in entry.get("note", {})]
+    bench_entry_list = (bench_entry_list * (10_000 // max(len(bench_entry_list), 1) + 1))[:10_000]
+    for title, func in [
+        ("read fields, find_values", read_by_find_values),
+        ("read fields, schema", read_by_schema),
+        ("create, find_values", FetchedInfo.create_by_find_values),
+        ("create, schema", FetchedInfo.create),
+    ]:
+        start_time = time.perf_counter()
+        for entry in bench_entry_list:
+            func(entry)
+        elapsed_time = time.perf_counter() - start_time
+        print(f"{title:<25} : {elapsed_time / len(bench_entry_list) * 1_000_000:8.2f} [us/entry]")
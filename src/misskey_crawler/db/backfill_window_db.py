@@ -0,0 +1,88 @@
+from datetime import datetime
+
+from sqlalchemy import delete, update
+from sqlalchemy.orm import sessionmaker
+
+from misskey_crawler.db.base import Base
+from misskey_crawler.db.model import BackfillWindow
+from misskey_crawler.util.misskey_id import sort_key
+
+
+class BackfillWindowDB(Base):
+    def __init__(self, db_path: str = "mc_db.db"):
+        super().__init__(db_path)
+
+    def select(self) -> list[BackfillWindow]:
+        Session = sessionmaker(bind=self.engine, autoflush=False)
+        session = Session()
+        result = session.query(BackfillWindow).all()
+        session.close()
+        return result
+
+    def select_by_account(self, account: str) -> list[BackfillWindow]:
+        """アカウントの時間窓を新しい順に返す"""
+        Session = sessionmaker(bind=self.engine, autoflush=False)
+        session = Session()
+        result = session.query(BackfillWindow).filter(BackfillWindow.account == account).all()
+        session.close()
+        return sorted(result, key=lambda r: sort_key(r.until_id), reverse=True)
+
+    def select_unfinished(self, account: str) -> list[BackfillWindow]:
+        """アカウントの未完了の時間窓を新しい順に返す"""
+        return [r for r in self.select_by_account(account) if not r.is_done]
+
+    def advance(self, window_key: str, cursor_id: str, is_done: bool = False) -> int:
+        """時間窓の進捗を1ページ分進める
+
+        cursor_id にはページ内で最も古いリアクションIDを渡す、空のページなら空文字列を渡してカーソルを動かさない
+        Database.transaction() の中で呼ばれた場合はそのトランザクションに含める
+
+        Args:
+            window_key (str): 時間窓のキー
+            cursor_id (str): DB に反映したページ内で最も古いリアクションID
+            is_done (bool): 窓の最後のページか
+
+        Returns:
+            int: 更新したレコード数
+        """
+        value_dict = {"updated_at": datetime.now().isoformat()}
+        if cursor_id:
+            value_dict["cursor_id"] = cursor_id
+            value_dict["page_num"] = BackfillWindow.page_num + 1
+        if is_done:
+            value_dict["is_done"] = True
+        stmt = update(BackfillWindow).where(BackfillWindow.window_key == window_key).values(**value_dict)
+        with self.database.transaction() as conn:
+            return conn.execute(stmt).rowcount
+
+    def delete_by_account(self, account: str) -> int:
+        """アカウントの時間窓をすべて削除する
+
+        Returns:
+            int: 削除したレコード数
+        """
+        with self.database.transaction() as conn:
+            return conn.execute(delete(BackfillWindow).where(BackfillWindow.account == account)).rowcount
+
+    def upsert(self, record: BackfillWindow | list[BackfillWindow] | list[dict]) -> list[int]:
+        """upsert
+
+        Args:
+            record (BackfillWindow | list[BackfillWindow] | list[dict]): 投入レコード、またはレコード辞書のリスト
+
+        Returns:
+            list[int]: レコードに対応した投入結果のリスト
+                       追加したレコードは0、更新したレコードは1が入る
+        """
+        record_list: list[BackfillWindow] = []
+        match record:
+            case BackfillWindow():
+                record_list = [record]
+            case [BackfillWindow(), *rest] if all([isinstance(r, BackfillWindow) for r in rest]):
+                record_list = record
+            case [dict(), *rest] if all([isinstance(r, dict) for r in rest]):
+                record_list = [BackfillWindow.create(r) for r in record]
+            case _:
+                raise TypeError("record is invalid type.")
+
+        return self._bulk_upsert(BackfillWindow, record_list, "window_key")
@@ -1,27 +1,121 @@
+import threading
 from abc import ABCMeta, abstractmethod
+from collections.abc import Iterator
+from contextlib import contextmanager
+from operator import itemgetter
+from typing import Self
 
-from sqlalchemy import create_engine
+from sqlalchemy import Connection, create_engine, event, select, text, tuple_
+from sqlalchemy.dialects.sqlite import insert
 from sqlalchemy.pool import StaticPool
 
+from misskey_crawler.db.migration import Migrator
 from misskey_crawler.db.model import Base as ModelBase
 
 
-class Base(metaclass=ABCMeta):
-    def __init__(self, db_path: str = "mc_db.db") -> None:
+class Database:
+    """同じ DB ファイルを使う DB クラスの間で共有するエンジン
+
+    エンジンの生成とスキーマの作成は DB ファイルごとに1度だけ行う
+    既存の DB には、スキーマを作成する前に未適用のマイグレーションを適用する
+    transaction() の中で行った書き込みは、どの DB クラスからのものでも1つのトランザクションにまとめる
+    ":memory:" はエンジンごとに別の DB になるため共有しない
+
+    接続ごとに pragma_dict の PRAGMA を適用する
+    既定では WAL モードにして、クロール中でも他のプロセスから読み出せるようにし、
+    synchronous=NORMAL でコミットごとの fsync を省く
+    """
+
+    database_dict: dict[str, Self] = {}
+    database_lock: threading.Lock = threading.Lock()
+    pragma_dict: dict[str, str | int] = {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "mmap_size": 256 * 1024 * 1024,
+        "cache_size": -64 * 1024,  # 負の値は KiB 単位
+        "temp_store": "MEMORY",
+    }
+
+    def __init__(self, db_path: str = "mc_db.db", pragma_dict: dict[str, str | int] | None = None) -> None:
         self.db_path = db_path
         self.db_url = f"sqlite:///{self.db_path}"
+        self.pragma_dict = self.pragma_dict | (pragma_dict or {})
+        for name, value in self.pragma_dict.items():
+            if not name.isidentifier() or not str(value).lstrip("-").isalnum():
+                raise ValueError(f"Invalid pragma : {name} = {value}")
 
+        # ファイルの DB はスレッドごとに別の接続を使う、":memory:" は1つの接続を使い回さないと DB が消える
+        pool_kwargs = {"poolclass": StaticPool} if db_path == ":memory:" else {}
         self.engine = create_engine(
             self.db_url,
             echo=False,
-            poolclass=StaticPool,
+            **pool_kwargs,
             # pool_recycle=5,
             connect_args={
                 "timeout": 30,
                 "check_same_thread": False,
             },
         )
+        event.listen(self.engine, "connect", self.apply_pragma)
+        Migrator(self.engine).migrate()
         ModelBase.metadata.create_all(self.engine)
+        self.local = threading.local()
+
+    @classmethod
+    def get(cls, db_path: str = "mc_db.db", pragma_dict: dict[str, str | int] | None = None) -> Self:
+        """db_path の Database を返す、なければ生成する
+
+        pragma_dict は生成するときにのみ使う
+        """
+        if db_path == ":memory:":
+            return cls(db_path, pragma_dict)
+        with cls.database_lock:
+            if db_path not in cls.database_dict:
+                cls.database_dict[db_path] = cls(db_path, pragma_dict)
+            return cls.database_dict[db_path]
+
+    def apply_pragma(self, dbapi_connection, connection_record) -> None:
+        """新しい接続に PRAGMA を適用する"""
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in self.pragma_dict.items():
+                cursor.execute(f"PRAGMA {name} = {value}")
+        finally:
+            cursor.close()
+
+    def close(self) -> None:
+        """終了時に統計情報を最適化し、WAL をチェックポイントしてから接続を閉じる"""
+        with self.engine.connect() as conn:
+            conn.execute(text("PRAGMA optimize"))
+            conn.execute(text("PRAGMA wal_checkpoint(TRUNCATE)"))
+        self.engine.dispose()
+
+    @contextmanager
+    def transaction(self) -> Iterator[Connection]:
+        """ブロック内の書き込みを1つのトランザクションにまとめる
+
+        ブロックを抜けるときにコミットし、例外が発生した場合はロールバックする
+        トランザクションは呼び出したスレッドごとに持ち、入れ子にした場合は外側のものを使う
+        """
+        if (conn := getattr(self.local, "conn", None)) is not None:
+            yield conn
+            return
+        with self.engine.begin() as conn:
+            self.local.conn = conn
+            try:
+                yield conn
+            finally:
+                self.local.conn = None
+
+
+class Base(metaclass=ABCMeta):
+    chunk_size: int = 500
+
+    def __init__(self, db_path: str = "mc_db.db") -> None:
+        self.database = Database.get(db_path)
+        self.db_path = self.database.db_path
+        self.db_url = self.database.db_url
+        self.engine = self.database.engine
 
     @abstractmethod
     def select(self):
@@ -31,6 +125,52 @@ class Base(metaclass=ABCMeta):
     def upsert(self, record):
         return []
 
+    def _bulk_upsert(
+        self, model: type[ModelBase], record_list: list[ModelBase], key: str | tuple[str, ...]
+    ) -> list[int]:
+        """INSERT ... ON CONFLICT DO UPDATE で record_list をまとめて投入する
+
+        chunk_size 件ごとに、既存のキーを1回の SELECT で調べてから executemany で投入する
+        同じキーのレコードが複数あれば後のもので上書きする
+        Database.transaction() の中で呼ばれた場合はそのトランザクションに含め、コミットは呼び出し側に任せる
+
+        Args:
+            model (type[ModelBase]): 投入先のモデル
+            record_list (list[ModelBase]): 投入レコードのリスト
+            key (str | tuple[str, ...]): 競合を判定する UNIQUE 制約のカラム名、複合キーならカラム名のタプル
+
+        Returns:
+            list[int]: レコードに対応した投入結果のリスト
+                       追加したレコードは0、更新したレコードは1が入る
+        """
+        result: list[int] = []
+        row_list = [r.to_dict() for r in record_list]
+        key_name_list = [key] if isinstance(key, str) else list(key)
+        key_column_list = [getattr(model, name) for name in key_name_list]
+        if len(key_name_list) == 1:
+            key_column = key_column_list[0]
+            get_key = itemgetter(key_name_list[0])
+        else:
+            key_column = tuple_(*key_column_list)
+            get_key = itemgetter(*key_name_list)
+        stmt = insert(model)
+        update_dict = {name: stmt.excluded[name] for name in row_list[0].keys() if name not in key_name_list}
+        stmt = stmt.on_conflict_do_update(index_elements=key_name_list, set_=update_dict)
+
+        with self.database.transaction() as conn:
+            for i in range(0, len(row_list), self.chunk_size):
+                chunk = row_list[i : i + self.chunk_size]
+                key_list = [get_key(row) for row in chunk]
+                exist_key_set = {
+                    row[0] if len(key_name_list) == 1 else tuple(row)
+                    for row in conn.execute(select(*key_column_list).where(key_column.in_(key_list)))
+                }
+                for key_value in key_list:
+                    result.append(1 if key_value in exist_key_set else 0)
+                    exist_key_set.add(key_value)
+                conn.execute(stmt, chunk)
+        return result
+
 
 if __name__ == "__main__":
     pass
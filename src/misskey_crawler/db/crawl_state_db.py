@@ -0,0 +1,54 @@
+from sqlalchemy.orm import sessionmaker
+
+from misskey_crawler.db.base import Base
+from misskey_crawler.db.model import CrawlState
+
+
+class CrawlStateDB(Base):
+    def __init__(self, db_path: str = "mc_db.db"):
+        super().__init__(db_path)
+
+    def select(self) -> list[CrawlState]:
+        Session = sessionmaker(bind=self.engine, autoflush=False)
+        session = Session()
+        result = session.query(CrawlState).all()
+        session.close()
+        return result
+
+    def select_last_reaction_id(self, account: str) -> str:
+        """アカウントごとの最後に取得したリアクションIDを返す
+
+        Args:
+            account (str): アカウント名(例: "@username@misskey.io")
+
+        Returns:
+            str: 最後に取得したリアクションID、未取得なら空文字列
+        """
+        Session = sessionmaker(bind=self.engine, autoflush=False)
+        session = Session()
+        result = session.query(CrawlState).filter(CrawlState.account == account).first()
+        session.close()
+        return result.last_reaction_id if result else ""
+
+    def upsert(self, record: CrawlState | list[CrawlState] | list[dict]) -> list[int]:
+        """upsert
+
+        Args:
+            record (CrawlState | list[CrawlState] | list[dict]): 投入レコード、またはレコード辞書のリスト
+
+        Returns:
+            list[int]: レコードに対応した投入結果のリスト
+                       追加したレコードは0、更新したレコードは1が入る
+        """
+        record_list: list[CrawlState] = []
+        match record:
+            case CrawlState():
+                record_list = [record]
+            case [CrawlState(), *rest] if all([isinstance(r, CrawlState) for r in rest]):
+                record_list = record
+            case [dict(), *rest] if all([isinstance(r, dict) for r in rest]):
+                record_list = [CrawlState.create(r) for r in record]
+            case _:
+                raise TypeError("record is invalid type.")
+
+        return self._bulk_upsert(CrawlState, record_list, "account")
@@ -1,9 +1,10 @@
-from sqlalchemy import and_
+from datetime import datetime
+
+from sqlalchemy import func, select
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.orm.exc import NoResultFound
 
 from misskey_crawler.db.base import Base
-from misskey_crawler.db.model import Media
+from misskey_crawler.db.model import Media, Reaction
 
 
 class MediaDB(Base):
@@ -17,6 +18,40 @@ class MediaDB(Base):
         session.close()
         return result
 
+    def select_created_between(
+        self, since: datetime | int | None = None, until: datetime | int | None = None
+    ) -> list[Media]:
+        """created_at が since 以上 until 未満のレコードを古い順に返す、created_at のインデックスを使う"""
+        Session = sessionmaker(bind=self.engine, autoflush=False)
+        session = Session()
+        result = (
+            session.query(Media).filter(Media.created_between(since, until)).order_by(Media.created_at, Media.id).all()
+        )
+        session.close()
+        return result
+
+    def select_with_reaction_created_at(self, after_id: int = 0, limit: int = 1000) -> list[tuple[Media, int | None]]:
+        """id が after_id より大きいレコードを id 順に limit 件、ノートへの最も新しいリアクション日時とともに返す
+
+        リアクションのないノートのメディアは日時を None とする
+        返した最後のレコードの id を after_id に渡すと続きを返す
+        """
+        reaction_created_at = (
+            select(func.max(Reaction.created_at)).where(Reaction.note_id == Media.note_id).scalar_subquery()
+        )
+        Session = sessionmaker(bind=self.engine, autoflush=False)
+        session = Session()
+        result = [
+            (media, created_at)
+            for media, created_at in session
+            .query(Media, reaction_created_at)
+            .filter(Media.id > after_id)
+            .order_by(Media.id)
+            .limit(limit)
+        ]
+        session.close()
+        return result
+
     def upsert(self, record: Media | list[Media] | list[dict]) -> list[int]:
         """upsert
 
@@ -27,7 +62,6 @@ class MediaDB(Base):
             list[int]: レコードに対応した投入結果のリスト
                        追加したレコードは0、更新したレコードは1が入る
         """
-        result: list[int] = []
         record_list: list[Media] = []
         match record:
             case Media():
@@ -39,34 +73,4 @@ class MediaDB(Base):
             case _:
                 raise TypeError("record is invalid type.")
 
-        Session = sessionmaker(bind=self.engine, autoflush=False)
-        session = Session()
-
-        for r in record_list:
-            try:
-                q = (
-                    session.query(Media)
-                    .filter(and_(Media.media_id == r.media_id, Media.note_id == r.note_id))
-                    .with_for_update()
-                )
-                p = q.one()
-            except NoResultFound:
-                # INSERT
-                session.add(r)
-                result.append(0)
-            else:
-                # UPDATE
-                p.note_id = r.note_id
-                p.media_id = r.media_id
-                p.name = r.name
-                p.type = r.type
-                p.md5 = r.md5
-                p.size = r.size
-                p.url = r.url
-                p.created_at = r.created_at
-                p.registered_at = r.registered_at
-                result.append(1)
-
-        session.commit()
-        session.close()
-        return result
+        return self._bulk_upsert(Media, record_list, "media_id")
@@ -0,0 +1,90 @@
+from sqlalchemy import func
+from sqlalchemy.orm import sessionmaker
+
+from misskey_crawler.db.base import Base
+from misskey_crawler.db.model import MediaFile
+
+
+class MediaFileDB(Base):
+    def __init__(self, db_path: str = "mc_db.db"):
+        super().__init__(db_path)
+
+    def select(self) -> list[MediaFile]:
+        Session = sessionmaker(bind=self.engine, autoflush=False)
+        session = Session()
+        result = session.query(MediaFile).all()
+        session.close()
+        return result
+
+    def select_total(self) -> tuple[int, int]:
+        """保存済みファイルの件数と合計バイト数を返す
+
+        Returns:
+            tuple[int, int]: (件数, 合計バイト数)
+        """
+        Session = sessionmaker(bind=self.engine, autoflush=False)
+        session = Session()
+        count, total = session.query(func.count(MediaFile.id), func.coalesce(func.sum(MediaFile.size), 0)).one()
+        session.close()
+        return count, total
+
+    def select_oldest(self, limit: int) -> list[MediaFile]:
+        """created_at が古い順に limit 件返す、created_at のインデックスを使うので全件は走査しない"""
+        Session = sessionmaker(bind=self.engine, autoflush=False)
+        session = Session()
+        result = session.query(MediaFile).order_by(MediaFile.created_at, MediaFile.id).limit(limit).all()
+        session.close()
+        return result
+
+    def count_by_store_path(self, store_path: str) -> int:
+        """ストア上の同じファイルを参照しているレコード数を返す"""
+        Session = sessionmaker(bind=self.engine, autoflush=False)
+        session = Session()
+        result = session.query(func.count(MediaFile.id)).filter(MediaFile.store_path == store_path).scalar()
+        session.close()
+        return result
+
+    def delete(self, record: MediaFile | list[MediaFile]) -> int:
+        """path が一致するレコードを削除する
+
+        Returns:
+            int: 削除したレコード数
+        """
+        match record:
+            case MediaFile():
+                record_list = [record]
+            case [MediaFile(), *rest] if all([isinstance(r, MediaFile) for r in rest]):
+                record_list = record
+            case _:
+                raise TypeError("record is invalid type.")
+
+        Session = sessionmaker(bind=self.engine, autoflush=False)
+        session = Session()
+        path_list = [r.path for r in record_list]
+        result = session.query(MediaFile).filter(MediaFile.path.in_(path_list)).delete(synchronize_session=False)
+        session.commit()
+        session.close()
+        return result
+
+    def upsert(self, record: MediaFile | list[MediaFile] | list[dict]) -> list[int]:
+        """upsert
+
+        Args:
+            record (MediaFile | list[MediaFile] | list[dict]): 投入レコード、またはレコード辞書のリスト
+
+        Returns:
+            list[int]: レコードに対応した投入結果のリスト
+                       追加したレコードは0、更新したレコードは1が入る
+        """
+        record_list: list[MediaFile] = []
+        match record:
+            case MediaFile():
+                record_list = [record]
+            case [MediaFile(), *rest] if all([isinstance(r, MediaFile) for r in rest]):
+                record_list = record
+            case [dict(), *rest] if all([isinstance(r, dict) for r in rest]):
+                record_list = [MediaFile.create(r) for r in record]
+            case _:
+                raise TypeError("record is invalid type.")
+
+        return self._bulk_upsert(MediaFile, record_list, "path")
@@ -0,0 +1,223 @@
+import re
+from collections.abc import Callable
+from logging import INFO, getLogger
+from typing import Any
+
+from sqlalchemy import Connection, Engine, inspect
+
+from misskey_crawler.util import to_epoch_ms
+
+logger = getLogger(__name__)
+logger.setLevel(INFO)
+
+
+def add_secondary_index(conn: Connection) -> None:
+    """検索と結合に使うカラムにインデックスを追加する
+
+    create_all は既存のテーブルにインデックスを追加しないため、既存の DB にはここで追加する
+    インデックス名は SQLAlchemy の既定の命名規則 (ix_<テーブル名>_<カラム名>) に合わせる
+    """
+    for table_name, column_name in [("Reaction", "reaction_id"), ("Media", "note_id"), ("Note", "user_id")]:
+        conn.exec_driver_sql(
+            f'CREATE INDEX IF NOT EXISTS "ix_{table_name}_{column_name}" ON "{table_name}" ("{column_name}")'
+        )
+
+
+def rebuild_table(
+    conn: Connection,
+    table_name: str,
+    type_dict: dict[str, str],
+    convert: Callable[[str, Any], Any],
+    chunk_size: int = 1000,
+) -> None:
+    """テーブルを作り直してカラムの型を変更する
+
+    SQLite は既存のカラムの型を変更できないため、CREATE TABLE 文のカラムの型を type_dict で置き換えた
+    テーブルを作り、convert(カラム名, 値) で変換した値を chunk_size 件ずつ移してから元のテーブルと入れ替える
+    インデックスは元のテーブルのものを作り直す、テーブルがなければ何もしない
+    """
+    create_sql = conn.exec_driver_sql(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table_name,)
+    ).scalar()
+    if create_sql is None:
+        return
+    index_sql_list = list(
+        conn.exec_driver_sql(
+            "SELECT sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL", (table_name,)
+        ).scalars()
+    )
+
+    temp_name = f"{table_name}_new"
+    new_sql = re.sub(rf'^CREATE TABLE\s+"?{table_name}"?', f'CREATE TABLE "{temp_name}"', create_sql)
+    for column_name, column_type in type_dict.items():
+        new_sql = re.sub(rf"(\b{column_name}\s+)\w+(\(\d+\))?", rf"\g<1>{column_type}", new_sql)
+    conn.exec_driver_sql(f'DROP TABLE IF EXISTS "{temp_name}"')
+    conn.exec_driver_sql(new_sql)
+
+    column_list = [row[1] for row in conn.exec_driver_sql(f'PRAGMA table_info("{table_name}")')]
+    column_sql = ", ".join(f'"{column}"' for column in column_list)
+    insert_sql = f'INSERT INTO "{temp_name}" ({column_sql}) VALUES ({", ".join("?" * len(column_list))})'
+    result = conn.exec_driver_sql(f'SELECT {column_sql} FROM "{table_name}"')
+    while row_list := result.fetchmany(chunk_size):
+        conn.exec_driver_sql(
+            insert_sql,
+            [tuple(convert(column, value) for column, value in zip(column_list, row)) for row in row_list],
+        )
+
+    conn.exec_driver_sql(f'DROP TABLE "{table_name}"')
+    conn.exec_driver_sql(f'ALTER TABLE "{temp_name}" RENAME TO "{table_name}"')
+    for index_sql in index_sql_list:
+        conn.exec_driver_sql(index_sql)
+
+
+def convert_timestamp_to_epoch_ms(conn: Connection) -> None:
+    """created_at と registered_at を ISO 形式の文字列からエポックミリ秒の整数に変換する
+
+    タイムゾーンのない日時は JST とみなす
+    期間指定の検索に使う created_at にはインデックスを追加する
+    """
+
+    def convert(column: str, value: Any) -> Any:
+        if column in ("created_at", "registered_at") and isinstance(value, str):
+            return to_epoch_ms(value) if value else 0
+        return value
+
+    for table_name, column_list in [
+        ("Reaction", ["created_at", "registered_at"]),
+        ("Note", ["created_at", "registered_at"]),
+        ("User", ["registered_at"]),
+        ("Media", ["created_at", "registered_at"]),
+        ("MediaFile", ["created_at", "registered_at"]),
+    ]:
+        rebuild_table(conn, table_name, {column: "INTEGER" for column in column_list}, convert)
+    for table_name in ["Reaction", "Note", "Media"]:
+        conn.exec_driver_sql(
+            f'CREATE INDEX IF NOT EXISTS "ix_{table_name}_created_at" ON "{table_name}" ("created_at")'
+        )
+
+
+def add_backfill_window_cursor(conn: Connection) -> None:
+    """時間窓の途中から取得を再開できるように、反映済みのカーソルとページ数のカラムを追加する
+
+    テーブルがなければ何もしない、create_all で最新のスキーマのテーブルが作られる
+    """
+    if not inspect(conn).has_table("BackfillWindow"):
+        return
+    column_list = [column["name"] for column in inspect(conn).get_columns("BackfillWindow")]
+    for column_name, column_ddl in [
+        ("cursor_id", "VARCHAR(256) NOT NULL DEFAULT ''"),
+        ("page_num", "INTEGER NOT NULL DEFAULT 0"),
+    ]:
+        if column_name not in column_list:
+            conn.exec_driver_sql(f'ALTER TABLE "BackfillWindow" ADD COLUMN "{column_name}" {column_ddl}')
+
+
+def add_reaction_account(conn: Connection) -> None:
+    """リアクションにアカウントのカラムを追加し、一意制約を note_id から (account, note_id) に変える
+
+    SQLite は既存の一意制約を変更できないため、テーブルを作り直す
+    既存のレコードは、CrawlState に記録されたアカウントが1つだけならそのアカウントのものとする
+    CrawlState がない単一アカウントの頃の DB では空文字列とし、Crawler が初回に単一アカウントへ引き継ぐ
+    テーブルがなければ何もしない
+    """
+    if not inspect(conn).has_table("Reaction"):
+        return
+    legacy_account = ""
+    if inspect(conn).has_table("CrawlState"):
+        account_list = list(conn.exec_driver_sql('SELECT account FROM "CrawlState"').scalars())
+        if len(account_list) == 1:
+            legacy_account = account_list[0]
+    index_sql_list = list(
+        conn.exec_driver_sql(
+            "SELECT sql FROM sqlite_master WHERE type = 'index' AND tbl_name = 'Reaction' AND sql IS NOT NULL"
+        ).scalars()
+    )
+
+    conn.exec_driver_sql('DROP TABLE IF EXISTS "Reaction_new"')
+    conn.exec_driver_sql(
+        """CREATE TABLE "Reaction_new" (
+            id INTEGER NOT NULL, account VARCHAR(256) NOT NULL, note_id VARCHAR(256) NOT NULL,
+            reaction_id VARCHAR(256) NOT NULL, type VARCHAR(256) NOT NULL,
+            created_at INTEGER NOT NULL, registered_at INTEGER NOT NULL,
+            PRIMARY KEY (id), UNIQUE (account, note_id)
+        )"""
+    )
+    conn.exec_driver_sql(
+        'INSERT INTO "Reaction_new" (id, account, note_id, reaction_id, type, created_at, registered_at) '
+        'SELECT id, ?, note_id, reaction_id, type, created_at, registered_at FROM "Reaction"',
+        (legacy_account,),
+    )
+    conn.exec_driver_sql('DROP TABLE "Reaction"')
+    conn.exec_driver_sql('ALTER TABLE "Reaction_new" RENAME TO "Reaction"')
+    for index_sql in index_sql_list:
+        conn.exec_driver_sql(index_sql)
+    logger.info(f"DB migration : Reaction account of existing records is '{legacy_account}'.")
+
+
+class Migrator:
+    """DB のスキーマのバージョンを PRAGMA user_version で管理し、未適用のマイグレーションを順に適用する
+
+    バージョンは適用済みのマイグレーションの数で、migration_list の末尾に追加したものが次のバージョンとなる
+    各マイグレーションはバージョンの更新と同じトランザクションで実行する
+    テーブルがまだない新しい DB は create_all で最新のスキーマが作られるため、適用せずに最新のバージョンとする
+    """
+
+    engine: Engine
+    migration_list: list[Callable[[Connection], None]] = [
+        add_secondary_index,
+        convert_timestamp_to_epoch_ms,
+        add_backfill_window_cursor,
+        add_reaction_account,
+    ]
+
+    def __init__(self, engine: Engine) -> None:
+        self.engine = engine
+
+    @property
+    def latest_version(self) -> int:
+        return len(self.migration_list)
+
+    @staticmethod
+    def get_version(conn: Connection) -> int:
+        return conn.exec_driver_sql("PRAGMA user_version").scalar()
+
+    @staticmethod
+    def set_version(conn: Connection, version: int) -> None:
+        conn.exec_driver_sql(f"PRAGMA user_version = {int(version)}")
+
+    def migrate(self) -> int:
+        """未適用のマイグレーションを適用する
+
+        create_all より前に呼び出す
+
+        Returns:
+            int: 適用したマイグレーションの数
+        """
+        with self.engine.begin() as conn:
+            version = self.get_version(conn)
+            if version == 0 and not inspect(conn).get_table_names():
+                self.set_version(conn, self.latest_version)
+                return 0
+        if version >= self.latest_version:
+            return 0
+
+        logger.info(f"DB migration : version {version} -> {self.latest_version} -> start")
+        for i, migration in enumerate(self.migration_list[version:], start=version + 1):
+            with self.engine.begin() as conn:
+                migration(conn)
+                self.set_version(conn, i)
+            logger.info(f"DB migration : version {i} ({migration.__name__}) applied.")
+        logger.info(f"DB migration : version {version} -> {self.latest_version} -> done")
+        return self.latest_version - version
+
+
+if __name__ == "__main__":
+    import logging.config
+
+    from misskey_crawler.db.base import Database
+
+    logging.config.fileConfig("./log/logging.ini", disable_existing_loggers=False)
+    database = Database.get()
+    with database.engine.connect() as conn:
+        print(f"user_version : {Migrator.get_version(conn)} / {Migrator(database.engine).latest_version}")
+    database.close()
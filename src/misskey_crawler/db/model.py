@@ -1,35 +1,65 @@
 import re
+from datetime import datetime
 from pathlib import Path
 from typing import Self
 
-from sqlalchemy import Boolean, Column, Integer, String, create_engine
+from sqlalchemy import Boolean, Column, ColumnElement, Integer, String, UniqueConstraint, and_, create_engine, true
 from sqlalchemy.orm import Session, declarative_base
 import urllib.parse
 
+from misskey_crawler.util import to_epoch_ms
+
 Base = declarative_base()
 
 
-class Reaction(Base):
+class TimeRangeMixin:
+    """created_at による期間指定の条件を作る
+
+    created_at と registered_at はエポックミリ秒で保持し、created_at にはインデックスを張る
+    """
+
+    @classmethod
+    def created_between(
+        cls, since: datetime | int | None = None, until: datetime | int | None = None
+    ) -> ColumnElement[bool]:
+        """since <= created_at < until の条件を返す、None を指定した側は制限しない"""
+        condition_list = []
+        if since is not None:
+            condition_list.append(cls.created_at >= (since if isinstance(since, int) else to_epoch_ms(since)))
+        if until is not None:
+            condition_list.append(cls.created_at < (until if isinstance(until, int) else to_epoch_ms(until)))
+        return and_(true(), *condition_list)
+
+
+class Reaction(TimeRangeMixin, Base):
     """リアクションモデル
     [id] INTEGER NOT NULL UNIQUE,
-    [note_id] TEXT NOT NULL UNIQUE,
+    [account] TEXT NOT NULL,
+    [note_id] TEXT NOT NULL,
     [reaction_id] TEXT NOT NULL,
     [type] TEXT NOT NULL,
-    [created_at] TEXT NOT NULL,
-    PRIMARY KEY([id])
+    [created_at] INTEGER NOT NULL,
+    [registered_at] INTEGER NOT NULL,
+    PRIMARY KEY([id]),
+    UNIQUE([account], [note_id])
+
+    account はリアクションしたアカウント名で、同じノートへのリアクションもアカウントごとに記録する
     """
 
     __tablename__ = "Reaction"
+    __table_args__ = (UniqueConstraint("account", "note_id"),)
 
     id = Column(Integer, primary_key=True)
-    note_id = Column(String(256), nullable=False, unique=True)
-    reaction_id = Column(String(256), nullable=False)
+    account = Column(String(256), nullable=False)
+    note_id = Column(String(256), nullable=False)
+    reaction_id = Column(String(256), nullable=False, index=True)
     type = Column(String(256), nullable=False)
-    created_at = Column(String(256), nullable=False)
-    registered_at = Column(String(256), nullable=False)
+    created_at = Column(Integer, nullable=False, index=True)
+    registered_at = Column(Integer, nullable=False)
 
-    def __init__(self, note_id: str, reaction_id: str, type: str, created_at: str, registered_at: str):
+    def __init__(self, account: str, note_id: str, reaction_id: str, type: str, created_at: int, registered_at: int):
         # self.id = id
+        self.account = account
         self.note_id = note_id
         self.reaction_id = reaction_id
         self.type = type
@@ -40,24 +70,26 @@ class Reaction(Base):
     def create(self, args_dict: dict) -> Self:
         match args_dict:
             case {
+                "account": account,
                 "note_id": note_id,
                 "reaction_id": reaction_id,
                 "type": type,
                 "created_at": created_at,
                 "registered_at": registered_at,
             }:
-                return Reaction(note_id, reaction_id, type, created_at, registered_at)
+                return Reaction(account, note_id, reaction_id, type, created_at, registered_at)
             case _:
                 raise ValueError("Unmatch args_dict.")
 
     def __repr__(self):
-        return f"<Reaction(reaction_id='{self.reaction_id}', note_id='{self.note_id}')>"
+        return f"<Reaction(account='{self.account}', reaction_id='{self.reaction_id}', note_id='{self.note_id}')>"
 
     def __eq__(self, other):
-        return isinstance(other, Reaction) and other.reaction_id == self.reaction_id and other.note_id == self.note_id
+        return isinstance(other, Reaction) and other.account == self.account and other.note_id == self.note_id
 
     def to_dict(self) -> dict:
         return {
+            "account": self.account,
             "note_id": self.note_id,
             "reaction_id": self.reaction_id,
             "type": self.type,
@@ -66,15 +98,15 @@ class Reaction(Base):
         }
 
 
-class Note(Base):
+class Note(TimeRangeMixin, Base):
     """ノートモデル
     [id] INTEGER NOT NULL UNIQUE,
     [note_id] TEXT NOT NULL UNIQUE,
     [user_id] TEXT NOT NULL,
     [url] TEXT NOT NULL,
     [text] TEXT,
-    [created_at] TEXT NOT NULL,
-    [registered_at] TEXT NOT NULL,
+    [created_at] INTEGER NOT NULL,
+    [registered_at] INTEGER NOT NULL,
     PRIMARY KEY([id])
     """
 
@@ -82,13 +114,13 @@ class Note(Base):
 
     id = Column(Integer, primary_key=True)
     note_id = Column(String(256), nullable=False, unique=True)
-    user_id = Column(String(256), nullable=False)
+    user_id = Column(String(256), nullable=False, index=True)
     url = Column(String(256), nullable=False)
     text = Column(String(256))
-    created_at = Column(String(256), nullable=False)
-    registered_at = Column(String(256), nullable=False)
+    created_at = Column(Integer, nullable=False, index=True)
+    registered_at = Column(Integer, nullable=False)
 
-    def __init__(self, note_id: str, user_id: str, url: str, text: str, created_at: str, registered_at: str):
+    def __init__(self, note_id: str, user_id: str, url: str, text: str, created_at: int, registered_at: int):
         # self.id = id
         self.note_id = note_id
         self.user_id = user_id
@@ -138,7 +170,7 @@ class User(Base):
     [avatar_url] TEXT,
     [is_bot] BOOL,
     [is_cat] BOOL,
-    [registered_at] TEXT NOT NULL,
+    [registered_at] INTEGER NOT NULL,
     PRIMARY KEY([id])
     """
 
@@ -151,10 +183,10 @@ class User(Base):
     avatar_url = Column(String(512))
     is_bot = Column(Boolean)
     is_cat = Column(Boolean)
-    registered_at = Column(String(256), nullable=False)
+    registered_at = Column(Integer, nullable=False)
 
     def __init__(
-        self, user_id: str, name: str, username: str, avatar_url: str, is_bot: bool, is_cat: bool, registered_at: str
+        self, user_id: str, name: str, username: str, avatar_url: str, is_bot: bool, is_cat: bool, registered_at: int
     ):
         # self.id = id
         self.user_id = user_id
@@ -199,7 +231,7 @@ class User(Base):
         }
 
 
-class Media(Base):
+class Media(TimeRangeMixin, Base):
     """メディアモデル
     [id] INTEGER NOT NULL UNIQUE,
     [note_id] TEXT NOT NULL,
@@ -209,23 +241,23 @@ class Media(Base):
     [md5] TEXT NOT NULL,
     [size] INTEGER NOT NULL,
     [url] TEXT NOT NULL,
-    [created_at] TEXT NOT NULL,
-    [registered_at] TEXT NOT NULL,
+    [created_at] INTEGER NOT NULL,
+    [registered_at] INTEGER NOT NULL,
     PRIMARY KEY([id])
     """
 
     __tablename__ = "Media"
 
     id = Column(Integer, primary_key=True)
-    note_id = Column(String(256), nullable=False)
+    note_id = Column(String(256), nullable=False, index=True)
     media_id = Column(String(256), nullable=False, unique=True)
     name = Column(String(256))
     type = Column(String(256), nullable=False)
     md5 = Column(String(256), nullable=False)
     size = Column(Integer, nullable=False)
     url = Column(String(512), nullable=False)
-    created_at = Column(String(256), nullable=False)
-    registered_at = Column(String(256), nullable=False)
+    created_at = Column(Integer, nullable=False, index=True)
+    registered_at = Column(Integer, nullable=False)
 
     def __init__(
         self,
@@ -236,8 +268,8 @@ class Media(Base):
         md5: str,
         size: int,
         url: str,
-        created_at: str,
-        registered_at: str,
+        created_at: int,
+        registered_at: int,
     ):
         # self.id = id
         self.note_id = note_id
@@ -309,6 +341,236 @@ class Media(Base):
         return filename
 
 
+class CrawlState(Base):
+    """クロール状態モデル
+    [id] INTEGER NOT NULL UNIQUE,
+    [account] TEXT NOT NULL UNIQUE,
+    [last_reaction_id] TEXT NOT NULL,
+    [updated_at] TEXT NOT NULL,
+    PRIMARY KEY([id])
+    """
+
+    __tablename__ = "CrawlState"
+
+    id = Column(Integer, primary_key=True)
+    account = Column(String(256), nullable=False, unique=True)
+    last_reaction_id = Column(String(256), nullable=False)
+    updated_at = Column(String(256), nullable=False)
+
+    def __init__(self, account: str, last_reaction_id: str, updated_at: str):
+        # self.id = id
+        self.account = account
+        self.last_reaction_id = last_reaction_id
+        self.updated_at = updated_at
+
+    @classmethod
+    def create(self, args_dict: dict) -> Self:
+        match args_dict:
+            case {
+                "account": account,
+                "last_reaction_id": last_reaction_id,
+                "updated_at": updated_at,
+            }:
+                return CrawlState(account, last_reaction_id, updated_at)
+            case _:
+                raise ValueError("Unmatch args_dict.")
+
+    def __repr__(self):
+        return f"<CrawlState(account='{self.account}', last_reaction_id='{self.last_reaction_id}')>"
+
+    def __eq__(self, other):
+        return isinstance(other, CrawlState) and other.account == self.account
+
+    def to_dict(self) -> dict:
+        return {
+            "account": self.account,
+            "last_reaction_id": self.last_reaction_id,
+            "updated_at": self.updated_at,
+        }
+
+
+class BackfillWindow(Base):
+    """バックフィルの時間窓モデル
+    [id] INTEGER NOT NULL UNIQUE,
+    [window_key] TEXT NOT NULL UNIQUE,
+    [account] TEXT NOT NULL,
+    [since_id] TEXT NOT NULL,
+    [until_id] TEXT NOT NULL,
+    [cursor_id] TEXT NOT NULL,
+    [page_num] INTEGER NOT NULL,
+    [is_done] BOOL NOT NULL,
+    [updated_at] TEXT NOT NULL,
+    PRIMARY KEY([id])
+
+    since_id と until_id は窓の境界となる合成 ID で、since_id < ID < until_id のリアクションを窓に含む
+    境界が空文字列の窓は、その方向に制限がない
+    window_key は account、since_id、until_id から作る
+    cursor_id は DB に反映済みの最も古いリアクションID、page_num は反映済みのページ数で、
+    窓の取得を再開するときは cursor_id から続ける
+    """
+
+    __tablename__ = "BackfillWindow"
+
+    id = Column(Integer, primary_key=True)
+    window_key = Column(String(512), nullable=False, unique=True)
+    account = Column(String(256), nullable=False, index=True)
+    since_id = Column(String(256), nullable=False)
+    until_id = Column(String(256), nullable=False)
+    cursor_id = Column(String(256), nullable=False)
+    page_num = Column(Integer, nullable=False)
+    is_done = Column(Boolean, nullable=False)
+    updated_at = Column(String(256), nullable=False)
+
+    def __init__(
+        self,
+        account: str,
+        since_id: str,
+        until_id: str,
+        is_done: bool,
+        updated_at: str,
+        cursor_id: str = "",
+        page_num: int = 0,
+    ):
+        # self.id = id
+        self.window_key = f"{account}_{since_id}_{until_id}"
+        self.account = account
+        self.since_id = since_id
+        self.until_id = until_id
+        self.cursor_id = cursor_id
+        self.page_num = page_num
+        self.is_done = is_done
+        self.updated_at = updated_at
+
+    @classmethod
+    def create(self, args_dict: dict) -> Self:
+        match args_dict:
+            case {
+                "account": account,
+                "since_id": since_id,
+                "until_id": until_id,
+                "is_done": is_done,
+                "updated_at": updated_at,
+                **rest,
+            }:
+                return BackfillWindow(
+                    account,
+                    since_id,
+                    until_id,
+                    is_done,
+                    updated_at,
+                    rest.get("cursor_id", ""),
+                    rest.get("page_num", 0),
+                )
+            case _:
+                raise ValueError("Unmatch args_dict.")
+
+    def __repr__(self):
+        return (
+            f"<BackfillWindow(window_key='{self.window_key}', cursor_id='{self.cursor_id}', is_done={self.is_done})>"
+        )
+
+    def __eq__(self, other):
+        return isinstance(other, BackfillWindow) and other.window_key == self.window_key
+
+    def to_dict(self) -> dict:
+        return {
+            "window_key": self.window_key,
+            "account": self.account,
+            "since_id": self.since_id,
+            "until_id": self.until_id,
+            "cursor_id": self.cursor_id,
+            "page_num": self.page_num,
+            "is_done": self.is_done,
+            "updated_at": self.updated_at,
+        }
+
+
+class MediaFile(Base):
+    """保存済みメディアファイルモデル
+    [id] INTEGER NOT NULL UNIQUE,
+    [path] TEXT NOT NULL UNIQUE,
+    [note_id] TEXT NOT NULL,
+    [media_id] TEXT NOT NULL,
+    [md5] TEXT NOT NULL,
+    [size] INTEGER NOT NULL,
+    [store_path] TEXT NOT NULL,
+    [created_at] INTEGER NOT NULL,
+    [registered_at] INTEGER NOT NULL,
+    PRIMARY KEY([id])
+
+    path と store_path は save_base_path からの相対パス、store_path はストアを使わない場合は空文字列
+    created_at はメディアを含むノートへのリアクション日時で、保存期間の判定に使う
+    """
+
+    __tablename__ = "MediaFile"
+
+    id = Column(Integer, primary_key=True)
+    path = Column(String(512), nullable=False, unique=True)
+    note_id = Column(String(256), nullable=False)
+    media_id = Column(String(256), nullable=False)
+    md5 = Column(String(256), nullable=False)
+    size = Column(Integer, nullable=False)
+    store_path = Column(String(512), nullable=False, index=True)
+    created_at = Column(Integer, nullable=False, index=True)
+    registered_at = Column(Integer, nullable=False)
+
+    def __init__(
+        self,
+        path: str,
+        note_id: str,
+        media_id: str,
+        md5: str,
+        size: int,
+        store_path: str,
+        created_at: int,
+        registered_at: int,
+    ):
+        # self.id = id
+        self.path = path
+        self.note_id = note_id
+        self.media_id = media_id
+        self.md5 = md5
+        self.size = size
+        self.store_path = store_path
+        self.created_at = created_at
+        self.registered_at = registered_at
+
+    @classmethod
+    def create(self, args_dict: dict) -> Self:
+        match args_dict:
+            case {
+                "path": path,
+                "note_id": note_id,
+                "media_id": media_id,
+                "md5": md5,
+                "size": size,
+                "store_path": store_path,
+                "created_at": created_at,
+                "registered_at": registered_at,
+            }:
+                return MediaFile(path, note_id, media_id, md5, size, store_path, created_at, registered_at)
+            case _:
+                raise ValueError("Unmatch args_dict.")
+
+    def __repr__(self):
+        return f"<MediaFile(path='{self.path}')>"
+
+    def __eq__(self, other):
+        return isinstance(other, MediaFile) and other.path == self.path
+
+    def to_dict(self) -> dict:
+        return {
+            "path": self.path,
+            "note_id": self.note_id,
+            "media_id": self.media_id,
+            "md5": self.md5,
+            "size": self.size,
+            "store_path": self.store_path,
+            "created_at": self.created_at,
+            "registered_at": self.registered_at,
+        }
+
+
 if __name__ == "__main__":
     test_db = Path("./test_DB.db")
     test_db.unlink(missing_ok=True)
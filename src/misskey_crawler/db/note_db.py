@@ -1,6 +1,6 @@
-from sqlalchemy import and_
+from datetime import datetime
+
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.orm.exc import NoResultFound
 
 from misskey_crawler.db.base import Base
 from misskey_crawler.db.model import Note
@@ -17,6 +17,18 @@ class NoteDB(Base):
         session.close()
         return result
 
+    def select_created_between(
+        self, since: datetime | int | None = None, until: datetime | int | None = None
+    ) -> list[Note]:
+        """created_at が since 以上 until 未満のレコードを古い順に返す、created_at のインデックスを使う"""
+        Session = sessionmaker(bind=self.engine, autoflush=False)
+        session = Session()
+        result = (
+            session.query(Note).filter(Note.created_between(since, until)).order_by(Note.created_at, Note.id).all()
+        )
+        session.close()
+        return result
+
     def upsert(self, record: Note | list[Note] | list[dict]) -> list[int]:
         """upsert
 
@@ -27,7 +39,6 @@ class NoteDB(Base):
             list[int]: レコードに対応した投入結果のリスト
                        追加したレコードは0、更新したレコードは1が入る
         """
-        result: list[int] = []
         record_list: list[Note] = []
         match record:
             case Note():
@@ -39,27 +50,4 @@ class NoteDB(Base):
             case _:
                 raise TypeError("record is invalid type.")
 
-        Session = sessionmaker(bind=self.engine, autoflush=False)
-        session = Session()
-
-        for r in record_list:
-            try:
-                q = session.query(Note).filter(and_(Note.note_id == r.note_id)).with_for_update()
-                p = q.one()
-            except NoResultFound:
-                # INSERT
-                session.add(r)
-                result.append(0)
-            else:
-                # UPDATE
-                p.note_id = r.note_id
-                p.user_id = r.user_id
-                p.url = r.url
-                p.text = r.text
-                p.created_at = r.created_at
-                p.registered_at = r.registered_at
-                result.append(1)
-
-        session.commit()
-        session.close()
-        return result
+        return self._bulk_upsert(Note, record_list, "note_id")
@@ -1,9 +1,11 @@
-from sqlalchemy import and_, desc
+from datetime import datetime
+
+from sqlalchemy import delete, desc, update
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.orm.exc import NoResultFound
 
 from misskey_crawler.db.base import Base
 from misskey_crawler.db.model import Reaction
+from misskey_crawler.util.misskey_id import sort_key
 
 
 class ReactionDB(Base):
@@ -18,12 +20,53 @@ class ReactionDB(Base):
         return result
 
     def select_last_record(self) -> Reaction | None:
+        """最も新しいリアクションを返す
+
+        ID の形式が途中で変わっても正しく選べるよう、文字列順ではなく created_at のインデックスで絞り込み、
+        同じ日時のものは ID を復号して比較する
+        リアクションの created_at は ID の生成日時と同じ
+        """
+        Session = sessionmaker(bind=self.engine, autoflush=False)
+        session = Session()
+        result = None
+        latest = session.query(Reaction).order_by(desc(Reaction.created_at)).first()
+        if latest is not None:
+            candidate_list = session.query(Reaction).filter(Reaction.created_at == latest.created_at).all()
+            result = max(candidate_list, key=lambda r: sort_key(r.reaction_id))
+        session.close()
+        return result
+
+    def select_created_between(
+        self, since: datetime | int | None = None, until: datetime | int | None = None
+    ) -> list[Reaction]:
+        """created_at が since 以上 until 未満のレコードを古い順に返す、created_at のインデックスを使う"""
         Session = sessionmaker(bind=self.engine, autoflush=False)
         session = Session()
-        result = session.query(Reaction).order_by(desc(Reaction.reaction_id)).first()
+        result = (
+            session
+            .query(Reaction)
+            .filter(Reaction.created_between(since, until))
+            .order_by(Reaction.created_at, Reaction.id)
+            .all()
+        )
         session.close()
         return result
 
+    def assign_legacy_account(self, account: str) -> int:
+        """アカウントが空文字列の既存のリアクションを account のものにする
+
+        アカウントを記録する前の単一アカウントの DB から移行した直後に使う
+        account のリアクションとして記録済みのノートのものは、記録済みのものを残して重複を削除する
+
+        Returns:
+            int: account のものにしたレコード数
+        """
+        update_stmt = update(Reaction).where(Reaction.account == "").values(account=account).prefix_with("OR IGNORE")
+        with self.database.transaction() as conn:
+            result = conn.execute(update_stmt).rowcount
+            conn.execute(delete(Reaction).where(Reaction.account == ""))
+        return result
+
     def upsert(self, record: Reaction | list[Reaction] | list[dict]) -> list[int]:
         """upsert
 
@@ -34,7 +77,6 @@ class ReactionDB(Base):
             list[int]: レコードに対応した投入結果のリスト
                        追加したレコードは0、更新したレコードは1が入る
         """
-        result: list[int] = []
         record_list: list[Reaction] = []
         match record:
             case Reaction():
@@ -46,30 +88,4 @@ class ReactionDB(Base):
             case _:
                 raise TypeError("record is invalid type.")
 
-        Session = sessionmaker(bind=self.engine, autoflush=False)
-        session = Session()
-
-        for r in record_list:
-            try:
-                q = (
-                    session.query(Reaction)
-                    .filter(and_(Reaction.note_id == r.note_id, Reaction.reaction_id == r.reaction_id))
-                    .with_for_update()
-                )
-                p = q.one()
-            except NoResultFound:
-                # INSERT
-                session.add(r)
-                result.append(0)
-            else:
-                # UPDATE
-                p.note_id = r.note_id
-                p.reaction_id = r.reaction_id
-                p.type = r.type
-                p.created_at = r.created_at
-                p.registered_at = r.registered_at
-                result.append(1)
-
-        session.commit()
-        session.close()
-        return result
+        return self._bulk_upsert(Reaction, record_list, ("account", "note_id"))
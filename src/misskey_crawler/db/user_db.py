@@ -1,6 +1,4 @@
-from sqlalchemy import and_
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.orm.exc import NoResultFound
 
 from misskey_crawler.db.base import Base
 from misskey_crawler.db.model import User
@@ -27,7 +25,6 @@ class UserDB(Base):
             list[int]: レコードに対応した投入結果のリスト
                        追加したレコードは0、更新したレコードは1が入る
         """
-        result: list[int] = []
         record_list: list[User] = []
         match record:
             case User():
@@ -39,28 +36,4 @@ class UserDB(Base):
             case _:
                 raise TypeError("record is invalid type.")
 
-        Session = sessionmaker(bind=self.engine, autoflush=False)
-        session = Session()
-
-        for r in record_list:
-            try:
-                q = session.query(User).filter(and_(User.user_id == r.user_id)).with_for_update()
-                p = q.one()
-            except NoResultFound:
-                # INSERT
-                session.add(r)
-                result.append(0)
-            else:
-                # UPDATE
-                p.user_id = r.user_id
-                p.name = r.name
-                p.username = r.username
-                p.avatar_url = r.avatar_url
-                p.is_bot = r.is_bot
-                p.is_cat = r.is_cat
-                p.registered_at = r.registered_at
-                result.append(1)
-
-        session.commit()
-        session.close()
-        return result
+        return self._bulk_upsert(User, record_list, "user_id")
@@ -1,3 +1,4 @@
+import argparse
 import logging.config
 from logging import getLogger
 
@@ -8,11 +9,15 @@ logger = getLogger(__name__)
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Misskey crawler")
+    parser.add_argument("--backfill", action="store_true", help="fetch whole reaction history from newest to oldest")
+    args = parser.parse_args()
+
     horizontal_line = "-" * 80
     logger.info(horizontal_line)
     logger.info("Misskey crawler -> start")
     crawler = Crawler()
-    crawler.run()
+    crawler.run(args.backfill)
     logger.info("Misskey crawler -> done")
     logger.info(horizontal_line)
 
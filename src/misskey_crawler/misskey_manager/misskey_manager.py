@@ -1,50 +1,120 @@
+import asyncio
 import logging.config
 import pprint
 from logging import INFO, getLogger
 from pathlib import Path
+from typing import Self
 
+import httpx
 import orjson
-from misskey import Misskey as Mk
+
+from misskey_crawler.misskey_manager.request_scheduler import RequestScheduler
 
 logger = getLogger(__name__)
 logger.setLevel(INFO)
 
 
+class MisskeyAPIError(Exception):
+    """Misskey API がエラーを返したことを表す例外"""
+
+    def __init__(self, path: str, status_code: int, error_dict: dict) -> None:
+        self.path = path
+        self.status_code = status_code
+        self.code = error_dict.get("code", "")
+        self.error_message = error_dict.get("message", "")
+        super().__init__(f"{path} : {status_code} {self.code} {self.error_message}".rstrip())
+
+
 class MisskeyManager:
+    """Misskey API クライアント
+
+    インスタンスごとに1つの httpx.AsyncClient を保持し、keep-alive と HTTP/2 で
+    接続を使い回す。API 呼び出しはすべて awaitable であり、メディアのダウンロードと
+    同じイベントループ上で並行に実行できる。
+    リクエストは RequestScheduler を経由して送信され、レート制限に応じてペーシングされる。
+    """
+
     instance_name: str
     token: str
-    misskey: Mk
+    client: httpx.AsyncClient
+    scheduler: RequestScheduler
+    timeout: int = 120
 
-    def __init__(self, instance_name: str, token: str) -> None:
+    def __init__(self, instance_name: str, token: str, scheduler: RequestScheduler | None = None) -> None:
         self.instance_name = instance_name
         self.token = token
-        self.misskey = Mk(instance_name, i=token)
-        self.misskey.timeout = 120
+        self.scheduler = scheduler or RequestScheduler()
+        self.client = httpx.AsyncClient(
+            base_url=f"https://{instance_name}/api/",
+            http2=True,
+            timeout=httpx.Timeout(self.timeout),
+            limits=httpx.Limits(max_connections=10, max_keepalive_connections=10, keepalive_expiry=60),
+            headers={"Content-Type": "application/json"},
+        )
+
+    async def aclose(self) -> None:
+        await self.client.aclose()
+
+    async def __aenter__(self) -> Self:
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        await self.aclose()
+
+    async def _run(self, path: str, params: dict = {}) -> list[dict] | dict | bool:
+        """API を呼び出す
 
-    @property
-    def user_dict(self) -> dict:
+        Args:
+            path (str): エンドポイント(例: "users/reactions")
+            params (dict): リクエストパラメータ、トークンは自動で付与される
+
+        Returns:
+            list[dict] | dict | bool: レスポンスの JSON、レスポンスボディがない場合は True
+
+        Raises:
+            MisskeyAPIError: API がエラーを返した場合
+        """
+        payload = orjson.dumps({**params, "i": self.token})
+        response = await self.scheduler.request(path, lambda: self.client.post(path, content=payload))
+        if response.status_code == 204:
+            return True
+        if response.is_success:
+            return orjson.loads(response.content)
+
+        error_dict = {}
+        try:
+            error_dict = orjson.loads(response.content).get("error", {})
+        except (orjson.JSONDecodeError, AttributeError):
+            pass
+        raise MisskeyAPIError(path, response.status_code, error_dict)
+
+    async def i(self) -> dict:
+        """トークンに紐づくユーザの情報を取得する(結果はキャッシュされる)"""
         if hasattr(self, "_user_dict"):
             return self._user_dict
-        self._user_dict = self.misskey.i()
+        self._user_dict = await self._run("i")
         return self._user_dict
 
-    def _run(self, path: str, params: dict = {}) -> list[dict] | dict | bool:
-        response = self.misskey._Misskey__request_api(path, **params)
-        return response
-
-    def notes_with_reactions(self, limit: int = 100, last_since_id: str = "") -> list[dict]:
-        user_dict = self.user_dict
-        user_id = user_dict["id"]
+    async def users_reactions(
+        self, user_id: str, limit: int = 100, since_id: str = "", until_id: str = ""
+    ) -> list[dict]:
         # https://misskey-hub.net/docs/api/endpoints/users/reactions.html
         params = {
             "userId": str(user_id),
             "limit": int(limit),
         }
-        if last_since_id != "":
-            params["sinceId"] = str(last_since_id)
+        if since_id != "":
+            params["sinceId"] = str(since_id)
+        if until_id != "":
+            params["untilId"] = str(until_id)
+        return await self._run("users/reactions", params)
 
-        reaction_dict = self._run("users/reactions", params)
-        return reaction_dict
+    async def notes_with_reactions(
+        self, limit: int = 100, last_since_id: str = "", last_until_id: str = ""
+    ) -> list[dict]:
+        user_dict = await self.i()
+        user_id = user_dict["id"]
+        return await self.users_reactions(user_id, limit, last_since_id, last_until_id)
 
 
 if __name__ == "__main__":
@@ -53,6 +123,10 @@ if __name__ == "__main__":
     config_dict = orjson.loads(config_path.read_bytes())
     instance_name = config_dict["misskey"]["instance"]
     token = config_dict["misskey"]["token"]
-    misskey = MisskeyManager(instance_name, token)
-    response = misskey.notes_with_reactions()
+
+    async def main() -> list[dict]:
+        async with MisskeyManager(instance_name, token) as misskey:
+            return await misskey.notes_with_reactions()
+
+    response = asyncio.run(main())
     pprint.pprint(response)
@@ -0,0 +1,233 @@
+import asyncio
+import random
+import time
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from logging import INFO, getLogger
+from typing import Self
+
+import httpx
+
+logger = getLogger(__name__)
+logger.setLevel(INFO)
+
+
+class TokenBucket:
+    """エンドポイントごとのリクエスト間隔を制御するトークンバケット
+
+    rate [req/sec] でトークンを補充し、capacity までのバーストを許す
+    429 を受けたら rate を半分に、成功が続けば max_rate まで少しずつ戻す(AIMD)
+    サーバから待機を指示された場合は pause_until まで全リクエストを止める
+    """
+
+    rate: float
+    max_rate: float
+    min_rate: float
+    capacity: float
+    tokens: float
+    updated_at: float
+    pause_until: float
+
+    def __init__(self, rate: float, capacity: float, max_rate: float, min_rate: float = 0.05) -> None:
+        self.rate = rate
+        self.max_rate = max(max_rate, rate)
+        self.min_rate = min(min_rate, rate)
+        self.capacity = max(capacity, 1.0)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.pause_until = 0.0
+        self.lock = asyncio.Lock()
+
+    def _refill(self, now: float) -> None:
+        if now <= self.updated_at:
+            return
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self) -> float:
+        """トークンを1つ取得する、取得できるまで待機する
+
+        Returns:
+            float: 待機した秒数
+        """
+        waited = 0.0
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                wait = max(self.pause_until - now, 0.0)
+                # 浮動小数点の誤差で待機時間が極小になり続けないよう許容誤差を設ける
+                if wait == 0.0 and self.tokens >= 1.0 - 1e-9:
+                    self.tokens = max(self.tokens - 1.0, 0.0)
+                    return waited
+                if wait == 0.0:
+                    wait = (1.0 - self.tokens) / self.rate
+                await asyncio.sleep(wait)
+                waited += wait
+
+    def pause(self, delay: float) -> None:
+        """delay 秒間リクエストを止める、停止中はトークンを補充しない"""
+        self.pause_until = max(self.pause_until, time.monotonic() + delay)
+        self.tokens = min(self.tokens, 0.0)
+        self.updated_at = max(self.updated_at, self.pause_until)
+
+    def on_success(self) -> None:
+        self.rate = min(self.max_rate, self.rate + 0.1)
+
+    def on_rate_limited(self) -> None:
+        self.rate = max(self.min_rate, self.rate / 2)
+
+
+@dataclass
+class EndpointStats:
+    """エンドポイントごとのリクエスト統計"""
+
+    request_num: int = 0
+    success_num: int = 0
+    retry_num: int = 0
+    rate_limited_num: int = 0
+    wait_time: float = 0.0
+    started_at: float = field(default_factory=lambda: time.monotonic())
+
+    def throughput(self) -> float:
+        """成功したリクエストの実効スループット [req/sec]"""
+        elapsed = time.monotonic() - self.started_at
+        if elapsed <= 0:
+            return 0.0
+        return self.success_num / elapsed
+
+
+class RequestScheduler:
+    """Misskey API へのリクエストをレート制限を考慮して送信する
+
+    リトライ対象は 429、5xx とトランスポートエラー
+    待機時間は Retry-After、X-RateLimit-Reset ヘッダの順に参照し、
+    どちらもなければジッタ付きの指数バックオフとする
+    """
+
+    retry_status_codes: tuple[int, ...] = (429, 500, 502, 503, 504)
+
+    def __init__(
+        self,
+        rate: float = 2.0,
+        burst: float = 5.0,
+        max_rate: float = 10.0,
+        max_retries: int = 5,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0,
+    ) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.max_rate = max_rate
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.bucket_dict: dict[str, TokenBucket] = {}
+        self.stats_dict: dict[str, EndpointStats] = {}
+
+    @classmethod
+    def create(cls, config_dict: dict) -> Self:
+        """config.json の "rate_limit" 設定から生成する、未指定の項目は既定値を使う"""
+        keys = ["rate", "burst", "max_rate", "max_retries", "base_delay", "max_delay"]
+        return cls(**{k: config_dict[k] for k in keys if k in config_dict})
+
+    def get_bucket(self, endpoint: str) -> TokenBucket:
+        if endpoint not in self.bucket_dict:
+            self.bucket_dict[endpoint] = TokenBucket(self.rate, self.burst, self.max_rate)
+            self.stats_dict[endpoint] = EndpointStats()
+        return self.bucket_dict[endpoint]
+
+    def backoff_delay(self, attempt: int) -> float:
+        """ジッタ付き指数バックオフ(full jitter)"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2**attempt)))
+
+    @staticmethod
+    def parse_retry_after(response: httpx.Response) -> float | None:
+        """レスポンスヘッダからサーバが指示する待機秒数を取得する"""
+        headers = response.headers
+        if retry_after := headers.get("Retry-After"):
+            try:
+                return max(float(retry_after), 0.0)
+            except ValueError:
+                pass
+            try:
+                retry_at = parsedate_to_datetime(retry_after)
+                return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0.0)
+            except (TypeError, ValueError):
+                pass
+        if reset := headers.get("X-RateLimit-Reset"):
+            try:
+                return max(float(reset), 0.0)
+            except ValueError:
+                pass
+        return None
+
+    def observe_headers(self, bucket: TokenBucket, response: httpx.Response) -> None:
+        """成功レスポンスの残数ヘッダが 0 ならリセットまで止める"""
+        remaining = response.headers.get("X-RateLimit-Remaining")
+        if remaining is None:
+            return
+        try:
+            if int(float(remaining)) <= 0 and (delay := self.parse_retry_after(response)):
+                bucket.pause(min(delay, self.max_delay))
+        except ValueError:
+            pass
+
+    async def request(self, endpoint: str, send: Callable[[], Awaitable[httpx.Response]]) -> httpx.Response:
+        """send を呼び出してレスポンスを返す
+
+        Args:
+            endpoint (str): ペーシング単位となるエンドポイント名
+            send (Callable[[], Awaitable[httpx.Response]]): リクエストを送信するコルーチン関数
+
+        Returns:
+            httpx.Response: 最後に受け取ったレスポンス、リトライ上限に達した場合はエラーレスポンスのまま返す
+
+        Raises:
+            httpx.TransportError: リトライ上限までトランスポートエラーが続いた場合
+        """
+        bucket = self.get_bucket(endpoint)
+        stats = self.stats_dict[endpoint]
+        attempt = 0
+        while True:
+            stats.wait_time += await bucket.acquire()
+            stats.request_num += 1
+            try:
+                response = await send()
+            except httpx.TransportError as e:
+                if attempt >= self.max_retries:
+                    raise
+                delay = self.backoff_delay(attempt)
+                logger.warning(f"{endpoint} : {e.__class__.__name__}, retry after {delay:.2f} [sec].")
+            else:
+                if response.status_code not in self.retry_status_codes:
+                    stats.success_num += 1
+                    bucket.on_success()
+                    self.observe_headers(bucket, response)
+                    return response
+                if response.status_code == 429:
+                    stats.rate_limited_num += 1
+                    bucket.on_rate_limited()
+                if attempt >= self.max_retries:
+                    return response
+                delay = self.parse_retry_after(response)
+                if delay is None:
+                    delay = self.backoff_delay(attempt)
+                delay = min(delay, self.max_delay)
+                logger.warning(f"{endpoint} : {response.status_code}, retry after {delay:.2f} [sec].")
+            bucket.pause(delay)
+            stats.retry_num += 1
+            attempt += 1
+
+    def log_stats(self, label: str = "") -> None:
+        prefix = f"{label} " if label else ""
+        for endpoint, stats in self.stats_dict.items():
+            rate = self.bucket_dict[endpoint].rate
+            logger.info(
+                f"{prefix}{endpoint} : {stats.success_num}/{stats.request_num} request(s) succeeded, "
+                f"{stats.retry_num} retry, {stats.rate_limited_num} rate limited, "
+                f"waited {stats.wait_time:.2f} [sec], "
+                f"throughput {stats.throughput():.2f} [req/sec], pacing {rate:.2f} [req/sec]."
+            )
@@ -1,47 +0,0 @@
-from datetime import datetime, timedelta
-from typing import Any
-
-
-def find_values(
-    obj: Any,
-    key: str,
-    is_predict_one: bool = False,
-    key_white_list: list[str] = None,
-    key_black_list: list[str] = None,
-) -> Any | list[Any]:
-    if not key_white_list:
-        key_white_list = []
-    if not key_black_list:
-        key_black_list = []
-
-    def _inner_helper(inner_obj: Any, inner_key: str, inner_result: list) -> list:
-        if isinstance(inner_obj, dict) and (inner_dict := inner_obj):
-            for k, v in inner_dict.items():
-                if k == inner_key:
-                    inner_result.append(v)
-                if key_white_list and (k not in key_white_list):
-                    continue
-                if k in key_black_list:
-                    continue
-                inner_result.extend(_inner_helper(v, inner_key, []))
-        if isinstance(inner_obj, list) and (inner_list := inner_obj):
-            for element in inner_list:
-                inner_result.extend(_inner_helper(element, inner_key, []))
-        return inner_result
-
-    result = _inner_helper(obj, key, [])
-    if not is_predict_one:
-        return result
-
-    if len(result) == 0:
-        raise ValueError(f"value of key='{key}' is not found.")
-    if len(result) > 1:
-        raise ValueError(f"values of key='{key}' are multiple found.")
-    return result[0]
-
-
-def to_jst(gmt: datetime) -> datetime:
-    if not isinstance(gmt, datetime):
-        raise ValueError("args is not datetime.")
-    jst = gmt + timedelta(hours=9)
-    return jst
@@ -0,0 +1,169 @@
+import re
+from collections.abc import Callable, Iterator
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from typing import Any
+
+JST = timezone(timedelta(hours=9))
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+MILLISECOND = timedelta(milliseconds=1)
+
+
+def iter_values(
+    obj: Any,
+    key: str,
+    key_white_list: list[str] = None,
+    key_black_list: list[str] = None,
+) -> Iterator[Any]:
+    """obj を再帰的にたどり、key の値を見つけた順に返すジェネレータ
+
+    辞書はキーの順に、キーが一致すればその値を返してから値の中をたどる
+    key_white_list を指定すると、そのキーの値の中だけをたどる
+    key_black_list を指定すると、そのキーの値の中はたどらない
+    """
+    white_key_list = key_white_list or ()
+    black_key_list = key_black_list or ()
+
+    def _iter(inner_obj: Any) -> Iterator[Any]:
+        if isinstance(inner_obj, dict):
+            for k, v in inner_obj.items():
+                if k == key:
+                    yield v
+                if white_key_list and (k not in white_key_list):
+                    continue
+                if k in black_key_list:
+                    continue
+                if isinstance(v, (dict, list)):
+                    yield from _iter(v)
+        elif isinstance(inner_obj, list):
+            for element in inner_obj:
+                if isinstance(element, (dict, list)):
+                    yield from _iter(element)
+
+    return _iter(obj)
+
+
+def find_values(
+    obj: Any,
+    key: str,
+    is_predict_one: bool = False,
+    key_white_list: list[str] = None,
+    key_black_list: list[str] = None,
+) -> Any | list[Any]:
+    """obj を再帰的にたどり、key の値をすべてリストで返す
+
+    is_predict_one が True なら値を1つだけ返し、見つからない場合と2つ目が見つかった時点で ValueError を送出する
+    """
+    value_iter = iter_values(obj, key, key_white_list, key_black_list)
+    if not is_predict_one:
+        return list(value_iter)
+
+    for result in value_iter:
+        break
+    else:
+        raise ValueError(f"value of key='{key}' is not found.")
+    for _ in value_iter:
+        raise ValueError(f"values of key='{key}' are multiple found.")
+    return result
+
+
+KEY_PATH_PATTERN = re.compile(r"(?:^|\.)([^.\[\]]+)|\[(\*|-?\d+)\]")
+
+
+@lru_cache(maxsize=256)
+def compile_key_path(key_path: str) -> Callable[[Any], Iterator[Any]]:
+    """キーのパス式を、値を順に返すジェネレータ関数にする
+
+    パス式はキーを "." でつなぎ、リストの全要素を "[*]"、添字で指定した要素を "[n]" で表す
+    (例: "note.files[*].url"、"result[0].note.id")
+    キーがない、添字が範囲外、型が合わないなどでたどれない枝は無視する
+    コンパイルした結果はパス式ごとにキャッシュする
+
+    Raises:
+        ValueError: パス式が不正な場合
+    """
+    step_list: list[str | int | None] = []
+    pos = 0
+    while pos < len(key_path):
+        matched = KEY_PATH_PATTERN.match(key_path, pos)
+        if matched is None:
+            raise ValueError(f"key path '{key_path}' is invalid.")
+        key, index = matched.groups()
+        if key is not None:
+            step_list.append(key)
+        else:
+            step_list.append(None if index == "*" else int(index))
+        pos = matched.end()
+    if not step_list:
+        raise ValueError(f"key path '{key_path}' is invalid.")
+    step_tuple = tuple(step_list)
+    step_num = len(step_tuple)
+
+    def _walk(obj: Any, step_index: int) -> Iterator[Any]:
+        if step_index == step_num:
+            yield obj
+            return
+        step = step_tuple[step_index]
+        if step is None:
+            if isinstance(obj, list):
+                for element in obj:
+                    yield from _walk(element, step_index + 1)
+        elif isinstance(step, int):
+            if isinstance(obj, list) and -len(obj) <= step < len(obj):
+                yield from _walk(obj[step], step_index + 1)
+        elif isinstance(obj, dict) and step in obj:
+            yield from _walk(obj[step], step_index + 1)
+
+    def walk(obj: Any) -> Iterator[Any]:
+        return _walk(obj, 0)
+
+    return walk
+
+
+def iter_key_path(obj: Any, key_path: str) -> Iterator[Any]:
+    """キーのパス式にあてはまる値を順に返すジェネレータ、パス式は compile_key_path を参照"""
+    return compile_key_path(key_path)(obj)
+
+
+def find_key_path(obj: Any, key_path: str, is_predict_one: bool = False) -> Any | list[Any]:
+    """キーのパス式にあてはまる値をすべてリストで返す
+
+    is_predict_one が True なら値を1つだけ返し、見つからない場合と2つ目が見つかった時点で ValueError を送出する
+    """
+    value_iter = iter_key_path(obj, key_path)
+    if not is_predict_one:
+        return list(value_iter)
+
+    for result in value_iter:
+        break
+    else:
+        raise ValueError(f"value of key path='{key_path}' is not found.")
+    for _ in value_iter:
+        raise ValueError(f"values of key path='{key_path}' are multiple found.")
+    return result
+
+
+def to_jst(gmt: datetime) -> datetime:
+    if not isinstance(gmt, datetime):
+        raise ValueError("args is not datetime.")
+    jst = gmt + timedelta(hours=9)
+    return jst
+
+
+def to_epoch_ms(date_at: datetime | str) -> int:
+    """日時をエポックミリ秒に変換する
+
+    タイムゾーンのない日時は JST とみなす
+    """
+    if isinstance(date_at, str):
+        date_at = datetime.fromisoformat(date_at)
+    if not isinstance(date_at, datetime):
+        raise ValueError("args is not datetime.")
+    if date_at.tzinfo is None:
+        date_at = date_at.replace(tzinfo=JST)
+    return (date_at - EPOCH) // MILLISECOND
+
+
+def from_epoch_ms(epoch_ms: int) -> datetime:
+    """エポックミリ秒を JST の日時に変換する"""
+    return (EPOCH + timedelta(milliseconds=epoch_ms)).astimezone(JST)
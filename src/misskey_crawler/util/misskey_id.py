@@ -0,0 +1,173 @@
+"""Misskey の ID の符号化と復号
+
+Misskey の ID は先頭に生成日時を符号化しており、インスタンスの設定によって次のいずれかの形式となる
+
+    aid      : 2000-01-01 からの経過ミリ秒(36進8桁) + ノイズ(36進2桁)、10文字
+    aidx     : 2000-01-01 からの経過ミリ秒(36進8桁) + 個体識別(36進4桁) + カウンタ(36進4桁)、16文字
+    meid     : UNIX 時間ミリ秒 + 0x800000000000(16進12桁) + ランダム(16進12桁)、24文字
+    meidg    : "g" + UNIX 時間ミリ秒(16進11桁) + ランダム(16進12桁)、24文字
+    objectid : UNIX 時間秒(16進8桁) + ランダム(16進16桁)、24文字
+    ulid     : UNIX 時間ミリ秒(Crockford の32進10桁) + ランダム(32進16桁)、26文字
+
+同じ形式なら ID の文字列順は生成日時順と一致するが、aid から aidx への移行のように
+形式をまたぐ場合は一致しないため、比較は復号した日時と ID の組で行う
+形式の判定は ID の長さと先頭文字だけで行い、復号は int() の基数変換で行う
+"""
+
+from collections.abc import Callable, Iterable
+
+TIME2000 = 946_684_800_000
+MEID_OFFSET = 0x800000000000
+CROCKFORD_CHARS = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+CROCKFORD_TABLE = str.maketrans(CROCKFORD_CHARS + CROCKFORD_CHARS.lower(), "0123456789abcdefghijklmnopqrstuv" * 2)
+ID_FORMAT_LIST = ["aid", "aidx", "meid", "meidg", "objectid", "ulid"]
+
+
+def _to_base36(value: int, width: int) -> str:
+    chars = "0123456789abcdefghijklmnopqrstuvwxyz"
+    result = ""
+    while value > 0:
+        value, remainder = divmod(value, 36)
+        result = chars[remainder] + result
+    return result.rjust(width, "0")
+
+
+def _to_crockford(value: int, width: int) -> str:
+    result = ""
+    while value > 0:
+        value, remainder = divmod(value, 32)
+        result = CROCKFORD_CHARS[remainder] + result
+    return result.rjust(width, "0")
+
+
+# 形式ごとの (日時の復号, 日時の部分の符号化, ランダム部分の下限, ランダム部分の上限)
+CODEC_DICT: dict[str, tuple[Callable[[str], int], Callable[[int], str], str, str]] = {
+    "aid": (
+        lambda misskey_id: int(misskey_id[:8], 36) + TIME2000,
+        lambda epoch_ms: _to_base36(epoch_ms - TIME2000, 8),
+        "0" * 2,
+        "z" * 2,
+    ),
+    "aidx": (
+        lambda misskey_id: int(misskey_id[:8], 36) + TIME2000,
+        lambda epoch_ms: _to_base36(epoch_ms - TIME2000, 8),
+        "0" * 8,
+        "z" * 8,
+    ),
+    "meid": (
+        lambda misskey_id: int(misskey_id[:12], 16) - MEID_OFFSET,
+        lambda epoch_ms: f"{epoch_ms + MEID_OFFSET:012x}",
+        "0" * 12,
+        "f" * 12,
+    ),
+    "meidg": (
+        lambda misskey_id: int(misskey_id[1:12], 16),
+        lambda epoch_ms: f"g{epoch_ms:011x}",
+        "0" * 12,
+        "f" * 12,
+    ),
+    "objectid": (
+        lambda misskey_id: int(misskey_id[:8], 16) * 1000,
+        lambda epoch_ms: f"{epoch_ms // 1000:08x}",
+        "0" * 16,
+        "f" * 16,
+    ),
+    "ulid": (
+        lambda misskey_id: int(misskey_id[:10].translate(CROCKFORD_TABLE), 32),
+        lambda epoch_ms: _to_crockford(epoch_ms, 10),
+        "0" * 16,
+        "Z" * 16,
+    ),
+}
+
+
+def detect_format(misskey_id: str) -> str:
+    """ID の長さと先頭文字から形式を判定する
+
+    meid と objectid は同じ長さなので、先頭の16進数字が8以上(日時にオフセットが加算されている)なら meid とする
+
+    Raises:
+        ValueError: どの形式にも当てはまらない場合
+    """
+    match len(misskey_id):
+        case 10:
+            return "aid"
+        case 16:
+            return "aidx"
+        case 24 if misskey_id[0] == "g":
+            return "meidg"
+        case 24 if misskey_id[0] in "89abcdef":
+            return "meid"
+        case 24:
+            return "objectid"
+        case 26:
+            return "ulid"
+        case _:
+            raise ValueError(f"Unknown misskey id format : '{misskey_id}'")
+
+
+def decode_time(misskey_id: str, id_format: str = "") -> int:
+    """ID の生成日時をエポックミリ秒で返す
+
+    Args:
+        misskey_id (str): Misskey の ID
+        id_format (str): ID の形式、省略すると判定する
+
+    Raises:
+        ValueError: ID を復号できない場合
+    """
+    decode = CODEC_DICT[id_format or detect_format(misskey_id)][0]
+    return decode(misskey_id)
+
+
+def encode_boundary(epoch_ms: int, id_format: str, is_upper: bool = False) -> str:
+    """epoch_ms に生成された ID のうち最小(is_upper なら最大)の ID を作る
+
+    実在しない合成 ID で、sinceId / untilId に指定して日時で範囲を区切るのに使う
+    objectid は秒単位なので、epoch_ms の属する秒の境界となる
+    """
+    _, encode, lower, upper = CODEC_DICT[id_format]
+    return encode(max(epoch_ms, 0)) + (upper if is_upper else lower)
+
+
+def encode_boundary_list(epoch_ms_list: Iterable[int], id_format: str, is_upper: bool = False) -> list[str]:
+    """encode_boundary のバッチ版、バックフィルの時間窓の境界をまとめて作るのに使う"""
+    _, encode, lower, upper = CODEC_DICT[id_format]
+    suffix = upper if is_upper else lower
+    return [encode(max(epoch_ms, 0)) + suffix for epoch_ms in epoch_ms_list]
+
+
+def sort_key(misskey_id: str) -> tuple[int, str]:
+    """ID を生成日時順に並べるためのキー
+
+    復号できない ID の日時は -1 とし、それらの間では文字列順となる
+    """
+    try:
+        return decode_time(misskey_id), misskey_id
+    except ValueError:
+        return -1, misskey_id
+
+
+def compare(id1: str, id2: str) -> int:
+    """id1 が id2 より古ければ負、新しければ正、同じなら0を返す"""
+    key1, key2 = sort_key(id1), sort_key(id2)
+    return (key1 > key2) - (key1 < key2)
+
+
+def max_id(id_list: Iterable[str]) -> str:
+    """最も新しい ID を返す、空なら空文字列を返す"""
+    return max(id_list, key=sort_key, default="")
+
+
+def min_id(id_list: Iterable[str]) -> str:
+    """最も古い ID を返す、空なら空文字列を返す"""
+    return min(id_list, key=sort_key, default="")
+
+
+if __name__ == "__main__":
+    import sys
+
+    from misskey_crawler.util import from_epoch_ms
+
+    for arg in sys.argv[1:]:
+        print(f"{arg} : {detect_format(arg)}, {from_epoch_ms(decode_time(arg)).isoformat()}")
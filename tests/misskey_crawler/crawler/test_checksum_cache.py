@@ -0,0 +1,107 @@
+import hashlib
+import os
+import sys
+import unittest
+from pathlib import Path
+
+from misskey_crawler.crawler.checksum_cache import ChecksumCache
+
+
+class TestChecksumCache(unittest.TestCase):
+    cache_path: Path = Path("./tests/misskey_crawler/cache/test_checksum_cache.json")
+    filepath: Path = Path("./tests/misskey_crawler/cache/test_checksum_media.png")
+    content: bytes = b"0123456789" * 10
+
+    def setUp(self) -> None:
+        self.filepath.write_bytes(self.content)
+        self.md5 = hashlib.md5(self.content).hexdigest()
+
+    def tearDown(self) -> None:
+        self.cache_path.unlink(missing_ok=True)
+        self.filepath.unlink(missing_ok=True)
+
+    def test_init(self):
+        checksum_cache = ChecksumCache(self.cache_path)
+        self.assertEqual(self.cache_path, checksum_cache.cache_path)
+        self.assertEqual({}, checksum_cache.cache_dict)
+        self.assertEqual(False, checksum_cache.is_dirty)
+
+        self.cache_path.write_bytes(b"invalid json")
+        checksum_cache = ChecksumCache(self.cache_path)
+        self.assertEqual({}, checksum_cache.cache_dict)
+
+    def test_compute(self):
+        self.assertEqual(self.md5, ChecksumCache.compute(self.filepath))
+        hasher = ChecksumCache.hash_file(self.filepath)
+        hasher.update(b"appended")
+        self.assertEqual(hashlib.md5(self.content + b"appended").hexdigest(), hasher.hexdigest())
+
+    def test_get_set(self):
+        checksum_cache = ChecksumCache(self.cache_path)
+        self.assertIsNone(checksum_cache.get(self.filepath))
+
+        checksum_cache.set(self.filepath, self.md5, "media_md5")
+        self.assertEqual(True, checksum_cache.is_dirty)
+        entry = checksum_cache.get(self.filepath)
+        self.assertEqual(self.md5, entry["md5"])
+        self.assertEqual("media_md5", entry["media_md5"])
+        self.assertEqual(len(self.content), entry["size"])
+
+        # 更新日時が変わればキャッシュは無効になる
+        stat = self.filepath.stat()
+        os.utime(self.filepath, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+        self.assertIsNone(checksum_cache.get(self.filepath))
+
+        checksum_cache.set(self.filepath, self.md5)
+        self.filepath.write_bytes(self.content + b"appended")
+        self.assertIsNone(checksum_cache.get(self.filepath))
+
+        self.filepath.unlink()
+        self.assertIsNone(checksum_cache.get(self.filepath))
+
+    def test_discard(self):
+        checksum_cache = ChecksumCache(self.cache_path)
+        checksum_cache.discard(self.filepath)
+        self.assertEqual(False, checksum_cache.is_dirty)
+        checksum_cache.set(self.filepath, self.md5)
+        checksum_cache.is_dirty = False
+        checksum_cache.discard(self.filepath)
+        self.assertEqual(True, checksum_cache.is_dirty)
+        self.assertIsNone(checksum_cache.get(self.filepath))
+
+    def test_md5(self):
+        checksum_cache = ChecksumCache(self.cache_path)
+        self.assertEqual(self.md5, checksum_cache.md5(self.filepath))
+        self.assertEqual(self.md5, checksum_cache.get(self.filepath)["md5"])
+
+        # キャッシュが有効ならファイルを読まない
+        checksum_cache.cache_dict[self.filepath.as_posix()]["md5"] = "cached_md5"
+        self.assertEqual("cached_md5", checksum_cache.md5(self.filepath))
+
+    def test_is_accepted(self):
+        checksum_cache = ChecksumCache(self.cache_path)
+        self.assertEqual(False, checksum_cache.is_accepted(self.filepath, self.md5))
+        checksum_cache.set(self.filepath, self.md5)
+        self.assertEqual(True, checksum_cache.is_accepted(self.filepath, self.md5))
+        self.assertEqual(False, checksum_cache.is_accepted(self.filepath, "media_md5"))
+        checksum_cache.set(self.filepath, self.md5, "media_md5")
+        self.assertEqual(True, checksum_cache.is_accepted(self.filepath, "media_md5"))
+
+    def test_save(self):
+        checksum_cache = ChecksumCache(self.cache_path)
+        checksum_cache.save()
+        self.assertEqual(False, self.cache_path.exists())
+
+        checksum_cache.set(self.filepath, self.md5, "media_md5")
+        checksum_cache.save()
+        self.assertEqual(True, self.cache_path.exists())
+        self.assertEqual(False, checksum_cache.is_dirty)
+
+        checksum_cache = ChecksumCache(self.cache_path)
+        self.assertEqual(True, checksum_cache.is_accepted(self.filepath, "media_md5"))
+
+
+if __name__ == "__main__":
+    if sys.argv:
+        del sys.argv[1:]
+    unittest.main(warnings="ignore")
@@ -1,16 +1,106 @@
+import asyncio
 import sys
 import unittest
 from contextlib import ExitStack
 from logging import getLogger
+from pathlib import Path
 
-from mock import MagicMock, patch
+import orjson
+from mock import ANY, AsyncMock, MagicMock, call, patch
 
-from misskey_crawler.crawler.crawler import Crawler
+from misskey_crawler.crawler.crawler import AccountStats, Crawler
+from misskey_crawler.crawler.valueobject.crawled_page import CrawledPage
+from misskey_crawler.db.model import Media, Note, Reaction, User
+from misskey_crawler.misskey_manager.misskey_manager import MisskeyAPIError
 
 logger = getLogger("crawler.crawler")
 
 
 class TestCrawler(unittest.TestCase):
+    config_path: Path = Path("./config/test_crawler_config.json")
+
+    def setUp(self) -> None:
+        config_dict = {"misskey": {}, "db": {"pragma": {"synchronous": "FULL"}}}
+        self.config_path.write_bytes(orjson.dumps(config_dict))
+
+    def tearDown(self) -> None:
+        self.config_path.unlink(missing_ok=True)
+
+    def make_fetcher_mock(self, account: str, page_list: list[list[dict]]) -> MagicMock:
+        fetcher = MagicMock()
+
+        async def fetch_entry_pages(last_reaction_id, is_backfill):
+            for page in page_list:
+                yield page
+
+        def create_fetched_info_list(fetched_entry_list):
+            return [
+                self.make_fetched_info_mock([self.make_records(e["id"])])
+                for e in fetched_entry_list
+                if e["id"] != "invalid_entry"
+            ]
+
+        fetcher.fetch_entry_pages = MagicMock(side_effect=fetch_entry_pages)
+        fetcher.create_fetched_info_list.side_effect = create_fetched_info_list
+        fetcher.get_account_name = AsyncMock(return_value=account)
+        fetcher.aclose = AsyncMock()
+        fetcher.is_debug = False
+        return fetcher
+
+    def get_instance(self, stack: ExitStack) -> Crawler:
+        mock_logger_info = stack.enter_context(patch.object(logger, "info"))
+        mock_fetcher = stack.enter_context(patch("misskey_crawler.crawler.crawler.Fetcher"))
+        mock_downloader = stack.enter_context(patch("misskey_crawler.crawler.crawler.Downloader"))
+        mock_reaction_db = stack.enter_context(patch("misskey_crawler.crawler.crawler.ReactionDB"))
+        mock_note_db = stack.enter_context(patch("misskey_crawler.crawler.crawler.NoteDB"))
+        mock_user_db = stack.enter_context(patch("misskey_crawler.crawler.crawler.UserDB"))
+        mock_media_db = stack.enter_context(patch("misskey_crawler.crawler.crawler.MediaDB"))
+        mock_crawl_state_db = stack.enter_context(patch("misskey_crawler.crawler.crawler.CrawlStateDB"))
+        mock_backfill_window_db = stack.enter_context(patch("misskey_crawler.crawler.crawler.BackfillWindowDB"))
+        mock_media_file_db = stack.enter_context(patch("misskey_crawler.crawler.crawler.MediaFileDB"))
+        mock_retention_policy = stack.enter_context(patch("misskey_crawler.crawler.crawler.RetentionPolicy"))
+        mock_database = stack.enter_context(patch("misskey_crawler.crawler.crawler.Database"))
+        stack.enter_context(patch.object(Crawler, "config_path", self.config_path))
+        mock_fetcher.create_list.return_value = [MagicMock()]
+        mock_backfill_window_db.return_value.select_unfinished.return_value = []
+        mock_retention_policy.return_value.select_downloadable.side_effect = lambda page: page.media_list
+        crawler = Crawler()
+        crawler.downloader.serve = AsyncMock()
+        crawler.downloader.submit = AsyncMock(side_effect=self.submit)
+        crawler.downloader.close_lanes = AsyncMock()
+        crawler.downloader.aclose = AsyncMock()
+        return crawler
+
+    async def submit(self, media_list: list[Media]) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(None)
+        return future
+
+    def make_records(self, entry_id: str) -> tuple[Reaction, Note, User, Media]:
+        note_id = f"note_{entry_id}"
+        return (
+            Reaction("@user@misskey.io", note_id, f"reaction_{entry_id}", "👍", 0, 0),
+            Note(note_id, "user", "", "", 0, 0),
+            User("user", "name", "username", "", False, False, 0),
+            Media(note_id, f"media_{entry_id}", "", "image/png", "", 0, "", 0, 0),
+        )
+
+    def make_page(self, account: str, last_reaction_id: str, entry_id_list: list[str]) -> CrawledPage:
+        record_list = [self.make_records(entry_id) for entry_id in entry_id_list]
+        return CrawledPage(
+            account,
+            last_reaction_id,
+            [records[0] for records in record_list],
+            [records[1] for records in record_list],
+            [records[2] for records in record_list[:1]],
+            [records[3] for records in record_list],
+        )
+
+    def make_fetched_info_mock(self, records: list[tuple]) -> MagicMock:
+        r = MagicMock()
+        r.get_records.side_effect = lambda: records
+        return r
+
     def test_init(self):
         with ExitStack() as stack:
             mock_logger_info = stack.enter_context(patch.object(logger, "info"))
@@ -20,73 +110,405 @@ class TestCrawler(unittest.TestCase):
             mock_note_db = stack.enter_context(patch("misskey_crawler.crawler.crawler.NoteDB"))
             mock_user_db = stack.enter_context(patch("misskey_crawler.crawler.crawler.UserDB"))
             mock_media_db = stack.enter_context(patch("misskey_crawler.crawler.crawler.MediaDB"))
+            mock_crawl_state_db = stack.enter_context(patch("misskey_crawler.crawler.crawler.CrawlStateDB"))
+            mock_backfill_window_db = stack.enter_context(patch("misskey_crawler.crawler.crawler.BackfillWindowDB"))
+            mock_media_file_db = stack.enter_context(patch("misskey_crawler.crawler.crawler.MediaFileDB"))
+            mock_retention_policy = stack.enter_context(patch("misskey_crawler.crawler.crawler.RetentionPolicy"))
+            mock_database = stack.enter_context(patch("misskey_crawler.crawler.crawler.Database"))
+            stack.enter_context(patch.object(Crawler, "config_path", self.config_path))
 
             self.crawler = Crawler()
-            mock_fetcher.assert_called_once_with(self.crawler.config_path)
+            mock_fetcher.create_list.assert_called_once_with(self.crawler.config_path)
             mock_downloader.assert_called_once_with(self.crawler.config_path)
             mock_reaction_db.assert_called_once_with()
             mock_note_db.assert_called_once_with()
             mock_user_db.assert_called_once_with()
             mock_media_db.assert_called_once_with()
+            mock_crawl_state_db.assert_called_once_with()
+            mock_backfill_window_db.assert_called_once_with()
+            mock_database.get.assert_called_once_with(pragma_dict={"synchronous": "FULL"})
+            self.assertEqual(mock_database.get.return_value, self.crawler.database)
+            mock_retention_policy.assert_called_once_with(
+                mock_downloader.return_value, mock_media_file_db.return_value, mock_media_db.return_value
+            )
+            self.assertEqual(mock_fetcher.create_list.return_value, self.crawler.fetcher_list)
 
-    def test_run(self):
+    def test_split_records(self):
+        reaction, note, user = MagicMock(), MagicMock(), MagicMock()
+        media1, media2 = MagicMock(), MagicMock()
+        fetched_list = [
+            self.make_fetched_info_mock([(reaction, note, user, media1), (reaction, note, user, media2)]),
+            self.make_fetched_info_mock([(reaction, note, user, media1)]),
+        ]
+        actual = Crawler.split_records(fetched_list)
+        expect = ([reaction], [note], [user], [media1, media2])
+        self.assertEqual(expect, actual)
+
+        # メディアのないノートへのリアクションも記録する
+        text_reaction, text_note = MagicMock(), MagicMock()
+        fetched_list.append(self.make_fetched_info_mock([(text_reaction, text_note, user, None)]))
+        actual = Crawler.split_records(fetched_list)
+        expect = ([reaction, text_reaction], [note, text_note], [user], [media1, media2])
+        self.assertEqual(expect, actual)
+
+    def test_select_last_reaction_id(self):
         with ExitStack() as stack:
-            mock_logger_info = stack.enter_context(patch.object(logger, "info"))
-            mock_fetcher = stack.enter_context(patch("misskey_crawler.crawler.crawler.Fetcher"))
-            mock_downloader = stack.enter_context(patch("misskey_crawler.crawler.crawler.Downloader"))
-            mock_reaction_db = stack.enter_context(patch("misskey_crawler.crawler.crawler.ReactionDB"))
-            mock_note_db = stack.enter_context(patch("misskey_crawler.crawler.crawler.NoteDB"))
-            mock_user_db = stack.enter_context(patch("misskey_crawler.crawler.crawler.UserDB"))
-            mock_media_db = stack.enter_context(patch("misskey_crawler.crawler.crawler.MediaDB"))
+            crawler = self.get_instance(stack)
+            crawler.crawl_state_db.select_last_reaction_id.return_value = "state_reaction_id"
+            actual = crawler.select_last_reaction_id("@user@misskey.io")
+            self.assertEqual("state_reaction_id", actual)
+            crawler.crawl_state_db.select_last_reaction_id.assert_called_once_with("@user@misskey.io")
+            crawler.reaction_db.select_last_record.assert_not_called()
+            crawler.reaction_db.assign_legacy_account.assert_not_called()
 
-            self.crawler = Crawler()
+            # 単一アカウントでクロール状態がなければ Reaction テーブルから引き継ぐ
+            crawler.crawl_state_db.select_last_reaction_id.return_value = ""
+            last_reaction = MagicMock()
+            last_reaction.reaction_id = "last_reaction_id"
+            crawler.reaction_db.select_last_record.return_value = last_reaction
+            actual = crawler.select_last_reaction_id("@user@misskey.io")
+            self.assertEqual("last_reaction_id", actual)
+            crawler.reaction_db.assign_legacy_account.assert_called_once_with("@user@misskey.io")
+
+            crawler.reaction_db.select_last_record.return_value = None
+            actual = crawler.select_last_reaction_id("@user@misskey.io")
+            self.assertEqual("", actual)
+
+            # 複数アカウントなら引き継がない
+            crawler.fetcher_list = [MagicMock(), MagicMock()]
+            crawler.reaction_db.select_last_record.return_value = last_reaction
+            actual = crawler.select_last_reaction_id("@user@misskey.io")
+            self.assertEqual("", actual)
+
+    def test_pipeline(self):
+        with ExitStack() as stack:
+            crawler = self.get_instance(stack)
+            fetcher1 = self.make_fetcher_mock(
+                "@user1@misskey.io",
+                [[{"id": "r1_2"}, {"id": "r1_1"}], [{"id": "invalid_entry"}]],
+            )
+            fetcher2 = self.make_fetcher_mock("@user2@misskey.example", [[{"id": "r2_1"}]])
+            crawler.fetcher_list = [fetcher1, fetcher2]
+            crawler.select_last_reaction_id = MagicMock(return_value="last_reaction_id")
+            crawler.upsert = MagicMock()
+
+            actual = asyncio.run(crawler.pipeline(False))
+            self.assertEqual(3, actual)
+            fetcher1.fetch_entry_pages.assert_called_once_with("last_reaction_id", False)
+            fetcher2.fetch_entry_pages.assert_called_once_with("last_reaction_id", False)
+            crawler.downloader.submit.assert_has_awaits(
+                [
+                    call(self.make_page("", "", ["r1_2", "r1_1"]).media_list),
+                    call([]),
+                    call(self.make_page("", "", ["r2_1"]).media_list),
+                ],
+                any_order=True,
+            )
+
+            # レコードにできるエントリがないページもカーソルを進めるため反映する
+            upserted_page_list = [c.args[0] for c in crawler.upsert.call_args_list]
+            self.assertEqual(3, len(upserted_page_list))
+            self.assertIn(CrawledPage("@user1@misskey.io", "invalid_entry", [], [], [], []), upserted_page_list)
+            self.assertIn(self.make_page("@user1@misskey.io", "r1_2", ["r1_2", "r1_1"]), upserted_page_list)
+            self.assertIn(self.make_page("@user2@misskey.example", "r2_1", ["r2_1"]), upserted_page_list)
+            fetcher1.aclose.assert_awaited_once_with()
+            fetcher2.aclose.assert_awaited_once_with()
+            crawler.downloader.aclose.assert_awaited_once_with()
+            self.assertEqual(3, crawler.retention_policy.apply.call_count)
+
+            self.assertEqual(2, crawler.stats_dict["@user1@misskey.io"].page_num)
+            self.assertEqual(2, crawler.stats_dict["@user1@misskey.io"].reaction_num)
+            self.assertEqual(1, crawler.stats_dict["@user2@misskey.example"].page_num)
+
+            crawler.downloader.serve.assert_awaited_once_with()
+            crawler.downloader.close_lanes.assert_awaited_once_with()
+            crawler.retention_policy.seed.assert_called_once_with()
+
+            async def failed_submit(media_list):
+                future = asyncio.get_running_loop().create_future()
+                future.set_exception(ValueError("download failed"))
+                return future
+
+            crawler.downloader.submit.side_effect = failed_submit
+            with self.assertRaises(ExceptionGroup):
+                asyncio.run(crawler.pipeline(False))
+
+    def test_pipeline_account_failure(self):
+        with ExitStack() as stack:
+            crawler = self.get_instance(stack)
+            mock_logger_error = stack.enter_context(patch("misskey_crawler.crawler.crawler.logger.error"))
+            fetcher1 = self.make_fetcher_mock("@user1@misskey.io", [[{"id": "r1_2"}], [{"id": "r1_1"}]])
 
-            def make_reaction_id_mock(reaction_id):
-                r = MagicMock()
-                r.reaction_id = reaction_id
-                return r
+            # リアクションの取得で API エラーになるアカウント
+            fetcher2 = self.make_fetcher_mock("@user2@misskey.example", [])
 
-            reaction_id_mock = make_reaction_id_mock(111111)
-            last_reaction_id = 111111
-            mock_reaction_db().select_last_record.side_effect = lambda: reaction_id_mock
+            async def failed_fetch_entry_pages(last_reaction_id, is_backfill):
+                raise MisskeyAPIError("users/reactions", 401, {"code": "CREDENTIAL_REQUIRED"})
+                yield
 
-            def make_fetched_list_mock(args_last_reaction_id):
-                r = MagicMock()
-                r1 = [MagicMock() for _ in range(4)]
-                r.get_records.side_effect = lambda: [r1]
-                return [r]
+            fetcher2.fetch_entry_pages = MagicMock(side_effect=failed_fetch_entry_pages)
 
-            mock_fetcher().fetch.side_effect = make_fetched_list_mock
+            # アカウント名も取得できないアカウント
+            fetcher3 = self.make_fetcher_mock("@user3@misskey.example", [[{"id": "r3_1"}]])
+            fetcher3.account_name = ""
+            fetcher3.misskey.instance_name = "misskey.example"
+            fetcher3.get_account_name = AsyncMock(side_effect=MisskeyAPIError("i", 503, {}))
 
-            actual = self.crawler.run()
+            crawler.fetcher_list = [fetcher1, fetcher2, fetcher3]
+            crawler.select_last_reaction_id = MagicMock(return_value="last_reaction_id")
+            crawler.upsert = MagicMock()
+
+            # 失敗したアカウントがあっても他のアカウントは最後まで取得する
+            actual = asyncio.run(crawler.pipeline(False))
+            self.assertEqual(2, actual)
+            upserted_page_list = [c.args[0] for c in crawler.upsert.call_args_list]
+            self.assertEqual(
+                ["r1_2", "r1_1"], sorted([page.last_reaction_id for page in upserted_page_list], reverse=True)
+            )
+            fetcher3.fetch_entry_pages.assert_not_called()
+
+            # 失敗はアカウントの統計に記録する
+            self.assertIsNone(crawler.stats_dict["@user1@misskey.io"].error)
+            self.assertEqual(2, crawler.stats_dict["@user1@misskey.io"].page_num)
+            self.assertIsInstance(crawler.stats_dict["@user2@misskey.example"].error, MisskeyAPIError)
+            self.assertEqual(0, crawler.stats_dict["@user2@misskey.example"].page_num)
+            self.assertIsInstance(crawler.stats_dict["@?@misskey.example"].error, MisskeyAPIError)
+            self.assertEqual(2, mock_logger_error.call_count)
+
+    def test_download_stage(self):
+        with ExitStack() as stack:
+            crawler = self.get_instance(stack)
+            page_list = [self.make_page("@user@misskey.io", f"r{i}", [f"r{i}"]) for i in range(3)]
+
+            async def run() -> list[CrawledPage]:
+                # 後のページのダウンロードが先に済んでも、ページは受け取った順に次のステージへ流す
+                future_list = [asyncio.get_running_loop().create_future() for _ in page_list]
+                crawler.downloader.submit.side_effect = future_list
+                input_queue = asyncio.Queue()
+                output_queue = asyncio.Queue()
+                for page in page_list:
+                    input_queue.put_nowait(page)
+                input_queue.put_nowait(None)
+                stage_task = asyncio.create_task(crawler.download_stage(input_queue, output_queue))
+                while crawler.downloader.submit.await_count < len(page_list):
+                    await asyncio.sleep(0)
+                # すべてのページのメディアを、前のページの完了を待たずにワーカーへ渡している
+                self.assertTrue(output_queue.empty())
+                for future in reversed(future_list):
+                    future.set_result(None)
+                await stage_task
+                output_list = []
+                while (page := output_queue.get_nowait()) is not None:
+                    output_list.append(page)
+                return output_list
+
+            actual = asyncio.run(run())
+            self.assertEqual(page_list, actual)
+            crawler.downloader.submit.assert_has_awaits([call(page.media_list) for page in page_list])
+            crawler.downloader.serve.assert_awaited_once_with()
+            crawler.downloader.close_lanes.assert_awaited_once_with()
+            self.assertEqual([call(page) for page in page_list], crawler.retention_policy.apply.call_args_list)
+
+            # 保存期間の上限で直後に削除されるメディアはワーカーに渡さない
+            crawler.retention_policy.select_downloadable.side_effect = lambda page: []
+            crawler.downloader.submit.reset_mock()
+            crawler.downloader.submit.side_effect = self.submit
+            input_queue = asyncio.Queue()
+            input_queue.put_nowait(page_list[0])
+            input_queue.put_nowait(None)
+            asyncio.run(crawler.download_stage(input_queue, asyncio.Queue()))
+            crawler.downloader.submit.assert_awaited_once_with([])
+            crawler.retention_policy.select_downloadable.assert_called_with(page_list[0])
+
+    def test_pipeline_backfill_windows(self):
+        with ExitStack() as stack:
+            crawler = self.get_instance(stack)
+            fetcher = self.make_fetcher_mock("@user@misskey.io", [[{"id": "r3_1"}]])
+            window_list = [MagicMock(window_key="window_2"), MagicMock(window_key="window_1")]
+
+            window_page_dict = {"window_2": [[{"id": "r2_2"}], [{"id": "r2_1"}]], "window_1": [[]]}
+
+            async def fetch_window_entry_pages(window_list, output_queue):
+                for window in window_list:
+                    page_list = window_page_dict[window.window_key]
+                    for i, page in enumerate(page_list):
+                        await output_queue.put((page, window.window_key, i == len(page_list) - 1))
+
+            fetcher.plan_backfill_windows = AsyncMock(return_value=window_list)
+            fetcher.fetch_window_entry_pages = AsyncMock(side_effect=fetch_window_entry_pages)
+            crawler.fetcher_list = [fetcher]
+            crawler.select_last_reaction_id = MagicMock(return_value="last_reaction_id")
+            crawler.upsert = MagicMock()
+            crawler.backfill_window_db.select_unfinished.return_value = []
+
+            actual = asyncio.run(crawler.pipeline(True))
+            self.assertEqual(3, actual)
+            fetcher.plan_backfill_windows.assert_awaited_once_with("@user@misskey.io")
+            fetcher.fetch_window_entry_pages.assert_called_once_with(window_list, ANY)
+            fetcher.fetch_entry_pages.assert_not_called()
+            crawler.backfill_window_db.delete_by_account.assert_called_once_with("@user@misskey.io")
+            crawler.backfill_window_db.upsert.assert_called_once_with(window_list)
+
+            # 空の窓も完了を記録するため反映する
+            upserted_page_list = [c.args[0] for c in crawler.upsert.call_args_list]
+            actual = [
+                (p.last_reaction_id, p.window_key, p.is_window_done, p.window_cursor_id) for p in upserted_page_list
+            ]
+            expect = [
+                ("r2_2", "window_2", False, "r2_2"),
+                ("r2_1", "window_2", True, "r2_1"),
+                ("", "window_1", True, ""),
+            ]
+            self.assertEqual(expect, actual)
+
+            # 未完了の窓があればそれだけを取得する
+            fetcher.plan_backfill_windows.reset_mock()
+            fetcher.fetch_window_entry_pages.reset_mock()
+            crawler.backfill_window_db.reset_mock()
+            crawler.backfill_window_db.select_unfinished.return_value = window_list[1:]
+            asyncio.run(crawler.pipeline(True))
+            fetcher.plan_backfill_windows.assert_not_awaited()
+            fetcher.fetch_window_entry_pages.assert_called_once_with(window_list[1:], ANY)
+            fetcher.fetch_entry_pages.assert_not_called()
+            crawler.backfill_window_db.upsert.assert_not_called()
+
+            # 通常のクロールでも未完了の窓を再開し、続けてカーソル以降を取得する
+            fetcher.fetch_window_entry_pages.reset_mock()
+            crawler.upsert.reset_mock()
+            asyncio.run(crawler.pipeline(False))
+            fetcher.plan_backfill_windows.assert_not_awaited()
+            fetcher.fetch_window_entry_pages.assert_called_once_with(window_list[1:], ANY)
+            fetcher.fetch_entry_pages.assert_called_once_with("last_reaction_id", False)
+            actual = [(p.last_reaction_id, p.window_key) for p in [c.args[0] for c in crawler.upsert.call_args_list]]
+            self.assertEqual([("", "window_1"), ("r3_1", "")], actual)
+
+            # 初回実行は時間窓に分けて取得する
+            fetcher.fetch_window_entry_pages.reset_mock()
+            fetcher.fetch_entry_pages.reset_mock()
+            crawler.backfill_window_db.select_unfinished.return_value = []
+            crawler.select_last_reaction_id.return_value = ""
+            asyncio.run(crawler.pipeline(False))
+            fetcher.plan_backfill_windows.assert_awaited_once_with("@user@misskey.io")
+            fetcher.fetch_window_entry_pages.assert_called_once_with(window_list, ANY)
+            fetcher.fetch_entry_pages.assert_not_called()
+
+            # リアクションがなければ時間窓に分けない
+            fetcher.fetch_window_entry_pages.reset_mock()
+            fetcher.plan_backfill_windows.return_value = []
+            crawler.select_last_reaction_id.return_value = "last_reaction_id"
+            asyncio.run(crawler.pipeline(True))
+            fetcher.fetch_window_entry_pages.assert_not_called()
+            fetcher.fetch_entry_pages.assert_called_once_with("last_reaction_id", True)
+
+            # デバッグ時はキャッシュから読むため時間窓を使わない
+            fetcher.plan_backfill_windows.reset_mock()
+            fetcher.fetch_entry_pages.reset_mock()
+            crawler.backfill_window_db.select_unfinished.reset_mock()
+            fetcher.is_debug = True
+            asyncio.run(crawler.pipeline(True))
+            crawler.backfill_window_db.select_unfinished.assert_not_called()
+            fetcher.plan_backfill_windows.assert_not_awaited()
+            fetcher.fetch_entry_pages.assert_called_once_with("last_reaction_id", True)
+
+    def test_upsert(self):
+        with ExitStack() as stack:
+            crawler = self.get_instance(stack)
+            mock_crawl_state = stack.enter_context(patch("misskey_crawler.crawler.crawler.CrawlState"))
+            page = CrawledPage("@user@misskey.io", "reaction_id_2", ["reaction"], ["note"], ["user"], ["media"])
+
+            crawler.crawl_state_db.select_last_reaction_id.return_value = "reaction_id_1"
+            crawler.upsert(page)
+            crawler.database.transaction.assert_called_once_with()
+            crawler.reaction_db.upsert.assert_called_once_with(["reaction"])
+            crawler.note_db.upsert.assert_called_once_with(["note"])
+            crawler.user_db.upsert.assert_called_once_with(["user"])
+            crawler.media_db.upsert.assert_called_once_with(["media"])
+            mock_crawl_state.assert_called_once()
+            self.assertEqual(("@user@misskey.io", "reaction_id_2"), mock_crawl_state.call_args.args[:2])
+            crawler.crawl_state_db.upsert.assert_called_once_with(mock_crawl_state.return_value)
+            mock_crawl_state.reset_mock()
+
+            # カーソルは後退しない
+            crawler.crawl_state_db.select_last_reaction_id.return_value = "reaction_id_3"
+            crawler.upsert(page)
+            self.assertEqual(("@user@misskey.io", "reaction_id_3"), mock_crawl_state.call_args.args[:2])
+
+            # 時間窓のページなら同じトランザクションで窓のカーソルを進める
+            crawler.backfill_window_db.advance.assert_not_called()
+            page = CrawledPage(
+                "@user@misskey.io",
+                "reaction_id_2",
+                ["reaction"],
+                ["note"],
+                ["user"],
+                ["media"],
+                "w",
+                True,
+                "reaction_id_1",
+            )
+            crawler.upsert(page)
+            crawler.backfill_window_db.advance.assert_called_once_with("w", "reaction_id_1", True)
+
+            # 空のリストは反映しない
+            crawler.reaction_db.upsert.reset_mock()
+            crawler.media_db.upsert.reset_mock()
+            page = CrawledPage("@user@misskey.io", "reaction_id_2", ["reaction"], ["note"], ["user"], [])
+            crawler.upsert(page)
+            crawler.reaction_db.upsert.assert_called_once_with(["reaction"])
+            crawler.media_db.upsert.assert_not_called()
+
+            # 空のページはカーソルと時間窓のみ更新する
+            crawler.reaction_db.upsert.reset_mock()
+            page = CrawledPage("@user@misskey.io", "", [], [], [], [], "w", True)
+            crawler.upsert(page)
+            crawler.reaction_db.upsert.assert_not_called()
+
+            # ID の形式が変わっても生成日時で比較する
+            page = CrawledPage("@user@misskey.io", "01HCDF3GV70000000000000000", [], [], [], [])
+            crawler.crawl_state_db.select_last_reaction_id.return_value = "9ko8xyzq00"
+            crawler.upsert(page)
+            self.assertEqual(("@user@misskey.io", "01HCDF3GV70000000000000000"), mock_crawl_state.call_args.args[:2])
+
+            # 途中で失敗すればカーソルは進めない
+            page = CrawledPage("@user@misskey.io", "reaction_id_2", ["reaction"], ["note"], ["user"], ["media"])
+            crawler.crawl_state_db.upsert.reset_mock()
+            crawler.media_db.upsert.side_effect = ValueError("upsert failed")
+            with self.assertRaises(ValueError):
+                crawler.upsert(page)
+            crawler.crawl_state_db.upsert.assert_not_called()
+
+    def test_log_stats(self):
+        with ExitStack() as stack:
+            crawler = self.get_instance(stack)
+            crawler.stats_dict = {"@user@misskey.io": AccountStats(1, 2, 3)}
+            crawler.log_stats()
+            crawler.stats_dict["@user@misskey.io"].error = MisskeyAPIError(
+                "users/reactions", 401, {"code": "CREDENTIAL_REQUIRED"}
+            )
+            crawler.log_stats()
+            crawler.fetcher_list[0].misskey.scheduler.log_stats.assert_called_with(
+                crawler.fetcher_list[0].account_name
+            )
+            crawler.downloader.log_stats.assert_called_with()
+
+    def test_run(self):
+        with ExitStack() as stack:
+            crawler = self.get_instance(stack)
+            mock_pipeline = stack.enter_context(patch("misskey_crawler.crawler.crawler.Crawler.pipeline"))
+            mock_log_stats = stack.enter_context(patch("misskey_crawler.crawler.crawler.Crawler.log_stats"))
+
+            mock_pipeline.return_value = 1
+            actual = crawler.run()
             self.assertEqual(None, actual)
-            mock_reaction_db().select_last_record.assert_called_once_with()
-            mock_fetcher().fetch.assert_called_once_with(last_reaction_id)
-            mock_downloader().download.assert_called_once()
-            mock_reaction_db().upsert.assert_called_once()
-            mock_note_db().upsert.assert_called_once()
-            mock_user_db().upsert.assert_called_once()
-            mock_media_db().upsert.assert_called_once()
-
-            mock_reaction_db().reset_mock()
-            mock_fetcher().reset_mock()
-            mock_downloader().reset_mock()
-            mock_reaction_db().reset_mock()
-            mock_note_db().reset_mock()
-            mock_user_db().reset_mock()
-            mock_media_db().reset_mock()
-            mock_fetcher().fetch.side_effect = lambda args_last_reaction_id: []
-
-            actual = self.crawler.run()
+            mock_pipeline.assert_called_once_with(False)
+            mock_log_stats.assert_called_once_with()
+            crawler.database.close.assert_called_once_with()
+            mock_pipeline.reset_mock()
+
+            mock_pipeline.return_value = 0
+            actual = crawler.run(True)
             self.assertEqual(None, actual)
-            mock_reaction_db().select_last_record.assert_called_once_with()
-            mock_fetcher().fetch.assert_called_once_with(last_reaction_id)
-            mock_downloader().download.assert_not_called()
-            mock_reaction_db().upsert.assert_not_called()
-            mock_note_db().upsert.assert_not_called()
-            mock_user_db().upsert.assert_not_called()
-            mock_media_db().upsert.assert_not_called()
-        pass
+            mock_pipeline.assert_called_once_with(True)
 
 
 if __name__ == "__main__":
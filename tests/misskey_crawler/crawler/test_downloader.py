@@ -1,14 +1,17 @@
 import asyncio
+import hashlib
+import shutil
 import sys
 import unittest
 from contextlib import ExitStack
 from logging import getLogger
 from pathlib import Path
 
+import httpx
 import orjson
 from mock import AsyncMock, MagicMock, patch
 
-from misskey_crawler.crawler.downloader import Downloader
+from misskey_crawler.crawler.downloader import ByteBudget, ChecksumMismatchError, ConnectionStats, Downloader
 
 logger = getLogger("crawler.downloader")
 
@@ -39,28 +42,670 @@ class TestDownloader(unittest.TestCase):
             downloader = Downloader(self.config_path)
             self.assertEqual(self.save_base_path, downloader.save_base_path)
             self.assertEqual(-1, downloader.save_num)
+            self.assertEqual(-1, downloader.save_bytes)
+            self.assertEqual(True, downloader.http2)
+            self.assertEqual(16, downloader.max_workers)
+            self.assertEqual(32, downloader.max_connections)
+            self.assertEqual(8, downloader.max_connections_per_host)
+            self.assertEqual(30.0, downloader.keepalive_expiry)
+            self.assertEqual(64 * 1024, downloader.chunk_size)
+            self.assertEqual(3, downloader.max_retries)
+            self.assertEqual(False, downloader.content_addressed)
+            self.assertEqual(8 * 1024 * 1024, downloader.large_threshold)
+            self.assertEqual(2, downloader.large_workers)
+            self.assertEqual(256 * 1024 * 1024, downloader.byte_budget.limit)
+            self.assertEqual(16, downloader.byte_budget.slot_num)
+            self.assertIsNone(downloader.client)
 
-    def test_worker(self):
+            config_dict = orjson.loads(self.config_path.read_bytes())
+            config_dict["misskey"]["download"] = {
+                "http2": False,
+                "max_workers": 3,
+                "max_connections": 4,
+                "max_connections_per_host": 2,
+                "keepalive_expiry": 5,
+                "chunk_size": 1024,
+                "max_retries": 1,
+                "content_addressed": True,
+                "large_threshold": 1024,
+                "large_workers": 1,
+                "max_inflight_bytes": 4096,
+            }
+            self.config_path.write_bytes(orjson.dumps(config_dict))
+            downloader = Downloader(self.config_path)
+            self.assertEqual(False, downloader.http2)
+            self.assertEqual(3, downloader.max_workers)
+            self.assertEqual(4, downloader.max_connections)
+            self.assertEqual(2, downloader.max_connections_per_host)
+            self.assertEqual(5.0, downloader.keepalive_expiry)
+            self.assertEqual(1024, downloader.chunk_size)
+            self.assertEqual(1, downloader.max_retries)
+            self.assertEqual(True, downloader.content_addressed)
+            self.assertEqual(1024, downloader.large_threshold)
+            self.assertEqual(1, downloader.large_workers)
+            self.assertEqual(4096, downloader.byte_budget.limit)
+            self.assertEqual(3, downloader.byte_budget.slot_num)
+
+    def test_get_client(self):
+        with ExitStack() as stack:
+            mock_logger_info = stack.enter_context(patch.object(logger, "info"))
+            downloader = Downloader(self.config_path)
+            client = downloader.get_client()
+            self.assertIsInstance(client, httpx.AsyncClient)
+            self.assertIs(client, downloader.get_client())
+            self.loop.run_until_complete(downloader.aclose())
+            self.assertIsNone(downloader.client)
+            self.assertIsNot(client, downloader.get_client())
+            self.loop.run_until_complete(downloader.aclose())
+
+    def test_byte_budget(self):
+        async def run():
+            byte_budget = ByteBudget(100, 2)
+            self.assertEqual(25, byte_budget.small_limit)
+            self.assertEqual(75, byte_budget.large_limit)
+            self.assertEqual(15, await byte_budget.acquire(15))
+            self.assertEqual(10, await byte_budget.acquire(10))
+            self.assertEqual(25, byte_budget.small_in_flight)
+
+            # 小さいファイルの枠が空くまで待機する
+            task = asyncio.create_task(byte_budget.acquire(10))
+            await asyncio.sleep(0.01)
+            self.assertEqual(False, task.done())
+            await byte_budget.release(15)
+            self.assertEqual(10, await task)
+            self.assertEqual(20, byte_budget.small_in_flight)
+
+            # 大きいファイルは large_limit / slot_num までしか確保せず、大きいファイル同士で待たない
+            self.assertEqual(37, await byte_budget.acquire(1000, True))
+            self.assertEqual(30, await byte_budget.acquire(30, True))
+            self.assertEqual(67, byte_budget.large_in_flight)
+            self.assertEqual(87, byte_budget.in_flight)
+
+            # 大きいファイルの枠を超える分は待機する
+            task = asyncio.create_task(byte_budget.acquire(1000, True))
+            await asyncio.sleep(0.01)
+            self.assertEqual(False, task.done())
+
+            # 大きいファイルが取得中でも、小さいファイルは自分の枠で取得を始められる
+            await byte_budget.release(10)
+            await byte_budget.release(10)
+            self.assertEqual(25, await byte_budget.acquire(1000))
+            await byte_budget.release(25)
+
+            await byte_budget.release(30, True)
+            self.assertEqual(37, await task)
+            await byte_budget.release(37, True)
+            await byte_budget.release(37, True)
+            self.assertEqual(0, byte_budget.in_flight)
+            self.assertEqual(0, byte_budget.large_in_flight)
+            self.assertEqual(92, byte_budget.peak)
+
+            byte_budget = ByteBudget(0)
+            self.assertEqual(0, await byte_budget.acquire(1000))
+            self.assertEqual(0, await byte_budget.acquire(1000, True))
+            await byte_budget.release(0)
+            self.assertEqual(0, byte_budget.in_flight)
+
+        self.loop.run_until_complete(run())
+
+    def test_byte_budget_large_file(self):
+        # 予算を超える大きいファイルを取得している間も、小さいファイルは待たずに取得する
+        with ExitStack() as stack:
+            mock_logger_info = stack.enter_context(patch.object(logger, "info"))
+            downloader = Downloader(self.config_path)
+            downloader.large_threshold = 100
+            downloader.byte_budget = ByteBudget(1000, 4)
+            large_content = b"0" * 5000
+            small_content = b"1" * 10
+            large_started = None
+            small_done = None
+
+            async def handler(request: httpx.Request) -> httpx.Response:
+                if request.url.path == "/large.mp4":
+                    large_started.set()
+                    await small_done.wait()
+                    return httpx.Response(200, content=large_content)
+                return httpx.Response(200, content=small_content)
+
+            downloader.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+            large_media = self.make_media("https://s3.arkjp.net/large.mp4", "large.mp4", large_content)
+            small_list = [
+                self.make_media(f"https://s3.arkjp.net/small_{i}.png", f"small_{i}.png", small_content)
+                for i in range(3)
+            ]
+
+            async def run() -> None:
+                nonlocal large_started, small_done
+                large_started = asyncio.Event()
+                small_done = asyncio.Event()
+                large_task = asyncio.create_task(downloader.excute([large_media]))
+                await large_started.wait()
+                self.assertEqual(750 // 4, downloader.byte_budget.large_in_flight)
+                await asyncio.wait_for(downloader.excute(small_list), 1)
+                small_done.set()
+                await large_task
+
+            self.loop.run_until_complete(run())
+            self.assertEqual(large_content, (self.save_base_path / "large.mp4").read_bytes())
+            for media in [large_media, *small_list]:
+                (self.save_base_path / media.get_filename()).unlink(missing_ok=True)
+            self.assertEqual(0, downloader.byte_budget.in_flight)
+
+    def test_is_large(self):
         with ExitStack() as stack:
             mock_logger_info = stack.enter_context(patch.object(logger, "info"))
-            mock_client = stack.enter_context(patch("misskey_crawler.crawler.downloader.httpx.AsyncClient.get"))
+            downloader = Downloader(self.config_path)
+            downloader.large_threshold = 100
+            self.assertEqual(False, downloader.is_large(self.make_media("url", "name.png", b"0" * 99)))
+            self.assertEqual(True, downloader.is_large(self.make_media("url", "name.png", b"0" * 100)))
+            self.assertEqual(True, downloader.is_large(self.make_media("url", "name.png")))
 
-            async def get_mock(url: str):
-                r = MagicMock()
-                r.content = url.encode()
-                return r
+    def test_get_host_semaphore(self):
+        with ExitStack() as stack:
+            mock_logger_info = stack.enter_context(patch.object(logger, "info"))
+            downloader = Downloader(self.config_path)
+            semaphore = downloader.get_host_semaphore("s3.arkjp.net")
+            self.assertIs(semaphore, downloader.get_host_semaphore("s3.arkjp.net"))
+            self.assertIsNot(semaphore, downloader.get_host_semaphore("media.misskeyusercontent.jp"))
 
-            mock_client.side_effect = get_mock
+    def test_get_tracer(self):
+        stats = ConnectionStats()
+        trace = Downloader.get_tracer(stats)
+        event_list = [
+            "connection.connect_tcp.started",
+            "connection.connect_tcp.complete",
+            "connection.start_tls.complete",
+            "http2.send_request_headers.started",
+            "http2.send_request_headers.complete",
+            "http2.send_request_headers.started",
+            "http11.send_request_headers.started",
+        ]
+        for event_name in event_list:
+            self.loop.run_until_complete(trace(event_name, {}))
+        self.assertEqual(ConnectionStats(3, 1), stats)
+        self.assertEqual(2, stats.reused_num())
+        self.assertEqual(0, ConnectionStats(1, 2).reused_num())
 
+    def test_worker(self):
+        with ExitStack() as stack:
+            mock_logger_info = stack.enter_context(patch.object(logger, "info"))
             downloader = Downloader(self.config_path)
+
+            def handler(request: httpx.Request) -> httpx.Response:
+                return httpx.Response(200, content=str(request.url).encode())
+
+            downloader.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
             filename = "media_filename.png"
-            media = MagicMock()
-            media.url = "media_url"
-            media.get_filename.return_value = filename
+            media = self.make_media("https://s3.arkjp.net/misskey/media_url.png", filename)
+            self.loop.run_until_complete(downloader.worker(media))
+
+            filepath = self.save_base_path / filename
+            self.assertEqual(True, filepath.exists())
+            self.assertEqual(media.url.encode(), filepath.read_bytes())
+            self.assertIn("s3.arkjp.net", downloader.connection_stats_dict)
+
+            # 既に存在するファイルは取得しない
+            downloader.client = MagicMock()
+            self.loop.run_until_complete(downloader.worker(media))
+            downloader.client.stream.assert_not_called()
+            filepath.unlink(missing_ok=True)
+
+            def error_handler(request: httpx.Request) -> httpx.Response:
+                return httpx.Response(404)
+
+            downloader.client = httpx.AsyncClient(transport=httpx.MockTransport(error_handler))
+            with self.assertRaises(httpx.HTTPStatusError):
+                self.loop.run_until_complete(downloader.worker(media))
+            self.assertEqual(False, filepath.exists())
+
+    def make_media(self, url: str, filename: str, content: bytes | None = None, type: str = "") -> MagicMock:
+        """content を指定すると、その size と md5 を持つメディアを返す"""
+        media = MagicMock()
+        media.url = url
+        media.type = type
+        media.get_filename.return_value = filename
+        media.md5 = hashlib.md5(content).hexdigest() if content is not None else ""
+        media.size = len(content) if content is not None else -1
+        return media
+
+    def make_range_handler(self, content: bytes, etag: str = '"etag"', support_range: bool = True):
+        """Range と If-Range を解釈するサーバのハンドラを返す、受け取ったリクエストは request_list に記録する"""
+        request_list = []
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            request_list.append(request)
+            headers = {"ETag": etag} if etag else {}
+            range_header = request.headers.get("Range", "")
+            if support_range and range_header and request.headers.get("If-Range") == etag:
+                start = int(range_header.removeprefix("bytes=").removesuffix("-"))
+                if start >= len(content):
+                    return httpx.Response(416, headers=headers)
+                headers["Content-Range"] = f"bytes {start}-{len(content) - 1}/{len(content)}"
+                return httpx.Response(206, headers=headers, content=content[start:])
+            return httpx.Response(200, headers=headers, content=content)
+
+        return handler, request_list
+
+    def write_part(self, filepath: Path, url: str, part: bytes, validator: str = '"etag"') -> None:
+        Downloader.get_part_path(filepath).write_bytes(part)
+        Downloader.get_meta_path(filepath).write_bytes(orjson.dumps({"url": url, "validator": validator}))
+
+    def test_get_validator(self):
+        response = httpx.Response(200, headers={"ETag": '"etag"', "Last-Modified": "last_modified"})
+        self.assertEqual('"etag"', Downloader.get_validator(response))
+        response = httpx.Response(200, headers={"ETag": 'W/"etag"', "Last-Modified": "last_modified"})
+        self.assertEqual("last_modified", Downloader.get_validator(response))
+        response = httpx.Response(200)
+        self.assertEqual("", Downloader.get_validator(response))
+
+    def test_is_resumed(self):
+        response = httpx.Response(206, headers={"Content-Range": "bytes 10-99/100"})
+        self.assertEqual(True, Downloader.is_resumed(response, 10))
+        self.assertEqual(False, Downloader.is_resumed(response, 20))
+        self.assertEqual(False, Downloader.is_resumed(response, 0))
+        response = httpx.Response(200)
+        self.assertEqual(False, Downloader.is_resumed(response, 10))
+
+    def test_load_part(self):
+        with ExitStack() as stack:
+            mock_logger_info = stack.enter_context(patch.object(logger, "info"))
+            downloader = Downloader(self.config_path)
+            filepath = self.save_base_path / "media_filename.png"
+            url = "https://s3.arkjp.net/misskey/media_url.png"
+            self.assertEqual((0, ""), downloader.load_part(filepath, url))
+
+            self.write_part(filepath, url, b"0123456789")
+            self.assertEqual((10, '"etag"'), downloader.load_part(filepath, url))
+            self.assertEqual((0, ""), downloader.load_part(filepath, "https://other.example/media_url.png"))
+
+            self.write_part(filepath, url, b"0123456789", validator="")
+            self.assertEqual((0, ""), downloader.load_part(filepath, url))
+
+            Downloader.get_meta_path(filepath).write_bytes(b"invalid json")
+            self.assertEqual((0, ""), downloader.load_part(filepath, url))
+
+            downloader.discard_part(filepath)
+            self.assertEqual(False, Downloader.get_part_path(filepath).exists())
+            self.assertEqual(False, Downloader.get_meta_path(filepath).exists())
+
+    def test_fetch(self):
+        with ExitStack() as stack:
+            mock_logger_info = stack.enter_context(patch.object(logger, "info"))
+            downloader = Downloader(self.config_path)
+            downloader.chunk_size = 10
+            filepath = self.save_base_path / "media_filename.png"
+            part_path = Downloader.get_part_path(filepath)
+            meta_path = Downloader.get_meta_path(filepath)
+            url = "https://s3.arkjp.net/misskey/media_url.png"
+            content = b"0123456789" * 10
+
+            media = self.make_media(url, filepath.name, content)
+
+            def fetch(handler) -> bool:
+                client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+                return self.loop.run_until_complete(downloader.fetch(client, media, filepath, ConnectionStats()))
+
+            # 新規に取得
+            handler, request_list = self.make_range_handler(content)
+            self.assertEqual(True, fetch(handler))
+            self.assertEqual(content, filepath.read_bytes())
+            self.assertNotIn("Range", request_list[0].headers)
+            self.assertEqual(False, part_path.exists())
+            self.assertEqual(False, meta_path.exists())
+            filepath.unlink()
+
+            # .part の続きから取得
+            self.write_part(filepath, url, content[:40])
+            self.assertEqual(True, fetch(handler))
+            self.assertEqual(content, filepath.read_bytes())
+            self.assertEqual("bytes=40-", request_list[-1].headers["Range"])
+            self.assertEqual('"etag"', request_list[-1].headers["If-Range"])
+            self.assertEqual(False, part_path.exists())
+            filepath.unlink()
+
+            # Range に対応していないサーバなら最初から取得し直す
+            handler, request_list = self.make_range_handler(content, support_range=False)
+            self.write_part(filepath, url, content[:40])
+            self.assertEqual(True, fetch(handler))
+            self.assertEqual(content, filepath.read_bytes())
+            filepath.unlink()
+
+            # 検証子が変わっていれば最初から取得し直す
+            handler, request_list = self.make_range_handler(content, etag='"new_etag"')
+            self.write_part(filepath, url, b"old_content")
+            self.assertEqual(True, fetch(handler))
+            self.assertEqual(content, filepath.read_bytes())
+            filepath.unlink()
+
+            # 416 なら .part を破棄する
+            handler, request_list = self.make_range_handler(content)
+            self.write_part(filepath, url, content + b"extra")
+            self.assertEqual(False, fetch(handler))
+            self.assertEqual(False, filepath.exists())
+            self.assertEqual(False, part_path.exists())
+            self.assertEqual(False, meta_path.exists())
+
+            # 途中で失敗した場合は .part と検証子を残す
+            async def broken_content():
+                yield content[:30]
+                raise httpx.ReadError("connection reset")
+
+            def broken_handler(request: httpx.Request) -> httpx.Response:
+                return httpx.Response(200, headers={"ETag": '"etag"'}, content=broken_content())
+
+            with self.assertRaises(httpx.ReadError):
+                fetch(broken_handler)
+            self.assertEqual(False, filepath.exists())
+            self.assertEqual(content[:30], part_path.read_bytes())
+            self.assertEqual((30, '"etag"'), downloader.load_part(filepath, url))
+            downloader.discard_part(filepath)
+
+    def test_is_saved(self):
+        with ExitStack() as stack:
+            mock_logger_info = stack.enter_context(patch.object(logger, "info"))
+            downloader = Downloader(self.config_path)
+            filepath = self.save_base_path / "media_filename.png"
+            url = "https://s3.arkjp.net/misskey/media_url.png"
+            content = b"0123456789" * 10
+            media = self.make_media(url, filepath.name, content)
+            self.assertEqual(False, downloader.is_saved(media, filepath))
+
+            filepath.write_bytes(content)
+            self.assertEqual(True, downloader.is_saved(media, filepath))
+            self.assertEqual(True, downloader.checksum_cache.is_accepted(filepath, media.md5))
+
+            # 破損したファイルは未保存とする
+            filepath.write_bytes(b"9" + content[1:])
+            self.assertEqual(False, downloader.is_saved(media, filepath))
+            filepath.write_bytes(content[:50])
+            self.assertEqual(False, downloader.is_saved(media, filepath))
+
+            # md5 が分からないメディアは存在するだけで保存済みとする
+            media = self.make_media(url, filepath.name)
+            self.assertEqual(True, downloader.is_saved(media, filepath))
+
+            # 変換後のファイルとして fetch が受け入れ済みなら、サイズが異なっても保存済みとする
+            media = self.make_media(url, filepath.name, content + b"original", "image/jpeg")
+            downloader.checksum_cache.set(filepath, "converted_md5", media.md5)
+            self.assertEqual(True, downloader.is_saved(media, filepath))
+
+            # チェックサムの記録がなければ、変換されうる画像でもサイズが異なるファイルは途中で切れたものとする
+            downloader.checksum_cache.discard(filepath)
+            media = self.make_media(url, filepath.name, content + b"original", "image/jpeg")
+            self.assertEqual(False, downloader.is_saved(media, filepath))
+            media = self.make_media(url, filepath.name, content + b"original", "video/mp4")
+            self.assertEqual(False, downloader.is_saved(media, filepath))
+            filepath.unlink()
+
+    def test_verify(self):
+        with ExitStack() as stack:
+            mock_logger_info = stack.enter_context(patch.object(logger, "info"))
+            downloader = Downloader(self.config_path)
+            part_path = self.save_base_path / "media_filename.png.part"
+            url = "https://s3.arkjp.net/misskey/media_url.png"
+            content = b"0123456789" * 10
+            md5 = hashlib.md5(content).hexdigest()
+            part_path.write_bytes(content)
+
+            media = self.make_media(url, "media_filename.png", content)
+            downloader.verify(media, part_path, md5)
+            with self.assertRaises(ChecksumMismatchError):
+                downloader.verify(media, part_path, "invalid_md5")
+
+            # 配信用に変換された画像、md5 が分からないメディアは検証しない
+            media = self.make_media(url, "media_filename.png", content + b"original", "image/png")
+            downloader.verify(media, part_path, "invalid_md5")
+            media = self.make_media(url, "media_filename.png")
+            downloader.verify(media, part_path, "invalid_md5")
+
+            # 変換されない種類のメディアでサイズが異なるものは、途中で切れたものとして md5 の検証で失敗する
+            media = self.make_media(url, "media_filename.png", content + b"original", "video/mp4")
+            with self.assertRaises(ChecksumMismatchError):
+                downloader.verify(media, part_path, md5)
+            media = self.make_media(url, "media_filename.png", content + b"original", "image/gif")
+            with self.assertRaises(ChecksumMismatchError):
+                downloader.verify(media, part_path, md5)
+            part_path.unlink()
+
+    def test_is_converted(self):
+        media = self.make_media("https://s3.arkjp.net/misskey/media_url.png", "media_filename.png", b"0" * 100)
+        for media_type, file_size, expect in [
+            ("image/jpeg", 50, True),
+            ("image/webp", 150, True),
+            ("image/jpeg", 100, False),
+            ("image/gif", 50, False),
+            ("video/mp4", 50, False),
+        ]:
+            media.type = media_type
+            self.assertEqual(expect, Downloader.is_converted(media, file_size))
+        media.size = -1
+        media.type = "image/jpeg"
+        self.assertEqual(False, Downloader.is_converted(media, 50))
+
+    def test_worker_checksum(self):
+        with ExitStack() as stack:
+            mock_logger_info = stack.enter_context(patch("misskey_crawler.crawler.downloader.logger.info"))
+            mock_logger_warning = stack.enter_context(patch("misskey_crawler.crawler.downloader.logger.warning"))
+            mock_sleep = stack.enter_context(patch("misskey_crawler.crawler.downloader.asyncio.sleep"))
+            downloader = Downloader(self.config_path)
+            downloader.max_retries = 1
+            filepath = self.save_base_path / "media_filename.png"
+            content = b"0123456789" * 10
+            broken_content = b"9" + content[1:]
+            response_list = [broken_content, content]
+
+            def handler(request: httpx.Request) -> httpx.Response:
+                return httpx.Response(200, content=response_list.pop(0))
+
+            downloader.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+            media = self.make_media("https://s3.arkjp.net/misskey/media_url.png", filepath.name, content)
+
+            # 破損したファイルが保存済みなら取得し直し、md5 が一致しなければリトライする
+            filepath.write_bytes(broken_content)
+            self.loop.run_until_complete(downloader.worker(media))
+            self.assertEqual(content, filepath.read_bytes())
+            self.assertEqual([], response_list)
+            mock_sleep.assert_awaited_once_with(1)
+            self.assertEqual(True, downloader.checksum_cache.is_accepted(filepath, media.md5))
+            filepath.unlink()
+
+            # 途中で切れたボディも md5 が一致しないためリトライする
+            mock_sleep.reset_mock()
+            response_list = [content[:50], content]
+            self.loop.run_until_complete(downloader.worker(media))
+            self.assertEqual(content, filepath.read_bytes())
+            mock_sleep.assert_awaited_once_with(1)
+            filepath.unlink()
+
+            # リトライ上限まで一致しなければ例外を送出し、.part は残さない
+            response_list = [broken_content, broken_content]
+            with self.assertRaises(ChecksumMismatchError):
+                self.loop.run_until_complete(downloader.worker(media))
+            self.assertEqual(False, filepath.exists())
+            self.assertEqual(False, Downloader.get_part_path(filepath).exists())
+
+    def test_get_store_path(self):
+        with ExitStack() as stack:
+            mock_logger_info = stack.enter_context(patch.object(logger, "info"))
+            downloader = Downloader(self.config_path)
+            media = self.make_media("https://s3.arkjp.net/misskey/media_url.png", "note_media_name.png", b"content")
+            actual = downloader.get_store_path(media)
+            expect = self.save_base_path / ".store" / media.md5[:2] / f"{media.md5}.png"
+            self.assertEqual(expect, actual)
+
+    def test_get_md5_lock(self):
+        with ExitStack() as stack:
+            mock_logger_info = stack.enter_context(patch.object(logger, "info"))
+            downloader = Downloader(self.config_path)
+            lock = downloader.get_md5_lock("md5_1")
+            self.assertIs(lock, downloader.get_md5_lock("md5_1"))
+            self.assertIsNot(lock, downloader.get_md5_lock("md5_2"))
+
+    def test_link(self):
+        with ExitStack() as stack:
+            mock_logger_info = stack.enter_context(patch.object(logger, "info"))
+            downloader = Downloader(self.config_path)
+            store_path = self.save_base_path / "store_media.png"
+            filepath = self.save_base_path / "media_filename.png"
+            store_path.write_bytes(b"content")
+            downloader.checksum_cache.set(store_path, "md5", "media_md5")
+
+            downloader.link(store_path, filepath)
+            self.assertEqual(True, filepath.samefile(store_path))
+            self.assertEqual(False, filepath.is_symlink())
+            self.assertEqual(True, downloader.checksum_cache.is_accepted(filepath, "media_md5"))
+
+            # ハードリンクが使えなければシンボリックリンクにする
+            with patch("misskey_crawler.crawler.downloader.os.link", side_effect=OSError):
+                downloader.link(store_path, filepath)
+            self.assertEqual(True, filepath.is_symlink())
+            self.assertEqual(True, filepath.samefile(store_path))
+
+            # どちらも使えなければコピーする
+            with ExitStack() as inner_stack:
+                inner_stack.enter_context(patch("misskey_crawler.crawler.downloader.os.link", side_effect=OSError))
+                inner_stack.enter_context(patch.object(Path, "symlink_to", side_effect=OSError))
+                downloader.link(store_path, filepath)
+            self.assertEqual(False, filepath.is_symlink())
+            self.assertEqual(False, filepath.samefile(store_path))
+            self.assertEqual(b"content", filepath.read_bytes())
+            self.assertEqual(True, downloader.checksum_cache.is_accepted(filepath, "media_md5"))
+            filepath.unlink()
+            store_path.unlink()
+
+    def test_worker_content_addressed(self):
+        with ExitStack() as stack:
+            mock_logger_info = stack.enter_context(patch("misskey_crawler.crawler.downloader.logger.info"))
+            downloader = Downloader(self.config_path)
+            downloader.content_addressed = True
+            content = b"0123456789" * 10
+            request_list = []
+
+            async def handler(request: httpx.Request) -> httpx.Response:
+                request_list.append(request)
+                await asyncio.sleep(0.01)
+                return httpx.Response(200, content=content)
+
+            downloader.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+            media_list = [
+                self.make_media(f"https://host{i}.example/media_url.png", f"note_{i}_media.png", content)
+                for i in range(3)
+            ]
+            self.loop.run_until_complete(downloader.excute(media_list))
+
+            # 同じ md5 のメディアは1度だけ取得し、ノートごとのファイルはストアへのリンクになる
+            self.assertEqual(1, len(request_list))
+            self.assertEqual(2, downloader.dedup_num)
+            store_path = downloader.get_store_path(media_list[0])
+            for i in range(3):
+                filepath = self.save_base_path / f"note_{i}_media.png"
+                self.assertEqual(True, filepath.samefile(store_path))
+                self.assertEqual(content, filepath.read_bytes())
+
+            # 保存済みならストアも参照しない
+            self.loop.run_until_complete(downloader.excute(media_list))
+            self.assertEqual(1, len(request_list))
+            self.assertEqual(2, downloader.dedup_num)
+
+            # md5 が分からないメディアはストアを使わない
+            media = self.make_media("https://host3.example/media_url.png", "note_3_media.png")
+            self.loop.run_until_complete(downloader.worker(media))
+            self.assertEqual(2, len(request_list))
+            self.assertEqual(1, (self.save_base_path / "note_3_media.png").stat().st_nlink)
+
+            for i in range(4):
+                (self.save_base_path / f"note_{i}_media.png").unlink()
+            shutil.rmtree(self.save_base_path / ".store")
+
+    def test_worker_resume(self):
+        with ExitStack() as stack:
+            mock_logger_info = stack.enter_context(patch.object(logger, "info"))
+            mock_logger_warning = stack.enter_context(patch("misskey_crawler.crawler.downloader.logger.warning"))
+            mock_sleep = stack.enter_context(patch("misskey_crawler.crawler.downloader.asyncio.sleep"))
+            downloader = Downloader(self.config_path)
+            downloader.max_retries = 2
+            downloader.chunk_size = 10
+            filepath = self.save_base_path / "media_filename.png"
+            content = b"0123456789" * 10
+            range_handler, request_list = self.make_range_handler(content)
+            call_count = 0
+
+            async def broken_content():
+                yield content[:30]
+                raise httpx.ReadError("connection reset")
+
+            def handler(request: httpx.Request) -> httpx.Response:
+                nonlocal call_count
+                call_count += 1
+                if call_count == 1:
+                    return httpx.Response(200, headers={"ETag": '"etag"'}, content=broken_content())
+                return range_handler(request)
+
+            downloader.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+            media = self.make_media("https://s3.arkjp.net/misskey/media_url.png", filepath.name, content)
             self.loop.run_until_complete(downloader.worker(media))
+            self.assertEqual(content, filepath.read_bytes())
+            self.assertEqual("bytes=30-", request_list[-1].headers["Range"])
+            mock_sleep.assert_awaited_once_with(1)
+            filepath.unlink()
 
-            self.assertEqual(True, (self.save_base_path / filename).exists())
-            (self.save_base_path / filename).unlink(missing_ok=True)
+            # リトライ上限に達したら例外を送出し、.part は次回のために残す
+            def always_broken_handler(request: httpx.Request) -> httpx.Response:
+                raise httpx.ConnectError("connection refused")
+
+            mock_sleep.reset_mock()
+            downloader.client = httpx.AsyncClient(transport=httpx.MockTransport(always_broken_handler))
+            self.write_part(filepath, media.url, content[:30])
+            with self.assertRaises(httpx.ConnectError):
+                self.loop.run_until_complete(downloader.worker(media))
+            self.assertEqual(2, mock_sleep.await_count)
+            self.assertEqual(content[:30], Downloader.get_part_path(filepath).read_bytes())
+            downloader.discard_part(filepath)
+
+    def test_worker_per_host_limit(self):
+        with ExitStack() as stack:
+            mock_logger_info = stack.enter_context(patch.object(logger, "info"))
+            downloader = Downloader(self.config_path)
+            downloader.max_connections_per_host = 2
+            in_flight_dict = {}
+            max_in_flight_dict = {}
+
+            async def handler(request: httpx.Request) -> httpx.Response:
+                host = request.url.host
+                in_flight_dict[host] = in_flight_dict.get(host, 0) + 1
+                max_in_flight_dict[host] = max(max_in_flight_dict.get(host, 0), in_flight_dict[host])
+                await asyncio.sleep(0.01)
+                in_flight_dict[host] -= 1
+                return httpx.Response(200, content=b"content")
+
+            downloader.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+            media_list = []
+            for i in range(6):
+                media = self.make_media(f"https://host{i % 2}.example/media_{i}.png", f"media_filename_{i}.png")
+                media_list.append(media)
+            self.loop.run_until_complete(downloader.excute(media_list))
+            self.assertEqual({"host0.example": 2, "host1.example": 2}, max_in_flight_dict)
+            for i in range(6):
+                (self.save_base_path / f"media_filename_{i}.png").unlink(missing_ok=True)
+
+    def test_log_stats(self):
+        with ExitStack() as stack:
+            mock_logger_info = stack.enter_context(patch("misskey_crawler.crawler.downloader.logger.info"))
+            downloader = Downloader(self.config_path)
+            downloader.byte_budget.limit = 0
+            downloader.connection_stats_dict = {"s3.arkjp.net": ConnectionStats(100, 2)}
+            downloader.log_stats()
+            mock_logger_info.assert_called_with("s3.arkjp.net : 100 request(s) over 2 connection(s), 98 reused.")
+
+            downloader.content_addressed = True
+            downloader.dedup_num = 3
+            downloader.log_stats()
+            mock_logger_info.assert_called_with("Content addressed store : 3 media deduplicated.")
+
+            downloader.byte_budget = ByteBudget(1000)
+            downloader.byte_budget.peak = 500
+            downloader.log_stats()
+            mock_logger_info.assert_called_with("Peak in-flight : 500 / 1000 [bytes].")
 
     def test_excute(self):
         with ExitStack() as stack:
@@ -73,10 +718,139 @@ class TestDownloader(unittest.TestCase):
             mock_worker.side_effect = worker
 
             downloader = Downloader(self.config_path)
-            media_list = ["media_list"]
+            media_list = [self.make_media("media_url", "media_filename.png", b"content")]
             self.loop.run_until_complete(downloader.excute(media_list))
             mock_worker.assert_called_once_with(media_list[0])
 
+            # ワーカー数を超えて同時に実行しない
+            in_flight = 0
+            max_in_flight = 0
+
+            async def slow_worker(media):
+                nonlocal in_flight, max_in_flight
+                in_flight += 1
+                max_in_flight = max(max_in_flight, in_flight)
+                await asyncio.sleep(0.01)
+                in_flight -= 1
+
+            mock_worker.reset_mock()
+            mock_worker.side_effect = slow_worker
+            downloader.max_workers = 3
+            media_list = [self.make_media(f"media_url_{i}", f"media_{i}.png", b"content") for i in range(10)]
+            self.loop.run_until_complete(downloader.excute(media_list))
+            self.assertEqual(10, mock_worker.call_count)
+            self.assertEqual(3, max_in_flight)
+
+            # 小さいファイルが残っている間、大きいファイルは large_workers 個までしか同時に取得しない
+            large_in_flight = 0
+            max_large_in_flight = 0
+            small_started = 0
+            order_list = []
+            small_done = asyncio.Event()
+
+            async def lane_worker(media):
+                nonlocal large_in_flight, max_large_in_flight, small_started
+                is_large = downloader.is_large(media)
+                large_in_flight += is_large
+                small_started += not is_large
+                if small_started < len(small_list):
+                    max_large_in_flight = max(max_large_in_flight, large_in_flight)
+                if is_large:
+                    # 大きいファイルは小さいファイルがすべて終わるまで取得中のままにする
+                    await small_done.wait()
+                else:
+                    await asyncio.sleep(0)
+                large_in_flight -= is_large
+                order_list.append(media.url)
+                if sum(url.startswith("small_") for url in order_list) == len(small_list):
+                    small_done.set()
+
+            mock_worker.reset_mock()
+            mock_worker.side_effect = lane_worker
+            downloader.max_workers = 4
+            downloader.large_workers = 2
+            downloader.large_threshold = 100
+            large_list = [self.make_media(f"large_{i}", f"large_{i}.mp4", b"0" * 100) for i in range(4)]
+            small_list = [self.make_media(f"small_{i}", f"small_{i}.png", b"0" * 10) for i in range(20)]
+            self.loop.run_until_complete(downloader.excute(large_list + small_list))
+            self.assertEqual(24, mock_worker.call_count)
+            self.assertEqual(2, max_large_in_flight)
+            self.assertEqual([f"small_{i}" for i in range(20)], order_list[:20])
+
+            # 失敗したメディアがあっても残りは処理して、最後に例外を送出する
+            media_list = [self.make_media(f"media_url_{i}", f"media_{i}.png", b"content") for i in range(5)]
+
+            async def error_worker(media):
+                if media is media_list[1]:
+                    raise ValueError("download failed")
+
+            mock_worker.reset_mock()
+            mock_worker.side_effect = error_worker
+            with ExitStack() as inner_stack:
+                mock_logger_warning = inner_stack.enter_context(
+                    patch("misskey_crawler.crawler.downloader.logger.warning")
+                )
+                with self.assertRaises(ValueError):
+                    self.loop.run_until_complete(downloader.excute(media_list))
+            self.assertEqual(5, mock_worker.call_count)
+
+            mock_worker.reset_mock()
+            self.loop.run_until_complete(downloader.excute([]))
+            mock_worker.assert_not_called()
+
+    def test_serve(self):
+        with ExitStack() as stack:
+            mock_logger_info = stack.enter_context(patch.object(logger, "info"))
+            mock_logger_warning = stack.enter_context(patch("misskey_crawler.crawler.downloader.logger.warning"))
+            mock_worker = stack.enter_context(patch("misskey_crawler.crawler.downloader.Downloader.worker"))
+            downloader = Downloader(self.config_path)
+            downloader.max_workers = 2
+            downloader.large_workers = 1
+            in_flight = 0
+            max_in_flight = 0
+            release_event = None
+
+            async def worker(media):
+                nonlocal in_flight, max_in_flight
+                in_flight += 1
+                max_in_flight = max(max_in_flight, in_flight)
+                if media.url == "media_url_0":
+                    await release_event.wait()
+                await asyncio.sleep(0)
+                in_flight -= 1
+                if media.url == "media_url_3":
+                    raise ValueError("download failed")
+
+            mock_worker.side_effect = worker
+            media_list = [self.make_media(f"media_url_{i}", f"media_{i}.png", b"content") for i in range(4)]
+
+            async def run() -> None:
+                nonlocal release_event
+                release_event = asyncio.Event()
+                serve_task = asyncio.create_task(downloader.serve())
+                # 1回目の完了を待たずに2回目のメディアも同じワーカーで取得する
+                future1 = await downloader.submit(media_list[:2])
+                future2 = await downloader.submit(media_list[2:3])
+                await future2
+                self.assertFalse(future1.done())
+                release_event.set()
+                await future1
+
+                # 失敗したメディアは後からの submit の future にだけ例外を設定する
+                future3 = await downloader.submit(media_list[3:])
+                await asyncio.wait([future3])
+                self.assertIsInstance(future3.exception(), ValueError)
+                empty_future = await downloader.submit([])
+                self.assertTrue(empty_future.done())
+
+                await downloader.close_lanes()
+                await serve_task
+                self.assertIsNone(downloader.lanes)
+
+            self.loop.run_until_complete(run())
+            self.assertEqual(4, mock_worker.call_count)
+            self.assertEqual(2, max_in_flight)
+
     def test_download(self):
         with ExitStack() as stack:
             mock_logger_info = stack.enter_context(patch.object(logger, "info"))
@@ -84,8 +858,16 @@ class TestDownloader(unittest.TestCase):
 
             downloader = Downloader(self.config_path)
             media_list = ["media_list"]
+            mock_aclose = stack.enter_context(patch("misskey_crawler.crawler.downloader.Downloader.aclose"))
             actual = downloader.download(media_list)
             mock_excute.assert_called_once_with(media_list)
+            mock_aclose.assert_awaited_once_with()
+
+            mock_aclose.reset_mock()
+            mock_excute.side_effect = ValueError
+            with self.assertRaises(ValueError):
+                actual = downloader.download(media_list)
+            mock_aclose.assert_awaited_once_with()
 
 
 if __name__ == "__main__":
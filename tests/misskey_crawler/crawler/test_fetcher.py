@@ -1,3 +1,4 @@
+import asyncio
 import sys
 import unittest
 from contextlib import ExitStack
@@ -7,9 +8,12 @@ from pathlib import Path
 
 import freezegun
 import orjson
-from mock import patch
+from mock import AsyncMock, MagicMock, call, patch
 
 from misskey_crawler.crawler.fetcher import Fetcher
+from misskey_crawler.db.model import BackfillWindow
+from misskey_crawler.util import to_epoch_ms
+from misskey_crawler.util.misskey_id import decode_time, encode_boundary
 
 logger = getLogger("crawler.fetcher")
 
@@ -29,13 +33,278 @@ class TestFetcher(unittest.TestCase):
     def tearDown(self) -> None:
         self.config_path.unlink(missing_ok=True)
 
+    async def collect(self, async_iter) -> list:
+        return [page async for page in async_iter]
+
+    async def collect_window_pages(self, fetcher: Fetcher, window_list: list[BackfillWindow]) -> list:
+        queue = asyncio.Queue()
+        await fetcher.fetch_window_entry_pages(window_list, queue)
+        return [queue.get_nowait() for _ in range(queue.qsize())]
+
     def test_init(self):
         with ExitStack() as stack:
             mock_logger_info = stack.enter_context(patch.object(logger, "info"))
             mock_misskey = stack.enter_context(patch("misskey_crawler.crawler.fetcher.MisskeyManager"))
+            mock_scheduler = stack.enter_context(patch("misskey_crawler.crawler.fetcher.RequestScheduler"))
             fetcher = Fetcher(self.config_path)
-            mock_misskey.assert_called_once_with("misskey.io", "misskey_token")
+            mock_scheduler.create.assert_called_once_with({})
+            mock_misskey.assert_called_once_with("misskey.io", "misskey_token", mock_scheduler.create.return_value)
             self.assertEqual(False, fetcher.is_debug)
+            self.assertEqual(0, fetcher.account_index)
+
+            mock_scheduler.reset_mock()
+            mock_misskey.reset_mock()
+            config_dict = {
+                "misskey": {
+                    "accounts": [
+                        {"instance": "misskey.io", "token": "misskey_token_1"},
+                        {"instance": "misskey.example", "token": "misskey_token_2", "rate_limit": {"rate": 1.0}},
+                    ],
+                    "rate_limit": {"rate": 2.0, "burst": 5},
+                }
+            }
+            self.config_path.write_bytes(orjson.dumps(config_dict))
+            fetcher = Fetcher(self.config_path, account_index=1)
+            mock_scheduler.create.assert_called_once_with({"rate": 1.0, "burst": 5})
+            mock_misskey.assert_called_once_with(
+                "misskey.example", "misskey_token_2", mock_scheduler.create.return_value
+            )
+            self.assertEqual(1, fetcher.account_index)
+
+    def test_get_account_list(self):
+        config_dict = {"misskey": {"instance": "misskey.io", "token": "misskey_token"}}
+        actual = Fetcher.get_account_list(config_dict)
+        self.assertEqual([{"instance": "misskey.io", "token": "misskey_token"}], actual)
+
+        account_list = [
+            {"instance": "misskey.io", "token": "misskey_token_1"},
+            {"instance": "misskey.example", "token": "misskey_token_2"},
+        ]
+        config_dict = {"misskey": {"accounts": account_list}}
+        actual = Fetcher.get_account_list(config_dict)
+        self.assertEqual(account_list, actual)
+
+    def test_create_list(self):
+        with ExitStack() as stack:
+            mock_logger_info = stack.enter_context(patch.object(logger, "info"))
+            mock_misskey = stack.enter_context(patch("misskey_crawler.crawler.fetcher.MisskeyManager"))
+            actual = Fetcher.create_list(self.config_path)
+            self.assertEqual(1, len(actual))
+            self.assertEqual(0, actual[0].account_index)
+
+            config_dict = {
+                "misskey": {
+                    "accounts": [
+                        {"instance": "misskey.io", "token": "misskey_token_1"},
+                        {"instance": "misskey.example", "token": "misskey_token_2"},
+                    ]
+                }
+            }
+            self.config_path.write_bytes(orjson.dumps(config_dict))
+            actual = Fetcher.create_list(self.config_path)
+            self.assertEqual([0, 1], [fetcher.account_index for fetcher in actual])
+
+    def test_get_account_name(self):
+        with ExitStack() as stack:
+            mock_logger_info = stack.enter_context(patch.object(logger, "info"))
+            mock_misskey = stack.enter_context(patch("misskey_crawler.crawler.fetcher.MisskeyManager"))
+            mock_misskey.return_value.i = AsyncMock(return_value={"username": "user"})
+            mock_misskey.return_value.instance_name = "misskey.io"
+            fetcher = Fetcher(self.config_path)
+            actual = asyncio.run(fetcher.get_account_name())
+            self.assertEqual("@user@misskey.io", actual)
+            self.assertEqual("@user@misskey.io", fetcher.account_name)
+
+    def test_fetch_entry_pages(self):
+        with ExitStack() as stack:
+            freeze_gun = stack.enter_context(freezegun.freeze_time("2023/09/11 00:00:00"))
+            mock_logger_info = stack.enter_context(patch.object(logger, "info"))
+            mock_misskey = stack.enter_context(patch("misskey_crawler.crawler.fetcher.MisskeyManager"))
+            mock_save_cache = stack.enter_context(patch("misskey_crawler.crawler.fetcher.Fetcher._save_cache"))
+
+            def make_page(start: int, num: int) -> list[dict]:
+                return [{"id": f"reaction_{i:04}"} for i in range(start, start + num)]
+
+            fetcher = Fetcher(self.config_path, False)
+            fetcher.page_limit = 2
+
+            # sinceId をたどって新しい方向へページング、page_limit 未満のページでは止めず空になるまで続ける
+            forward_pages = {
+                "reaction_0000": make_page(1, 2),
+                "reaction_0002": make_page(3, 1),
+                "reaction_0003": make_page(4, 2),
+            }
+            mock_misskey().notes_with_reactions = AsyncMock(
+                side_effect=lambda limit, last_since_id: forward_pages.get(last_since_id, [])
+            )
+            actual = asyncio.run(self.collect(fetcher.fetch_entry_pages("reaction_0000")))
+            self.assertEqual([make_page(1, 2), make_page(3, 1), make_page(4, 2)], actual)
+            mock_misskey().notes_with_reactions.assert_has_calls([
+                call(limit=2, last_since_id="reaction_0000"),
+                call(limit=2, last_since_id="reaction_0002"),
+                call(limit=2, last_since_id="reaction_0003"),
+                call(limit=2, last_since_id="reaction_0005"),
+            ])
+            self.assertEqual(3, mock_save_cache.call_count)
+
+            # カーソルが進まなければ止める
+            mock_misskey().notes_with_reactions = AsyncMock(return_value=[{"id": "reaction_0000"}])
+            actual = asyncio.run(self.collect(fetcher.fetch_entry_pages("reaction_0000")))
+            self.assertEqual([[{"id": "reaction_0000"}]], actual)
+            mock_misskey().notes_with_reactions.assert_awaited_once()
+            mock_misskey().notes_with_reactions.reset_mock()
+            mock_save_cache.reset_mock()
+
+            # 初回実行時は untilId をたどって最新から最古の方向へページング
+            backward_pages = {"": make_page(5, 2), "reaction_0005": make_page(3, 2), "reaction_0003": []}
+            mock_misskey().notes_with_reactions = AsyncMock(
+                side_effect=lambda limit, last_until_id: backward_pages.get(last_until_id, [])
+            )
+            actual = asyncio.run(self.collect(fetcher.fetch_entry_pages("")))
+            self.assertEqual([make_page(5, 2), make_page(3, 2)], actual)
+            mock_misskey().notes_with_reactions.assert_has_calls([
+                call(limit=2, last_until_id=""),
+                call(limit=2, last_until_id="reaction_0005"),
+                call(limit=2, last_until_id="reaction_0003"),
+            ])
+            self.assertEqual(2, mock_save_cache.call_count)
+            mock_misskey().notes_with_reactions.reset_mock()
+
+            # バックフィル指定時は last_since_id を無視してさかのぼる
+            actual = asyncio.run(self.collect(fetcher.fetch_entry_pages("reaction_0000", True)))
+            self.assertEqual([make_page(5, 2), make_page(3, 2)], actual)
+            mock_misskey().notes_with_reactions.assert_any_call(limit=2, last_until_id="")
+
+    def test_plan_backfill_windows(self):
+        with ExitStack() as stack:
+            freeze_gun = stack.enter_context(freezegun.freeze_time("2023/09/11 00:00:00"))
+            mock_logger_info = stack.enter_context(patch.object(logger, "info"))
+            mock_logger_warning = stack.enter_context(patch("misskey_crawler.crawler.fetcher.logger.warning"))
+            mock_misskey = stack.enter_context(patch("misskey_crawler.crawler.fetcher.MisskeyManager"))
+
+            newest_id = encode_boundary(to_epoch_ms("2023-10-11T03:55:33.734+09:00"), "aid")
+            created_ms = to_epoch_ms("2023-10-01T00:00:00.000+09:00")
+            mock_misskey().notes_with_reactions = AsyncMock(return_value=[{"id": newest_id}])
+            mock_misskey().i = AsyncMock(return_value={"createdAt": "2023-09-30T15:00:00.000Z"})
+
+            fetcher = Fetcher(self.config_path, False)
+            fetcher.window_num = 4
+            actual = asyncio.run(fetcher.plan_backfill_windows("@user@misskey.io"))
+            self.assertEqual(4, len(actual))
+            mock_misskey().notes_with_reactions.assert_awaited_once_with(limit=1)
+
+            # 窓は新しい順に隙間なく並び、最新のリアクションとアカウントの作成日時を含む
+            self.assertEqual(["@user@misskey.io"] * 4, [window.account for window in actual])
+            self.assertEqual([False] * 4, [window.is_done for window in actual])
+            for newer, older in zip(actual, actual[1:]):
+                self.assertEqual(newer.since_id, older.until_id)
+            self.assertLess(newest_id, actual[0].until_id)
+            self.assertLess(decode_time(actual[-1].since_id), created_ms)
+
+            # ID の形式が判定できない場合は境界のない1つの窓にする
+            mock_misskey().notes_with_reactions = AsyncMock(return_value=[{"id": "reaction_0001"}])
+            actual = asyncio.run(fetcher.plan_backfill_windows("@user@misskey.io"))
+            self.assertEqual([BackfillWindow("@user@misskey.io", "", "", False, "")], actual)
+            mock_logger_warning.assert_called_once()
+
+            mock_misskey().notes_with_reactions = AsyncMock(return_value=[])
+            actual = asyncio.run(fetcher.plan_backfill_windows("@user@misskey.io"))
+            self.assertEqual([], actual)
+
+    def test_fetch_window_entry_pages(self):
+        with ExitStack() as stack:
+            mock_logger_info = stack.enter_context(patch.object(logger, "info"))
+            mock_misskey = stack.enter_context(patch("misskey_crawler.crawler.fetcher.MisskeyManager"))
+            mock_save_cache = stack.enter_context(patch("misskey_crawler.crawler.fetcher.Fetcher._save_cache"))
+
+            def make_page(start: int, num: int) -> list[dict]:
+                return [{"id": f"reaction_{i:04}"} for i in range(start + num - 1, start - 1, -1)]
+
+            # 窓ごとに untilId をたどる、sinceId は窓の下端に固定する
+            # page_limit 未満のページでは窓を終えず、空になるまでたどる
+            window_pages = {
+                ("reaction_0004", "reaction_0009"): make_page(7, 2),
+                ("reaction_0004", "reaction_0007"): make_page(6, 1),
+                ("reaction_0004", "reaction_0006"): make_page(5, 1),
+                ("reaction_0004", "reaction_0005"): [],
+                ("reaction_0000", "reaction_0004"): [],
+            }
+            mock_misskey().notes_with_reactions = AsyncMock(
+                side_effect=lambda limit, last_since_id, last_until_id: window_pages.get(
+                    (last_since_id, last_until_id), []
+                )
+            )
+
+            fetcher = Fetcher(self.config_path, False)
+            fetcher.page_limit = 2
+            fetcher.window_workers = 2
+            fetcher.window_buffer_size = 1
+            window_list = [
+                BackfillWindow("@user@misskey.io", "reaction_0004", "reaction_0009", False, ""),
+                BackfillWindow("@user@misskey.io", "reaction_0000", "reaction_0004", False, ""),
+            ]
+            actual = asyncio.run(self.collect_window_pages(fetcher, window_list))
+            window_key_list = [window.window_key for window in window_list]
+            expect = [
+                (make_page(7, 2), window_key_list[0], False),
+                (make_page(6, 1), window_key_list[0], False),
+                (make_page(5, 1), window_key_list[0], False),
+                ([], window_key_list[0], True),
+                ([], window_key_list[1], True),
+            ]
+            self.assertEqual(expect, actual)
+            self.assertEqual(3, mock_save_cache.call_count)
+
+            # 反映済みのカーソルがあればその続きから取得する
+            window_list[0].cursor_id = "reaction_0006"
+            actual = asyncio.run(self.collect_window_pages(fetcher, window_list[:1]))
+            self.assertEqual([(make_page(5, 1), window_key_list[0], False), ([], window_key_list[0], True)], actual)
+
+            # カーソルが進まなければ窓の最後とする
+            mock_misskey().notes_with_reactions = AsyncMock(return_value=make_page(5, 1))
+            window_list[0].cursor_id = "reaction_0005"
+            actual = asyncio.run(self.collect_window_pages(fetcher, window_list[:1]))
+            self.assertEqual([(make_page(5, 1), window_key_list[0], True)], actual)
+
+    def test_fetch_window_entry_pages_cancel(self):
+        with ExitStack() as stack:
+            mock_logger_info = stack.enter_context(patch.object(logger, "info"))
+            mock_misskey = stack.enter_context(patch("misskey_crawler.crawler.fetcher.MisskeyManager"))
+            mock_save_cache = stack.enter_context(patch("misskey_crawler.crawler.fetcher.Fetcher._save_cache"))
+
+            # 終わりのない窓を取得している途中で、後段のステージが失敗する
+            mock_misskey().notes_with_reactions = AsyncMock(
+                side_effect=lambda limit, last_since_id, last_until_id: [
+                    {"id": f"reaction_{int(last_until_id[-4:]) - 1:04}"}
+                ]
+            )
+            fetcher = Fetcher(self.config_path, False)
+            window_list = [
+                BackfillWindow("@user@misskey.io", "reaction_5000", "reaction_9999", False, ""),
+                BackfillWindow("@user@misskey.io", "reaction_0000", "reaction_5000", False, ""),
+            ]
+
+            remaining_task_list = []
+
+            async def run() -> None:
+                queue = asyncio.Queue(maxsize=1)
+
+                async def consume() -> None:
+                    await queue.get()
+                    raise ValueError("upsert failed")
+
+                try:
+                    async with asyncio.TaskGroup() as task_group:
+                        task_group.create_task(fetcher.fetch_window_entry_pages(window_list, queue))
+                        task_group.create_task(consume())
+                finally:
+                    remaining_task_list.extend(asyncio.all_tasks() - {asyncio.current_task()})
+
+            # 失敗した例外のみが送出され、窓を取得するタスクは残らない
+            with self.assertRaises(ExceptionGroup) as context:
+                asyncio.run(run())
+            self.assertEqual([ValueError], [type(e) for e in context.exception.exceptions])
+            self.assertEqual([], remaining_task_list)
 
     def test_fetch(self):
         with ExitStack() as stack:
@@ -44,29 +313,35 @@ class TestFetcher(unittest.TestCase):
             mock_misskey = stack.enter_context(patch("misskey_crawler.crawler.fetcher.MisskeyManager"))
             mock_fetched_info = stack.enter_context(patch("misskey_crawler.crawler.fetcher.FetchedInfo"))
 
-            mock_misskey().notes_with_reactions.side_effect = lambda limit, last_since_id: ["fetched_entry"]
+            fetched_pages = {"last_since_id": [{"id": "fetched_entry"}]}
+            mock_misskey().notes_with_reactions = AsyncMock(
+                side_effect=lambda limit, last_since_id: fetched_pages.get(last_since_id, [])
+            )
             mock_misskey().instance_name = "misskey.io"
-            mock_fetched_info.create.side_effect = lambda fetched_dict, instance_name: fetched_dict
+            mock_fetched_info.create.side_effect = lambda fetched_dict, instance_name, account: fetched_dict
 
             fetcher = Fetcher(self.config_path, False)
             fetcher.cache_path = Path("./tests/misskey_crawler/cache/")
             last_since_id = "last_since_id"
-            actual = fetcher.fetch(last_since_id)
-            self.assertEqual(["fetched_entry"], actual)
-            mock_misskey().notes_with_reactions.assert_called_once_with(limit=100, last_since_id=last_since_id)
+            actual = asyncio.run(fetcher.fetch(last_since_id))
+            self.assertEqual([{"id": "fetched_entry"}], actual)
+            mock_misskey().notes_with_reactions.assert_has_awaits([
+                call(limit=100, last_since_id=last_since_id),
+                call(limit=100, last_since_id="fetched_entry"),
+            ])
             mock_misskey().notes_with_reactions.reset_mock()
             mock_fetched_info.create.assert_called()
             mock_fetched_info.create.reset_mock()
 
             date_str = datetime.now().strftime("%Y%m%d%H%M%S")  # YYYYMMDDhhmmss
-            cache_filename = f"{date_str}_notes_with_reactions.json"
+            cache_filename = f"{date_str}_0_0000_notes_with_reactions.json"
             expect_cachepath = fetcher.cache_path / cache_filename
             self.assertEqual(True, expect_cachepath.exists())
             expect_cachepath.unlink(missing_ok=True)
 
             fetcher = Fetcher(self.config_path, True)
             fetcher.cache_path = Path("./tests/misskey_crawler/cache/")
-            actual = fetcher.fetch(last_since_id)
+            actual = asyncio.run(fetcher.fetch(last_since_id))
 
             expect: list[dict] = orjson.loads(Path("./tests/misskey_crawler/cache/test_notes_with_reactions.json").read_bytes()).get(
                 "result"
@@ -76,6 +351,34 @@ class TestFetcher(unittest.TestCase):
             mock_misskey().notes_with_reactions.assert_not_called()
             mock_fetched_info.create.assert_called()
 
+    def test_fetch_pages(self):
+        with ExitStack() as stack:
+            mock_logger_info = stack.enter_context(patch.object(logger, "info"))
+            mock_misskey = stack.enter_context(patch("misskey_crawler.crawler.fetcher.MisskeyManager"))
+            mock_fetch_entry_pages = stack.enter_context(
+                patch("misskey_crawler.crawler.fetcher.Fetcher.fetch_entry_pages")
+            )
+            mock_fetched_info = stack.enter_context(patch("misskey_crawler.crawler.fetcher.FetchedInfo"))
+
+            def create(fetched_dict, instance_name, account):
+                self.assertEqual("@user@misskey.io", account)
+                if fetched_dict == "invalid_entry":
+                    raise ValueError("invalid entry")
+                return fetched_dict
+
+            async def fetch_entry_pages(last_since_id, is_backfill):
+                for page in [["entry_2", "entry_1"], ["invalid_entry", "entry_3"]]:
+                    yield page
+
+            mock_fetch_entry_pages.side_effect = fetch_entry_pages
+            mock_fetched_info.create.side_effect = create
+
+            fetcher = Fetcher(self.config_path, False)
+            fetcher.account_name = "@user@misskey.io"
+            actual = asyncio.run(self.collect(fetcher.fetch_pages("last_since_id")))
+            self.assertEqual([["entry_1", "entry_2"], ["entry_3"]], actual)
+            mock_fetch_entry_pages.assert_called_once_with("last_since_id", False)
+
 
 if __name__ == "__main__":
     if sys.argv:
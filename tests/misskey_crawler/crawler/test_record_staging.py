@@ -0,0 +1,84 @@
+import sys
+import unittest
+
+from misskey_crawler.crawler.record_staging import RecordStaging
+from misskey_crawler.crawler.valueobject.fetched_info import FetchedInfo
+from misskey_crawler.db.model import Media, Note, Reaction, User
+
+
+class TestRecordStaging(unittest.TestCase):
+    def make_fetched_info(self, note_num: int, user_num: int, media_num: int, text: str = "") -> FetchedInfo:
+        note_id = f"note_{note_num}"
+        user_id = f"user_{user_num}"
+        reaction = Reaction("@user@misskey.io", note_id, f"reaction_{note_num}", "👍", 0, 0)
+        note = Note(note_id, user_id, "", text, 0, 0)
+        user = User(user_id, "name", "username", "", False, False, 0)
+        media_list = [
+            Media(note_id, f"media_{note_num}_{i}", "", "image/png", "", 0, "", 0, 0) for i in range(media_num)
+        ]
+        return FetchedInfo(reaction, note, user, media_list)
+
+    def test_init(self):
+        staging = RecordStaging()
+        self.assertEqual(0, len(staging))
+        self.assertEqual(([], [], [], []), staging.to_lists())
+
+    def test_add(self):
+        staging = RecordStaging()
+        fetched_info1 = self.make_fetched_info(1, 1, 2)
+        fetched_info2 = self.make_fetched_info(2, 1, 1)
+        staging.add_list([fetched_info1, fetched_info2])
+        reaction_list, note_list, user_list, media_list = staging.to_lists()
+        self.assertEqual([fetched_info1.reaction, fetched_info2.reaction], reaction_list)
+        self.assertEqual([fetched_info1.note, fetched_info2.note], note_list)
+        self.assertEqual([fetched_info1.user], user_list)
+        self.assertEqual([*fetched_info1.media_list, *fetched_info2.media_list], media_list)
+        self.assertEqual(2 + 2 + 1 + 3, len(staging))
+
+        # メディアが複数あってもリアクション、ノート、ユーザは1つにまとめる
+        self.assertEqual(3, staging.add_counter["reaction"])
+        self.assertEqual(1, staging.merge_counter["reaction"])
+        self.assertEqual(2, staging.merge_counter["user"])
+        self.assertEqual(0, staging.merge_counter["media"])
+
+        # メディアのないノートへのリアクションはメディアを除いて追加する
+        fetched_info3 = self.make_fetched_info(3, 2, 0)
+        staging.add(fetched_info3)
+        reaction_list, note_list, user_list, media_list = staging.to_lists()
+        self.assertEqual(fetched_info3.reaction, reaction_list[-1])
+        self.assertEqual(fetched_info3.user, user_list[-1])
+        self.assertEqual(3, len(media_list))
+        self.assertEqual(3, staging.add_counter["media"])
+
+    def test_add_merge(self):
+        # 同じキーのレコードは後のもので上書きし、並びは最初に追加した順を保つ
+        staging = RecordStaging()
+        staging.add(self.make_fetched_info(1, 1, 1, "old"))
+        staging.add(self.make_fetched_info(2, 2, 1))
+        staging.add(self.make_fetched_info(1, 1, 1, "new"))
+        reaction_list, note_list, user_list, media_list = staging.to_lists()
+        self.assertEqual(["note_1", "note_2"], [note.note_id for note in note_list])
+        self.assertEqual("new", note_list[0].text)
+        self.assertEqual(["reaction_1", "reaction_2"], [reaction.reaction_id for reaction in reaction_list])
+        self.assertEqual(["media_1_0", "media_2_0"], [media.media_id for media in media_list])
+        self.assertEqual(1, staging.merge_counter["note"])
+
+        # 同じメディアIDでもノートが違えば別のレコードとする
+        fetched_info = self.make_fetched_info(3, 1, 0)
+        fetched_info.media_list.append(Media("note_3", "media_1_0", "", "image/png", "", 0, "", 0, 0))
+        staging.add(fetched_info)
+        self.assertEqual(3, len(staging.to_lists()[3]))
+
+    def test_clear(self):
+        staging = RecordStaging()
+        staging.add(self.make_fetched_info(1, 1, 1))
+        staging.clear()
+        self.assertEqual(0, len(staging))
+        self.assertEqual(0, staging.add_counter["reaction"])
+        self.assertEqual(([], [], [], []), staging.to_lists())
+
+
+if __name__ == "__main__":
+    if sys.argv:
+        del sys.argv[1:]
+    unittest.main(warnings="ignore")
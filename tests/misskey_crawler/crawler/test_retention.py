@@ -0,0 +1,217 @@
+import sys
+import unittest
+from pathlib import Path
+
+from mock import MagicMock, call
+
+from misskey_crawler.crawler.retention import RetentionPolicy
+from misskey_crawler.crawler.valueobject.crawled_page import CrawledPage
+from misskey_crawler.db.media_file_db import MediaFileDB
+from misskey_crawler.db.model import Media, Reaction
+from misskey_crawler.util import to_epoch_ms
+
+
+class TestRetentionPolicy(unittest.TestCase):
+    save_base_path: Path = Path("./tests/misskey_crawler/cache/")
+
+    def setUp(self) -> None:
+        self.created_path_list: list[Path] = []
+
+    def tearDown(self) -> None:
+        for path in self.created_path_list:
+            path.unlink(missing_ok=True)
+
+    def get_instance(self, save_num: int = -1, save_bytes: int = -1, content_addressed: bool = False):
+        downloader = MagicMock()
+        downloader.save_base_path = self.save_base_path
+        downloader.save_num = save_num
+        downloader.save_bytes = save_bytes
+        downloader.content_addressed = content_addressed
+        downloader.get_store_path.side_effect = lambda media: self.save_base_path / f"store_{media.md5}.png"
+        media_db = MagicMock()
+        media_db.select_with_reaction_created_at.return_value = []
+        return RetentionPolicy(downloader, MediaFileDB(db_path=":memory:"), media_db)
+
+    def make_page(self, id_num_list: list[int], md5: str = "", size: int = 100) -> CrawledPage:
+        reaction_list, media_list = [], []
+        for id_num in id_num_list:
+            note_id = f"note_id_{id_num}"
+            created_at = to_epoch_ms(f"2023-09-{id_num:02}T00:00:00")
+            reaction_list.append(Reaction("@user@misskey.io", note_id, f"reaction_id_{id_num}", "👍", created_at, 0))
+            url = "https://misskey.io/name.png"
+            media = Media(note_id, f"media_id_{id_num}", "name.png", "image/png", md5, size, url, 0, 0)
+            media_list.append(media)
+            filepath = self.save_base_path / media.get_filename()
+            filepath.write_bytes(b"0" * size)
+            self.created_path_list.append(filepath)
+        return CrawledPage("@user@misskey.io", "", reaction_list, [], [], media_list)
+
+    def test_register(self):
+        retention_policy = self.get_instance(save_num=10)
+        page = self.make_page([2, 1])
+        page.media_list.append(
+            Media("note_id_3", "media_id_3", "name.png", "image/png", "", 100, "https://misskey.io/name.png", 0, 0)
+        )
+        actual = retention_policy.register(page)
+        self.assertEqual(2, len(actual))
+        self.assertEqual("note_id_2_media_id_2_name.png", actual[0].path)
+        self.assertEqual(to_epoch_ms("2023-09-02T00:00:00"), actual[0].created_at)
+        self.assertEqual(100, actual[0].size)
+        self.assertEqual("", actual[0].store_path)
+        self.assertEqual((2, 200), retention_policy.media_file_db.select_total())
+
+        retention_policy = self.get_instance(save_num=10, content_addressed=True)
+        actual = retention_policy.register(self.make_page([1], md5="md5"))
+        self.assertEqual("store_md5.png", actual[0].store_path)
+
+    def test_seed(self):
+        # 上限がなければ記録しない
+        retention_policy = self.get_instance()
+        self.assertEqual(0, retention_policy.seed())
+        retention_policy.media_db.select_with_reaction_created_at.assert_not_called()
+
+        retention_policy = self.get_instance(save_num=10, content_addressed=True)
+        retention_policy.seed_chunk_size = 2
+        page = self.make_page([1, 2], md5="md5")
+        row_list = []
+        for i, media in enumerate(page.media_list, start=1):
+            media.id = i
+            row_list.append((media, page.reaction_list[i - 1].created_at if i == 1 else None))
+        # 保存されていないメディア、ファイル名を決められないメディアは記録しない
+        not_saved = Media(
+            "note_id_3", "media_id_3", "name.png", "image/png", "", 100, "https://misskey.io/name.png", 0, 0
+        )
+        not_saved.id = 3
+        invalid = Media("note_id_4", "media_id_4", "name", "", "", 100, "https://misskey.io/name", 0, 0)
+        invalid.id = 4
+        row_list.extend([(not_saved, None), (invalid, None)])
+        chunk_list = [row_list[:2], row_list[2:], []]
+        retention_policy.media_db.select_with_reaction_created_at.side_effect = chunk_list
+
+        self.assertEqual(2, retention_policy.seed())
+        retention_policy.media_db.select_with_reaction_created_at.assert_has_calls([
+            call(0, 2),
+            call(2, 2),
+            call(4, 2),
+        ])
+        record_list = retention_policy.media_file_db.select()
+        self.assertEqual(
+            ["note_id_1_media_id_1_name.png", "note_id_2_media_id_2_name.png"], [r.path for r in record_list]
+        )
+        # リアクションがなければメディアの日時とする
+        self.assertEqual([to_epoch_ms("2023-09-01T00:00:00"), 0], [r.created_at for r in record_list])
+        self.assertEqual(["store_md5.png", "store_md5.png"], [r.store_path for r in record_list])
+
+        # 記録済みなら何もしない
+        retention_policy.media_db.select_with_reaction_created_at.reset_mock()
+        self.assertEqual(0, retention_policy.seed())
+        retention_policy.media_db.select_with_reaction_created_at.assert_not_called()
+
+    def test_is_over(self):
+        retention_policy = self.get_instance()
+        self.assertEqual(False, retention_policy.is_enabled)
+        self.assertEqual(False, retention_policy.is_over(100, 100000))
+
+        retention_policy = self.get_instance(save_num=2)
+        self.assertEqual(True, retention_policy.is_enabled)
+        self.assertEqual(False, retention_policy.is_over(2, 100000))
+        self.assertEqual(True, retention_policy.is_over(3, 0))
+
+        retention_policy = self.get_instance(save_bytes=1000)
+        self.assertEqual(True, retention_policy.is_enabled)
+        self.assertEqual(False, retention_policy.is_over(100, 1000))
+        self.assertEqual(True, retention_policy.is_over(1, 1001))
+
+    def test_evict(self):
+        retention_policy = self.get_instance(save_num=2)
+        retention_policy.batch_size = 1
+        page = self.make_page([3, 1, 4, 2])
+        retention_policy.register(page)
+        actual = retention_policy.evict()
+        self.assertEqual(["note_id_1_media_id_1_name.png", "note_id_2_media_id_2_name.png"], [r.path for r in actual])
+        self.assertEqual(False, (self.save_base_path / "note_id_1_media_id_1_name.png").exists())
+        self.assertEqual(False, (self.save_base_path / "note_id_2_media_id_2_name.png").exists())
+        self.assertEqual(True, (self.save_base_path / "note_id_3_media_id_3_name.png").exists())
+        self.assertEqual((2, 200), retention_policy.media_file_db.select_total())
+        self.assertEqual([], retention_policy.evict())
+
+        retention_policy = self.get_instance(save_bytes=250)
+        retention_policy.register(self.make_page([1, 2, 3]))
+        actual = retention_policy.evict()
+        self.assertEqual(["note_id_1_media_id_1_name.png"], [r.path for r in actual])
+        self.assertEqual((2, 200), retention_policy.media_file_db.select_total())
+
+    def test_evict_store(self):
+        retention_policy = self.get_instance(save_num=1, content_addressed=True)
+        store_path = self.save_base_path / "store_md5.png"
+        store_path.write_bytes(b"content")
+        self.created_path_list.append(store_path)
+        retention_policy.register(self.make_page([1, 2], md5="md5"))
+
+        # 他のファイルから参照されているストア上のファイルは残す
+        actual = retention_policy.evict()
+        self.assertEqual(1, len(actual))
+        self.assertEqual(True, store_path.exists())
+
+        retention_policy.downloader.save_num = 0
+        retention_policy.downloader.save_bytes = 1
+        actual = retention_policy.evict()
+        self.assertEqual(1, len(actual))
+        self.assertEqual(False, store_path.exists())
+
+    def test_select_downloadable(self):
+        # 上限がなければすべて取得する
+        retention_policy = self.get_instance()
+        page = self.make_page([1, 2])
+        self.assertEqual(page.media_list, retention_policy.select_downloadable(page))
+
+        # 上限に達していなければすべて取得する
+        retention_policy = self.get_instance(save_num=3)
+        retention_policy.register(self.make_page([3, 4]))
+        page = self.make_page([1, 5])
+        self.assertEqual(page.media_list, retention_policy.select_downloadable(page))
+
+        # 上限に達していれば、残っている最も古いファイルより古いメディアは取得しない
+        retention_policy.register(self.make_page([6]))
+        page = self.make_page([1, 2, 5])
+        actual = retention_policy.select_downloadable(page)
+        self.assertEqual(["media_id_5"], [media.media_id for media in actual])
+
+        retention_policy = self.get_instance(save_bytes=250)
+        retention_policy.register(self.make_page([3, 4]))
+        page = self.make_page([1, 2], size=10)
+        self.assertEqual(page.media_list, retention_policy.select_downloadable(page))
+        page = self.make_page([1, 2], size=100)
+        self.assertEqual([], retention_policy.select_downloadable(page))
+
+    def test_remove(self):
+        retention_policy = self.get_instance(save_num=1, content_addressed=True)
+        store_path = self.save_base_path / "store_md5.png"
+        store_path.write_bytes(b"content")
+        self.created_path_list.append(store_path)
+        record_list = retention_policy.register(self.make_page([1], md5="md5"))
+        retention_policy.remove(record_list)
+        self.assertEqual(False, (self.save_base_path / record_list[0].path).exists())
+        self.assertEqual(False, store_path.exists())
+        self.assertEqual((0, 0), retention_policy.media_file_db.select_total())
+
+        # 削除したファイルの記録済みのチェックサムも破棄する
+        retention_policy.downloader.checksum_cache.discard.assert_any_call(self.save_base_path / record_list[0].path)
+        retention_policy.downloader.checksum_cache.discard.assert_any_call(store_path)
+
+    def test_apply(self):
+        retention_policy = self.get_instance()
+        actual = retention_policy.apply(self.make_page([1, 2]))
+        self.assertEqual([], actual)
+        self.assertEqual((0, 0), retention_policy.media_file_db.select_total())
+
+        retention_policy = self.get_instance(save_num=1)
+        actual = retention_policy.apply(self.make_page([1, 2]))
+        self.assertEqual(["note_id_1_media_id_1_name.png"], [r.path for r in actual])
+        self.assertEqual((1, 100), retention_policy.media_file_db.select_total())
+
+
+if __name__ == "__main__":
+    if sys.argv:
+        del sys.argv[1:]
+    unittest.main(warnings="ignore")
@@ -3,11 +3,12 @@ import unittest
 from datetime import datetime
 from pathlib import Path
 
+import freezegun
 import orjson
 
 from misskey_crawler.crawler.valueobject.fetched_info import FetchedInfo
 from misskey_crawler.db.model import Media, Note, Reaction, User
-from misskey_crawler.util import find_values, to_jst
+from misskey_crawler.util import JST, find_values, to_epoch_ms
 
 
 class TestFetchedInfo(unittest.TestCase):
@@ -16,19 +17,15 @@ class TestFetchedInfo(unittest.TestCase):
         self.fetched_entry_list = orjson.loads(self.cache_filepath.read_bytes()).get("result")
         return super().setUp()
 
-    def expect_create(self, fetched_dict: dict, instance_name: str = "") -> FetchedInfo:
-        def normalize_date_at(date_at_str: str) -> str:
-            result = to_jst(datetime.fromisoformat(date_at_str)).isoformat()
-            if result.endswith("+00:00"):
-                result = result[:-6]
-            return result
+    def expect_create(self, fetched_dict: dict, instance_name: str = "", account: str = "") -> FetchedInfo:
+        def normalize_date_at(date_at_str: str) -> int:
+            return to_epoch_ms(datetime.fromisoformat(date_at_str))
 
-        registered_at = datetime.now().isoformat()
+        registered_at = to_epoch_ms(datetime.now(JST))
         note_dict = find_values(fetched_dict, "note", True, [""])
         note_id = find_values(note_dict, "id", True, [""])
 
-        media_dicts = []
-        media_dicts = find_values(note_dict, "files", True, [""])
+        media_dicts = note_dict.get("files", [])
 
         media_list = []
         for media_dict in media_dicts:
@@ -56,6 +53,7 @@ class TestFetchedInfo(unittest.TestCase):
         reaction_type = find_values(fetched_dict, "type", True, [""])
         reaction_created_at = normalize_date_at(find_values(fetched_dict, "createdAt", True, [""]))
         reaction = Reaction.create({
+            "account": account,
             "note_id": note_id,
             "reaction_id": reaction_id,
             "type": reaction_type,
@@ -95,22 +93,101 @@ class TestFetchedInfo(unittest.TestCase):
 
     def test_create(self):
         instance_name = "test.misskey.io"
-        for entry in self.fetched_entry_list[:-1]:
-            expect = self.expect_create(entry, instance_name)
-            actual = FetchedInfo.create(entry, instance_name)
+        account = "@user@test.misskey.io"
+        for entry in self.fetched_entry_list:
+            expect = self.expect_create(entry, instance_name, account)
+            actual = FetchedInfo.create(entry, instance_name, account)
             self.assertEqual(expect, actual)
+            self.assertEqual(account, actual.reaction.account)
 
+        # テキストのみのノートはメディアのないノートとして扱う
         entry = self.fetched_entry_list[-1]
+        actual = FetchedInfo.create(entry)
+        self.assertEqual([], actual.media_list)
+        self.assertEqual(entry["id"], actual.reaction.reaction_id)
+
+        entry = {**entry, "note": {**entry["note"], "files": []}}
+        actual = FetchedInfo.create(entry)
+        self.assertEqual([], actual.media_list)
+
+        entry = {**entry, "note": {}}
         with self.assertRaises(ValueError):
             actual = FetchedInfo.create(entry)
 
+    def to_dict_list(self, fetched_info: FetchedInfo) -> list[dict]:
+        return [
+            fetched_info.reaction.to_dict(),
+            fetched_info.note.to_dict(),
+            fetched_info.user.to_dict(),
+            *[media.to_dict() for media in fetched_info.media_list],
+        ]
+
+    def test_create_by_find_values(self):
+        # コンパイル済みのスキーマで作ったレコードは find_values で作ったものとすべてのフィールドが一致する
+        instance_name = "test.misskey.io"
+        account = "@user@test.misskey.io"
+        with freezegun.freeze_time("2023-09-11T00:00:00Z"):
+            for entry in self.fetched_entry_list:
+                expect = FetchedInfo.create_by_find_values(entry, instance_name, account)
+                actual = FetchedInfo.create(entry, instance_name, account)
+                self.assertEqual(self.to_dict_list(expect), self.to_dict_list(actual))
+
+            # name が null なら username を使う
+            entry = self.fetched_entry_list[0]
+            entry = {**entry, "note": {**entry["note"], "user": {**entry["note"]["user"], "name": None}}}
+            actual = FetchedInfo.create(entry, instance_name)
+            self.assertEqual(entry["note"]["user"]["username"], actual.user.name)
+            expect = FetchedInfo.create_by_find_values(entry, instance_name)
+            self.assertEqual(self.to_dict_list(expect), self.to_dict_list(actual))
+
+    def test_create_fallback(self):
+        # 直接読めないエントリは find_values で作り直し、同じ例外を送出する
+        entry = self.fetched_entry_list[0]
+        invalid_entry_list = [
+            ({**entry, "note": {}}, ValueError),
+            ({**entry, "note": None}, ValueError),
+            ({k: v for k, v in entry.items() if k != "type"}, ValueError),
+            ({**entry, "note": {**entry["note"], "files": None}}, TypeError),
+            ({**entry, "createdAt": "invalid_date"}, ValueError),
+        ]
+        for invalid_entry, expect_exception in invalid_entry_list:
+            with self.assertRaises(expect_exception):
+                FetchedInfo.create_by_find_values(invalid_entry)
+            with self.assertRaises(expect_exception):
+                FetchedInfo.create(invalid_entry)
+
+        # ノートがリストなら要素からキーを探す
+        list_entry = {**entry, "note": [entry["note"]]}
+        with freezegun.freeze_time("2023-09-11T00:00:00Z"):
+            actual = FetchedInfo.create(list_entry)
+            expect = FetchedInfo.create(entry)
+        self.assertEqual(self.to_dict_list(expect)[:3], self.to_dict_list(actual)[:3])
+
+    def test_create_timestamp(self):
+        # 日時はエポックミリ秒で保持する
+        with freezegun.freeze_time("2023-09-11T00:00:00Z"):
+            entry = self.fetched_entry_list[0]
+            actual = FetchedInfo.create(entry, "test.misskey.io")
+        self.assertEqual(to_epoch_ms(entry["createdAt"]), actual.reaction.created_at)
+        self.assertEqual(to_epoch_ms(entry["note"]["createdAt"]), actual.note.created_at)
+        self.assertEqual(to_epoch_ms(entry["note"]["files"][0]["createdAt"]), actual.media_list[0].created_at)
+        registered_at = to_epoch_ms("2023-09-11T09:00:00+09:00")
+        self.assertEqual(registered_at, actual.reaction.registered_at)
+        self.assertEqual(registered_at, actual.note.registered_at)
+        self.assertEqual(registered_at, actual.user.registered_at)
+        self.assertEqual(registered_at, actual.media_list[0].registered_at)
+
     def test_get_records(self):
         instance_name = "test.misskey.io"
-        for entry in self.fetched_entry_list[:-1]:
+        for entry in self.fetched_entry_list:
             expect = self.expect_create(entry, instance_name)
             actual = FetchedInfo.create(entry, instance_name)
             self.assertEqual(expect.get_records(), actual.get_records())
 
+        # メディアのないノートへのリアクションもメディアを None として返す
+        actual = FetchedInfo.create(self.fetched_entry_list[-1], instance_name)
+        self.assertEqual([(actual.reaction, actual.note, actual.user, None)], actual.get_records())
+
 
 if __name__ == "__main__":
     if sys.argv:
@@ -0,0 +1,131 @@
+import sys
+import unittest
+from datetime import datetime
+from typing import Literal
+
+from misskey_crawler.db.backfill_window_db import BackfillWindowDB
+from misskey_crawler.db.model import BackfillWindow
+from misskey_crawler.util.misskey_id import encode_boundary
+
+
+class TestBackfillWindowDB(unittest.TestCase):
+    def get_instance(self) -> BackfillWindowDB:
+        controller = BackfillWindowDB(db_path=":memory:")
+        return controller
+
+    def get_record(
+        self,
+        id_num: int,
+        type_kind: Literal["record", "list", "dict"] = "record",
+        account: str = "@username@misskey.io",
+    ) -> BackfillWindow | list[BackfillWindow] | list[dict]:
+        now_date = datetime.now().isoformat()
+        base_ms = 1_700_000_000_000
+        arg_dict = {
+            "account": account,
+            "since_id": encode_boundary(base_ms + id_num * 1000, "aidx"),
+            "until_id": encode_boundary(base_ms + (id_num + 1) * 1000, "aidx"),
+            "is_done": False,
+            "updated_at": now_date,
+        }
+        if type_kind == "dict":
+            return arg_dict
+        record = BackfillWindow.create(arg_dict)
+        if type_kind == "list":
+            return [record]
+        return record
+
+    def test_select(self):
+        controller = self.get_instance()
+        actual = controller.select()
+        self.assertEqual([], actual)
+
+        record = self.get_record(1)
+        controller.upsert(record)
+        actual = controller.select()
+        record = self.get_record(1)
+        self.assertEqual([record], actual)
+        self.assertEqual(f"{record.account}_{record.since_id}_{record.until_id}", actual[0].window_key)
+
+    def test_select_by_account(self):
+        controller = self.get_instance()
+        record_list = [self.get_record(i) for i in [2, 1, 3]]
+        other = self.get_record(4, account="@other@misskey.io")
+        controller.upsert([*record_list, other])
+
+        # 新しい順に返す
+        actual = controller.select_by_account("@username@misskey.io")
+        self.assertEqual([self.get_record(i) for i in [3, 2, 1]], actual)
+
+        controller.advance(record_list[2].window_key, "", True)
+        actual = controller.select_unfinished("@username@misskey.io")
+        self.assertEqual([self.get_record(2), self.get_record(1)], actual)
+        self.assertEqual([], controller.select_unfinished("@unknown@misskey.io"))
+
+    def test_advance(self):
+        controller = self.get_instance()
+        record = self.get_record(1)
+        controller.upsert(record)
+        actual = controller.advance(record.window_key, "reaction_id_2")
+        self.assertEqual(1, actual)
+        actual = controller.select()[0]
+        self.assertEqual(("reaction_id_2", 1, False), (actual.cursor_id, actual.page_num, actual.is_done))
+
+        # 空のページはカーソルを動かさずに完了にする
+        controller.advance(record.window_key, "reaction_id_1")
+        controller.advance(record.window_key, "", True)
+        actual = controller.select()[0]
+        self.assertEqual(("reaction_id_1", 2, True), (actual.cursor_id, actual.page_num, actual.is_done))
+
+        actual = controller.advance("invalid_window_key", "reaction_id_1", True)
+        self.assertEqual(0, actual)
+
+        # トランザクションが失敗すれば進めない
+        record = self.get_record(2)
+        controller.upsert(record)
+        with self.assertRaises(ValueError):
+            with controller.database.transaction():
+                controller.advance(record.window_key, "reaction_id_1", True)
+                raise ValueError("upsert failed")
+        actual = controller.select_unfinished(record.account)
+        self.assertEqual([record], actual)
+        self.assertEqual(("", 0), (actual[0].cursor_id, actual[0].page_num))
+
+    def test_delete_by_account(self):
+        controller = self.get_instance()
+        other = self.get_record(3, account="@other@misskey.io")
+        controller.upsert([self.get_record(1), self.get_record(2), other])
+        actual = controller.delete_by_account("@username@misskey.io")
+        self.assertEqual(2, actual)
+        self.assertEqual([other], controller.select())
+
+    def test_upsert(self):
+        controller = self.get_instance()
+        record1 = self.get_record(1)
+        actual = controller.upsert(record1)
+        self.assertEqual([0], actual)
+
+        record1 = self.get_record(1)
+        record1.is_done = True
+        actual = controller.upsert(record1)
+        self.assertEqual([1], actual)
+
+        record2 = self.get_record(2, "dict")
+        actual = controller.upsert([record2])
+        self.assertEqual([0], actual)
+        record2 = BackfillWindow.create(record2)
+
+        actual = controller.select()
+        self.assertEqual([record1, record2], actual)
+        self.assertEqual(True, actual[0].is_done)
+
+        with self.assertRaises(TypeError):
+            actual = controller.upsert([])
+        with self.assertRaises(TypeError):
+            actual = controller.upsert("invalid_element")
+
+
+if __name__ == "__main__":
+    if sys.argv:
+        del sys.argv[1:]
+    unittest.main(warnings="ignore")
@@ -1,11 +1,13 @@
 import sys
 import unittest
 from contextlib import ExitStack
+from pathlib import Path
 
 from mock import patch
 from sqlalchemy.pool import StaticPool
 
-from misskey_crawler.db.base import Base
+from misskey_crawler.db.base import Base, Database
+from misskey_crawler.db.model import CrawlState
 
 
 class ConcreteBase(Base):
@@ -17,10 +19,18 @@ class ConcreteBase(Base):
 
 
 class TestBase(unittest.TestCase):
+    def setUp(self) -> None:
+        Database.database_dict.clear()
+
+    def tearDown(self) -> None:
+        Database.database_dict.clear()
+
     def test_init(self):
         with ExitStack() as stack:
             mock_create_engine = stack.enter_context(patch("misskey_crawler.db.base.create_engine"))
             mock_model_base = stack.enter_context(patch("misskey_crawler.db.base.ModelBase"))
+            mock_event = stack.enter_context(patch("misskey_crawler.db.base.event"))
+            mock_migrator = stack.enter_context(patch("misskey_crawler.db.base.Migrator"))
 
             mock_create_engine.return_value = "created_engine"
 
@@ -31,13 +41,110 @@ class TestBase(unittest.TestCase):
             mock_create_engine.assert_called_once_with(
                 f"sqlite:///{db_path}",
                 echo=False,
-                poolclass=StaticPool,
                 connect_args={
                     "timeout": 30,
                     "check_same_thread": False,
                 },
             )
             mock_model_base.metadata.create_all.assert_called_once_with("created_engine")
+            mock_migrator.assert_called_once_with("created_engine")
+            mock_migrator.return_value.migrate.assert_called_once_with()
+            mock_event.listen.assert_called_once_with("created_engine", "connect", base.database.apply_pragma)
+            self.assertEqual(Database.pragma_dict, base.database.pragma_dict)
+
+            # 同じ DB ファイルならエンジンを共有し、スキーマの作成も1度だけ行う
+            other = ConcreteBase()
+            self.assertIs(base.database, other.database)
+            self.assertEqual("created_engine", other.engine)
+            mock_create_engine.assert_called_once()
+            mock_model_base.metadata.create_all.assert_called_once()
+
+            # ":memory:" は共有しない
+            mock_create_engine.reset_mock()
+            base = ConcreteBase(db_path=":memory:")
+            other = ConcreteBase(db_path=":memory:")
+            self.assertIsNot(base.database, other.database)
+            self.assertEqual(2, mock_create_engine.call_count)
+            self.assertEqual(StaticPool, mock_create_engine.call_args.kwargs["poolclass"])
+
+    def test_transaction(self):
+        base = ConcreteBase(db_path=":memory:")
+        database = base.database
+
+        def get_record(id_num: int) -> CrawlState:
+            return CrawlState(f"@user_{id_num}@misskey.io", "reaction_id", "2023-09-11T00:00:00")
+
+        def select_account_list() -> list[str]:
+            with base.engine.connect() as conn:
+                return list(conn.scalars(CrawlState.__table__.select().with_only_columns(CrawlState.account)))
+
+        # 例外が発生すればブロック内の書き込みはすべてロールバックする
+        with self.assertRaises(ValueError):
+            with database.transaction():
+                base._bulk_upsert(CrawlState, [get_record(0)], "account")
+                base._bulk_upsert(CrawlState, [get_record(1)], "account")
+                raise ValueError("crashed")
+        self.assertEqual([], select_account_list())
+
+        # 入れ子にした場合は外側のトランザクションにまとめる
+        with database.transaction() as conn:
+            base._bulk_upsert(CrawlState, [get_record(0)], "account")
+            with database.transaction() as inner_conn:
+                self.assertIs(conn, inner_conn)
+                base._bulk_upsert(CrawlState, [get_record(1)], "account")
+        self.assertEqual(["@user_0@misskey.io", "@user_1@misskey.io"], select_account_list())
+        self.assertIsNone(database.local.conn)
+
+    def test_pragma(self):
+        db_path = "./tests/misskey_crawler/cache/test_pragma.db"
+        try:
+            database = Database.get(db_path, {"synchronous": "FULL"})
+            with database.engine.connect() as conn:
+                self.assertEqual("wal", conn.exec_driver_sql("PRAGMA journal_mode").scalar())
+                self.assertEqual(2, conn.exec_driver_sql("PRAGMA synchronous").scalar())
+                self.assertEqual(2, conn.exec_driver_sql("PRAGMA temp_store").scalar())
+                self.assertEqual(-64 * 1024, conn.exec_driver_sql("PRAGMA cache_size").scalar())
+            database.close()
+            wal_path = Path(f"{db_path}-wal")
+            self.assertEqual(True, not wal_path.exists() or wal_path.stat().st_size == 0)
+
+            with self.assertRaises(ValueError):
+                Database(db_path, {"synchronous": "OFF; DROP TABLE Reaction"})
+        finally:
+            for suffix in ["", "-wal", "-shm"]:
+                Path(f"{db_path}{suffix}").unlink(missing_ok=True)
+
+    def test_bulk_upsert(self):
+        base = ConcreteBase(db_path=":memory:")
+        base.chunk_size = 2
+
+        def get_record(id_num: int, last_reaction_id: str) -> CrawlState:
+            return CrawlState(f"@user_{id_num}@misskey.io", last_reaction_id, "2023-09-11T00:00:00")
+
+        record_list = [get_record(i, "reaction_id_1") for i in range(3)]
+        actual = base._bulk_upsert(CrawlState, record_list, "account")
+        self.assertEqual([0, 0, 0], actual)
+
+        # チャンクをまたいでも既存のキーは更新になり、同じキーが続けば後のもので上書きする
+        record_list = [
+            get_record(2, "reaction_id_2"),
+            get_record(3, "reaction_id_2"),
+            get_record(3, "reaction_id_3"),
+            get_record(0, "reaction_id_2"),
+        ]
+        actual = base._bulk_upsert(CrawlState, record_list, "account")
+        self.assertEqual([1, 0, 1, 1], actual)
+
+        with base.engine.connect() as conn:
+            rows = conn.execute(CrawlState.__table__.select().order_by(CrawlState.id)).all()
+        actual = [(row.account, row.last_reaction_id) for row in rows]
+        expect = [
+            ("@user_0@misskey.io", "reaction_id_2"),
+            ("@user_1@misskey.io", "reaction_id_1"),
+            ("@user_2@misskey.io", "reaction_id_2"),
+            ("@user_3@misskey.io", "reaction_id_3"),
+        ]
+        self.assertEqual(expect, actual)
 
 
 if __name__ == "__main__":
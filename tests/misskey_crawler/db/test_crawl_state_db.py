@@ -0,0 +1,82 @@
+import sys
+import unittest
+from datetime import datetime
+from typing import Literal
+
+from misskey_crawler.db.crawl_state_db import CrawlStateDB
+from misskey_crawler.db.model import CrawlState
+
+
+class TestCrawlStateDB(unittest.TestCase):
+    def get_instance(self) -> CrawlStateDB:
+        controller = CrawlStateDB(db_path=":memory:")
+        return controller
+
+    def get_record(
+        self, id_num: int, type_kind: Literal["record", "list", "dict"] = "record"
+    ) -> CrawlState | list[CrawlState] | list[dict]:
+        now_date = datetime.now().isoformat()
+        arg_dict = {
+            "account": f"@username_{id_num}@misskey.io",
+            "last_reaction_id": f"reaction_id_{id_num}",
+            "updated_at": now_date,
+        }
+        if type_kind == "dict":
+            return arg_dict
+        record = CrawlState.create(arg_dict)
+        if type_kind == "list":
+            return [record]
+        return record
+
+    def test_select(self):
+        controller = self.get_instance()
+        actual = controller.select()
+        self.assertEqual([], actual)
+
+        record = self.get_record(1)
+        controller.upsert(record)
+        actual = controller.select()
+        record = self.get_record(1)
+        self.assertEqual([record], actual)
+
+    def test_select_last_reaction_id(self):
+        controller = self.get_instance()
+        actual = controller.select_last_reaction_id("@username_1@misskey.io")
+        self.assertEqual("", actual)
+
+        controller.upsert([self.get_record(1), self.get_record(2)])
+        actual = controller.select_last_reaction_id("@username_1@misskey.io")
+        self.assertEqual("reaction_id_1", actual)
+        actual = controller.select_last_reaction_id("@username_2@misskey.io")
+        self.assertEqual("reaction_id_2", actual)
+
+    def test_upsert(self):
+        controller = self.get_instance()
+        record1 = self.get_record(1)
+        actual = controller.upsert(record1)
+        self.assertEqual([0], actual)
+
+        record1 = self.get_record(1)
+        record1.last_reaction_id = "new_reaction_id"
+        actual = controller.upsert(record1)
+        self.assertEqual([1], actual)
+
+        record2 = self.get_record(2, "dict")
+        actual = controller.upsert([record2])
+        self.assertEqual([0], actual)
+        record2 = CrawlState.create(record2)
+
+        actual = controller.select()
+        self.assertEqual([record1, record2], actual)
+        self.assertEqual("new_reaction_id", actual[0].last_reaction_id)
+
+        with self.assertRaises(TypeError):
+            actual = controller.upsert([])
+        with self.assertRaises(TypeError):
+            actual = controller.upsert("invalid_element")
+
+
+if __name__ == "__main__":
+    if sys.argv:
+        del sys.argv[1:]
+    unittest.main(warnings="ignore")
@@ -4,7 +4,8 @@ from datetime import datetime
 from typing import Literal
 
 from misskey_crawler.db.media_db import MediaDB
-from misskey_crawler.db.model import Media
+from misskey_crawler.db.model import Media, Reaction
+from misskey_crawler.util import to_epoch_ms
 
 
 class TestMediaDB(unittest.TestCase):
@@ -15,7 +16,7 @@ class TestMediaDB(unittest.TestCase):
     def get_record(
         self, id_num: int, type_kind: Literal["record", "list", "dict"] = "record"
     ) -> Media | list[Media] | list[dict]:
-        now_date = datetime.now().isoformat()
+        now_date = to_epoch_ms(datetime.now())
         arg_dict = {
             "note_id": f"note_id_{id_num}",
             "media_id": f"media_id_{id_num}",
@@ -45,6 +46,43 @@ class TestMediaDB(unittest.TestCase):
         record = self.get_record(1)
         self.assertEqual([record], actual)
 
+    def test_select_created_between(self):
+        controller = self.get_instance()
+        record_list = []
+        for i in range(1, 5):
+            record = self.get_record(i)
+            record.created_at = to_epoch_ms(f"2023-09-{i:02}T00:00:00")
+            record_list.append(record)
+        controller.upsert(list(reversed(record_list)))
+
+        actual = controller.select_created_between(datetime(2023, 9, 2), datetime(2023, 9, 4))
+        self.assertEqual(record_list[1:3], actual)
+        actual = controller.select_created_between(since=record_list[2].created_at)
+        self.assertEqual(record_list[2:], actual)
+        actual = controller.select_created_between(until=datetime(2023, 9, 2))
+        self.assertEqual(record_list[:1], actual)
+        actual = controller.select_created_between()
+        self.assertEqual(record_list, actual)
+
+    def test_select_with_reaction_created_at(self):
+        controller = self.get_instance()
+        self.assertEqual([], controller.select_with_reaction_created_at())
+        record_list = [self.get_record(i) for i in range(1, 4)]
+        controller.upsert(record_list)
+        # 同じノートへの複数のアカウントのリアクションは最も新しい日時とする
+        reaction_list = [
+            Reaction("@user1@misskey.io", "note_id_1", "reaction_id_1", "👍", 100, 0),
+            Reaction("@user2@misskey.io", "note_id_1", "reaction_id_2", "👍", 200, 0),
+            Reaction("@user1@misskey.io", "note_id_2", "reaction_id_3", "👍", 300, 0),
+        ]
+        controller._bulk_upsert(Reaction, reaction_list, ("account", "note_id"))
+
+        actual = controller.select_with_reaction_created_at(limit=2)
+        self.assertEqual([(record_list[0], 200), (record_list[1], 300)], actual)
+        actual = controller.select_with_reaction_created_at(actual[-1][0].id, 2)
+        self.assertEqual([(record_list[2], None)], actual)
+        self.assertEqual([], controller.select_with_reaction_created_at(actual[-1][0].id, 2))
+
     def test_upsert(self):
         controller = self.get_instance()
         record1 = self.get_record(1)
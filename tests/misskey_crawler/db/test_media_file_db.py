@@ -0,0 +1,121 @@
+import sys
+import unittest
+from datetime import datetime
+from typing import Literal
+
+from misskey_crawler.db.media_file_db import MediaFileDB
+from misskey_crawler.db.model import MediaFile
+from misskey_crawler.util import to_epoch_ms
+
+
+class TestMediaFileDB(unittest.TestCase):
+    def get_instance(self) -> MediaFileDB:
+        controller = MediaFileDB(db_path=":memory:")
+        return controller
+
+    def get_record(
+        self, id_num: int, type_kind: Literal["record", "list", "dict"] = "record", store_path: str = ""
+    ) -> MediaFile | list[MediaFile] | list[dict]:
+        now_date = to_epoch_ms(datetime.now())
+        arg_dict = {
+            "path": f"note_id_{id_num}_media_id_{id_num}_name.png",
+            "note_id": f"note_id_{id_num}",
+            "media_id": f"media_id_{id_num}",
+            "md5": "md5",
+            "size": 100 * id_num,
+            "store_path": store_path,
+            "created_at": to_epoch_ms(f"2023-09-{id_num:02}T00:00:00"),
+            "registered_at": now_date,
+        }
+        if type_kind == "dict":
+            return arg_dict
+        record = MediaFile.create(arg_dict)
+        if type_kind == "list":
+            return [record]
+        return record
+
+    def test_select(self):
+        controller = self.get_instance()
+        actual = controller.select()
+        self.assertEqual([], actual)
+
+        record = self.get_record(1)
+        controller.upsert(record)
+        actual = controller.select()
+        record = self.get_record(1)
+        self.assertEqual([record], actual)
+
+    def test_select_total(self):
+        controller = self.get_instance()
+        actual = controller.select_total()
+        self.assertEqual((0, 0), actual)
+
+        controller.upsert([self.get_record(1), self.get_record(2)])
+        actual = controller.select_total()
+        self.assertEqual((2, 300), actual)
+
+    def test_select_oldest(self):
+        controller = self.get_instance()
+        actual = controller.select_oldest(2)
+        self.assertEqual([], actual)
+
+        controller.upsert([self.get_record(3), self.get_record(1), self.get_record(2)])
+        actual = controller.select_oldest(2)
+        self.assertEqual([self.get_record(1), self.get_record(2)], actual)
+
+    def test_count_by_store_path(self):
+        controller = self.get_instance()
+        store_path = ".store/md/md5.png"
+        actual = controller.count_by_store_path(store_path)
+        self.assertEqual(0, actual)
+
+        controller.upsert([self.get_record(1, store_path=store_path), self.get_record(2, store_path=store_path)])
+        controller.upsert(self.get_record(3))
+        actual = controller.count_by_store_path(store_path)
+        self.assertEqual(2, actual)
+
+    def test_delete(self):
+        controller = self.get_instance()
+        controller.upsert([self.get_record(1), self.get_record(2), self.get_record(3)])
+        actual = controller.delete(self.get_record(1))
+        self.assertEqual(1, actual)
+        actual = controller.delete([self.get_record(2), self.get_record(4)])
+        self.assertEqual(1, actual)
+        actual = controller.select()
+        self.assertEqual([self.get_record(3)], actual)
+
+        with self.assertRaises(TypeError):
+            actual = controller.delete([])
+        with self.assertRaises(TypeError):
+            actual = controller.delete("invalid_element")
+
+    def test_upsert(self):
+        controller = self.get_instance()
+        record1 = self.get_record(1)
+        actual = controller.upsert(record1)
+        self.assertEqual([0], actual)
+
+        record1 = self.get_record(1)
+        record1.size = 12345
+        actual = controller.upsert(record1)
+        self.assertEqual([1], actual)
+
+        record2 = self.get_record(2, "dict")
+        actual = controller.upsert([record2])
+        self.assertEqual([0], actual)
+        record2 = MediaFile.create(record2)
+
+        actual = controller.select()
+        self.assertEqual([record1, record2], actual)
+        self.assertEqual(12345, actual[0].size)
+
+        with self.assertRaises(TypeError):
+            actual = controller.upsert([])
+        with self.assertRaises(TypeError):
+            actual = controller.upsert("invalid_element")
+
+
+if __name__ == "__main__":
+    if sys.argv:
+        del sys.argv[1:]
+    unittest.main(warnings="ignore")
@@ -0,0 +1,259 @@
+import sys
+import unittest
+from contextlib import ExitStack
+
+from mock import MagicMock, patch
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.pool import StaticPool
+
+from misskey_crawler.db.base import Database
+from misskey_crawler.db.migration import (
+    Migrator,
+    add_backfill_window_cursor,
+    add_reaction_account,
+    add_secondary_index,
+    convert_timestamp_to_epoch_ms,
+    rebuild_table,
+)
+from misskey_crawler.db.model import Base as ModelBase
+from misskey_crawler.util import to_epoch_ms
+
+# バージョン管理を始める前のスキーマ
+LEGACY_DDL_LIST = [
+    """CREATE TABLE "Reaction" (
+        id INTEGER NOT NULL, note_id VARCHAR(256) NOT NULL, reaction_id VARCHAR(256) NOT NULL,
+        type VARCHAR(256) NOT NULL, created_at VARCHAR(256) NOT NULL, registered_at VARCHAR(256) NOT NULL,
+        PRIMARY KEY (id), UNIQUE (note_id)
+    )""",
+    """CREATE TABLE "Note" (
+        id INTEGER NOT NULL, note_id VARCHAR(256) NOT NULL, user_id VARCHAR(256) NOT NULL, url VARCHAR(256) NOT NULL,
+        text VARCHAR(256), created_at VARCHAR(256) NOT NULL, registered_at VARCHAR(256) NOT NULL,
+        PRIMARY KEY (id), UNIQUE (note_id)
+    )""",
+    """CREATE TABLE "User" (
+        id INTEGER NOT NULL, user_id VARCHAR(256) NOT NULL, name VARCHAR(256), username VARCHAR(256) NOT NULL,
+        avatar_url VARCHAR(512), is_bot BOOLEAN, is_cat BOOLEAN, registered_at VARCHAR(256) NOT NULL,
+        PRIMARY KEY (id), UNIQUE (user_id)
+    )""",
+    """CREATE TABLE "Media" (
+        id INTEGER NOT NULL, note_id VARCHAR(256) NOT NULL, media_id VARCHAR(256) NOT NULL, name VARCHAR(256),
+        type VARCHAR(256) NOT NULL, md5 VARCHAR(256) NOT NULL, size INTEGER NOT NULL, url VARCHAR(512) NOT NULL,
+        created_at VARCHAR(256) NOT NULL, registered_at VARCHAR(256) NOT NULL,
+        PRIMARY KEY (id), UNIQUE (media_id)
+    )""",
+]
+
+
+class TestMigrator(unittest.TestCase):
+    def get_engine(self):
+        return create_engine("sqlite:///:memory:", poolclass=StaticPool)
+
+    def get_index_name_list(self, engine, table_name: str) -> list[str]:
+        return [index["name"] for index in inspect(engine).get_indexes(table_name)]
+
+    def get_column_type_dict(self, engine, table_name: str) -> dict[str, str]:
+        return {column["name"]: str(column["type"]) for column in inspect(engine).get_columns(table_name)}
+
+    def create_legacy_schema(self, engine) -> None:
+        """インデックスがなく、日時を文字列で保持する、バージョン管理を始める前の DB を作る"""
+        with engine.begin() as conn:
+            for ddl in LEGACY_DDL_LIST:
+                conn.exec_driver_sql(ddl)
+            conn.exec_driver_sql(
+                'INSERT INTO "Reaction" VALUES (1, "note_id_1", "reaction_id_1", "👍", '
+                '"2023-09-10T12:55:55.054", "2023-09-11T00:00:00.123456")'
+            )
+            conn.exec_driver_sql(
+                'INSERT INTO "User" VALUES (1, "user_id_1", "name", "username", "", 0, 1, "2023-09-11T00:00:00")'
+            )
+
+    def test_init(self):
+        engine = self.get_engine()
+        migrator = Migrator(engine)
+        self.assertEqual(engine, migrator.engine)
+        self.assertEqual(len(Migrator.migration_list), migrator.latest_version)
+        self.assertIn(add_secondary_index, Migrator.migration_list)
+
+    def test_migrate(self):
+        with ExitStack() as stack:
+            mock_logger_info = stack.enter_context(patch("misskey_crawler.db.migration.logger.info"))
+            engine = self.get_engine()
+            self.create_legacy_schema(engine)
+            self.assertNotIn("ix_Reaction_reaction_id", self.get_index_name_list(engine, "Reaction"))
+
+            migrator = Migrator(engine)
+            actual = migrator.migrate()
+            self.assertEqual(migrator.latest_version, actual)
+            with engine.connect() as conn:
+                self.assertEqual(migrator.latest_version, Migrator.get_version(conn))
+            self.assertIn("ix_Reaction_reaction_id", self.get_index_name_list(engine, "Reaction"))
+            self.assertIn("ix_Media_note_id", self.get_index_name_list(engine, "Media"))
+            self.assertIn("ix_Note_user_id", self.get_index_name_list(engine, "Note"))
+            self.assertIn("ix_Reaction_created_at", self.get_index_name_list(engine, "Reaction"))
+            self.assertEqual("INTEGER", self.get_column_type_dict(engine, "Reaction")["created_at"])
+            mock_logger_info.assert_called()
+
+            # マイグレーション後のスキーマは create_all で作るものと同じになる
+            fresh_engine = self.get_engine()
+            ModelBase.metadata.create_all(fresh_engine)
+            for table_name in ["Reaction", "Note", "User", "Media"]:
+                self.assertEqual(
+                    self.get_column_type_dict(fresh_engine, table_name),
+                    self.get_column_type_dict(engine, table_name),
+                )
+                self.assertEqual(
+                    sorted(self.get_index_name_list(fresh_engine, table_name)),
+                    sorted(self.get_index_name_list(engine, table_name)),
+                )
+
+            # 適用済みなら何もしない
+            actual = migrator.migrate()
+            self.assertEqual(0, actual)
+
+            # 未適用のものだけを順に適用する
+            mock_migration = MagicMock(__name__="mock_migration")
+            migration_list = [*Migrator.migration_list, mock_migration]
+            stack.enter_context(patch.object(Migrator, "migration_list", migration_list))
+            actual = migrator.migrate()
+            self.assertEqual(1, actual)
+            mock_migration.assert_called_once()
+            with engine.connect() as conn:
+                self.assertEqual(len(migration_list), Migrator.get_version(conn))
+
+    def test_convert_timestamp_to_epoch_ms(self):
+        engine = self.get_engine()
+        self.create_legacy_schema(engine)
+        with engine.begin() as conn:
+            add_secondary_index(conn)
+            convert_timestamp_to_epoch_ms(conn)
+
+        # タイムゾーンのない日時は JST とみなして変換する
+        with engine.connect() as conn:
+            row = conn.exec_driver_sql(
+                'SELECT id, note_id, reaction_id, type, created_at, registered_at FROM "Reaction"'
+            ).one()
+            self.assertEqual(
+                (1, "note_id_1", "reaction_id_1", "👍", 1694318155054, to_epoch_ms("2023-09-11T00:00:00.123+09:00")),
+                tuple(row),
+            )
+            row = conn.exec_driver_sql('SELECT registered_at, is_cat FROM "User"').one()
+            self.assertEqual((to_epoch_ms("2023-09-11T00:00:00+09:00"), 1), tuple(row))
+            self.assertEqual("integer", conn.exec_driver_sql('SELECT typeof(created_at) FROM "Reaction"').scalar())
+        self.assertIn("ix_Reaction_reaction_id", self.get_index_name_list(engine, "Reaction"))
+
+    def test_rebuild_table(self):
+        engine = self.get_engine()
+        self.create_legacy_schema(engine)
+        with engine.begin() as conn:
+            rebuild_table(conn, "User", {"name": "TEXT"}, lambda column, value: value, chunk_size=1)
+            # テーブルがなければ何もしない
+            rebuild_table(conn, "MediaFile", {"created_at": "INTEGER"}, lambda column, value: value)
+        self.assertEqual("TEXT", self.get_column_type_dict(engine, "User")["name"])
+        self.assertEqual("VARCHAR(256)", self.get_column_type_dict(engine, "User")["username"])
+        self.assertNotIn("MediaFile", inspect(engine).get_table_names())
+        with engine.connect() as conn:
+            self.assertEqual(1, conn.exec_driver_sql('SELECT count(*) FROM "User"').scalar())
+
+    def test_add_backfill_window_cursor(self):
+        engine = self.get_engine()
+        with engine.begin() as conn:
+            # テーブルがなければ何もしない
+            add_backfill_window_cursor(conn)
+            conn.exec_driver_sql(
+                """CREATE TABLE "BackfillWindow" (
+                    id INTEGER NOT NULL, window_key VARCHAR(512) NOT NULL, account VARCHAR(256) NOT NULL,
+                    since_id VARCHAR(256) NOT NULL, until_id VARCHAR(256) NOT NULL, is_done BOOLEAN NOT NULL,
+                    updated_at VARCHAR(256) NOT NULL, PRIMARY KEY (id), UNIQUE (window_key)
+                )"""
+            )
+            conn.exec_driver_sql(
+                'INSERT INTO "BackfillWindow" VALUES (1, "window_key", "account", "since_id", "until_id", 0, "")'
+            )
+            add_backfill_window_cursor(conn)
+            add_backfill_window_cursor(conn)
+
+        # 既存の窓は先頭から取得し直す
+        with engine.connect() as conn:
+            row = conn.exec_driver_sql('SELECT cursor_id, page_num FROM "BackfillWindow"').one()
+            self.assertEqual(("", 0), tuple(row))
+        fresh_engine = self.get_engine()
+        ModelBase.metadata.create_all(fresh_engine)
+        self.assertEqual(
+            sorted(self.get_column_type_dict(fresh_engine, "BackfillWindow").items()),
+            sorted(self.get_column_type_dict(engine, "BackfillWindow").items()),
+        )
+
+    def test_add_reaction_account(self):
+        with ExitStack() as stack:
+            mock_logger_info = stack.enter_context(patch("misskey_crawler.db.migration.logger.info"))
+            engine = self.get_engine()
+            with engine.begin() as conn:
+                # テーブルがなければ何もしない
+                add_reaction_account(conn)
+            self.create_legacy_schema(engine)
+            with engine.begin() as conn:
+                add_secondary_index(conn)
+                convert_timestamp_to_epoch_ms(conn)
+                conn.exec_driver_sql(
+                    """CREATE TABLE "CrawlState" (
+                        id INTEGER NOT NULL, account VARCHAR(256) NOT NULL, last_reaction_id VARCHAR(256) NOT NULL,
+                        updated_at VARCHAR(256) NOT NULL, PRIMARY KEY (id), UNIQUE (account)
+                    )"""
+                )
+                conn.exec_driver_sql('INSERT INTO "CrawlState" VALUES (1, "@user@misskey.io", "reaction_id_1", "")')
+                add_reaction_account(conn)
+
+            # 既存のリアクションは CrawlState の唯一のアカウントのものとする
+            with engine.connect() as conn:
+                row = conn.exec_driver_sql('SELECT id, account, note_id, reaction_id FROM "Reaction"').one()
+                self.assertEqual((1, "@user@misskey.io", "note_id_1", "reaction_id_1"), tuple(row))
+
+                # 同じノートへのリアクションもアカウントが違えば記録できる
+                insert_sql = 'INSERT INTO "Reaction" VALUES (?, ?, "note_id_1", "reaction_id", "👍", 0, 0)'
+                conn.exec_driver_sql(insert_sql, (2, "@other@misskey.io"))
+                with self.assertRaises(IntegrityError):
+                    conn.exec_driver_sql(insert_sql, (3, "@user@misskey.io"))
+            self.assertIn("ix_Reaction_reaction_id", self.get_index_name_list(engine, "Reaction"))
+            self.assertIn("ix_Reaction_created_at", self.get_index_name_list(engine, "Reaction"))
+            mock_logger_info.assert_called()
+
+            # CrawlState のアカウントが1つでなければ空文字列とする
+            engine = self.get_engine()
+            self.create_legacy_schema(engine)
+            with engine.begin() as conn:
+                convert_timestamp_to_epoch_ms(conn)
+                add_reaction_account(conn)
+            with engine.connect() as conn:
+                self.assertEqual("", conn.exec_driver_sql('SELECT account FROM "Reaction"').scalar())
+
+    def test_migrate_failed(self):
+        with ExitStack() as stack:
+            mock_logger_info = stack.enter_context(patch("misskey_crawler.db.migration.logger.info"))
+            engine = self.get_engine()
+            self.create_legacy_schema(engine)
+
+            mock_migration = MagicMock(__name__="mock_migration", side_effect=ValueError("migration failed"))
+            migration_list = [*Migrator.migration_list, mock_migration]
+            stack.enter_context(patch.object(Migrator, "migration_list", migration_list))
+            with self.assertRaises(ValueError):
+                Migrator(engine).migrate()
+
+            # 失敗したマイグレーションはバージョンに含めない
+            with engine.connect() as conn:
+                self.assertEqual(len(migration_list) - 1, Migrator.get_version(conn))
+
+    def test_fresh_database(self):
+        # 新しい DB は最新のスキーマで作られ、最新のバージョンとなる
+        database = Database(":memory:")
+        with database.engine.connect() as conn:
+            self.assertEqual(Migrator(database.engine).latest_version, Migrator.get_version(conn))
+        self.assertIn("ix_Reaction_reaction_id", self.get_index_name_list(database.engine, "Reaction"))
+        self.assertIn("ix_Media_note_id", self.get_index_name_list(database.engine, "Media"))
+        self.assertIn("ix_Note_user_id", self.get_index_name_list(database.engine, "Note"))
+
+
+if __name__ == "__main__":
+    if sys.argv:
+        del sys.argv[1:]
+    unittest.main(warnings="ignore")
@@ -5,13 +5,14 @@ from pathlib import Path
 from typing import Literal
 
 from misskey_crawler.db.model import Media, Note, Reaction, User
+from misskey_crawler.util import to_epoch_ms
 
 
 class TestModel(unittest.TestCase):
     def get_record(
         self, id_num: int, type_kind: Literal["record", "list", "dict"] = "record"
     ) -> Media | list[Media] | list[dict]:
-        now_date = datetime.now().isoformat()
+        now_date = to_epoch_ms(datetime.now())
         arg_dict = {
             "note_id": f"note_id_{id_num}",
             "media_id": f"media_id_{id_num}",
@@ -30,6 +31,19 @@ class TestModel(unittest.TestCase):
             return [record]
         return record
 
+    def test_created_between(self):
+        since = to_epoch_ms("2023-09-01T00:00:00")
+        until = to_epoch_ms("2023-09-02T00:00:00")
+        for model in [Reaction, Note, Media]:
+            actual = model.created_between(datetime(2023, 9, 1), until).compile(compile_kwargs={"literal_binds": True})
+            expect = f"{model.__tablename__}.created_at >= {since} AND {model.__tablename__}.created_at < {until}"
+            self.assertIn(expect, str(actual).replace('"', ""))
+
+        actual = Reaction.created_between(since).compile(compile_kwargs={"literal_binds": True})
+        self.assertNotIn("<", str(actual))
+        actual = Reaction.created_between().compile(compile_kwargs={"literal_binds": True})
+        self.assertEqual("true", str(actual))
+
     def test_get_filename(self):
         media = self.get_record(1)
         ext = Path(media.url).suffix
@@ -5,6 +5,7 @@ from typing import Literal
 
 from misskey_crawler.db.model import Note
 from misskey_crawler.db.note_db import NoteDB
+from misskey_crawler.util import to_epoch_ms
 
 
 class TestNoteDB(unittest.TestCase):
@@ -15,7 +16,7 @@ class TestNoteDB(unittest.TestCase):
     def get_record(
         self, id_num: int, type_kind: Literal["record", "list", "dict"] = "record"
     ) -> Note | list[Note] | list[dict]:
-        now_date = datetime.now().isoformat()
+        now_date = to_epoch_ms(datetime.now())
         arg_dict = {
             "note_id": f"note_id_{id_num}",
             "user_id": f"user_id_{id_num}",
@@ -42,6 +43,24 @@ class TestNoteDB(unittest.TestCase):
         record = self.get_record(1)
         self.assertEqual([record], actual)
 
+    def test_select_created_between(self):
+        controller = self.get_instance()
+        record_list = []
+        for i in range(1, 5):
+            record = self.get_record(i)
+            record.created_at = to_epoch_ms(f"2023-09-{i:02}T00:00:00")
+            record_list.append(record)
+        controller.upsert(list(reversed(record_list)))
+
+        actual = controller.select_created_between(datetime(2023, 9, 2), datetime(2023, 9, 4))
+        self.assertEqual(record_list[1:3], actual)
+        actual = controller.select_created_between(since=record_list[2].created_at)
+        self.assertEqual(record_list[2:], actual)
+        actual = controller.select_created_between(until=datetime(2023, 9, 2))
+        self.assertEqual(record_list[:1], actual)
+        actual = controller.select_created_between()
+        self.assertEqual(record_list, actual)
+
     def test_upsert(self):
         controller = self.get_instance()
         record1 = self.get_record(1)
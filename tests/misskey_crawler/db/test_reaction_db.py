@@ -5,6 +5,8 @@ from typing import Literal
 
 from misskey_crawler.db.model import Reaction
 from misskey_crawler.db.reaction_db import ReactionDB
+from misskey_crawler.util import to_epoch_ms
+from misskey_crawler.util.misskey_id import decode_time, encode_boundary
 
 
 class TestReactionDB(unittest.TestCase):
@@ -15,8 +17,9 @@ class TestReactionDB(unittest.TestCase):
     def get_record(
         self, id_num: int, type_kind: Literal["record", "list", "dict"] = "record"
     ) -> Reaction | list[Reaction] | list[dict]:
-        now_date = datetime.now().isoformat()
+        now_date = to_epoch_ms(datetime.now())
         arg_dict = {
+            "account": "@user@misskey.io",
             "note_id": f"note_id_{id_num}",
             "reaction_id": f"reaction_id_{id_num}",
             "type": "❤",
@@ -46,15 +49,65 @@ class TestReactionDB(unittest.TestCase):
         actual = controller.select_last_record()
         self.assertEqual(None, actual)
 
-        record = self.get_record(2)
-        controller.upsert(record)
-        record = self.get_record(3)
-        controller.upsert(record)
-        record = self.get_record(1)
-        controller.upsert(record)
+        def get_record_with_id(id_num: int, reaction_id: str) -> Reaction:
+            record = self.get_record(id_num)
+            record.reaction_id = reaction_id
+            record.created_at = decode_time(reaction_id)
+            return record
+
+        # 文字列順ではなく生成日時順で最も新しいものを返す
+        aid = "9ko8xyzq0a"
+        aidx = "9ko8xyzq0a1b0001"
+        ulid = encode_boundary(decode_time(aid) + 1, "ulid")
+        controller.upsert([get_record_with_id(2, aidx), get_record_with_id(3, ulid), get_record_with_id(1, aid)])
         actual = controller.select_last_record()
-        expect = self.get_record(3)
-        self.assertEqual(expect, actual)
+        self.assertEqual(get_record_with_id(3, ulid), actual)
+        self.assertEqual(ulid, actual.reaction_id)
+
+        # 同じ日時なら ID で比較する
+        controller.upsert(get_record_with_id(4, ulid[:-1] + "1"))
+        actual = controller.select_last_record()
+        self.assertEqual(ulid[:-1] + "1", actual.reaction_id)
+
+    def test_select_created_between(self):
+        controller = self.get_instance()
+        record_list = []
+        for i in range(1, 5):
+            record = self.get_record(i)
+            record.created_at = to_epoch_ms(f"2023-09-{i:02}T00:00:00")
+            record_list.append(record)
+        controller.upsert(list(reversed(record_list)))
+
+        actual = controller.select_created_between(datetime(2023, 9, 2), datetime(2023, 9, 4))
+        self.assertEqual(record_list[1:3], actual)
+        actual = controller.select_created_between(since=record_list[2].created_at)
+        self.assertEqual(record_list[2:], actual)
+        actual = controller.select_created_between(until=datetime(2023, 9, 2))
+        self.assertEqual(record_list[:1], actual)
+        actual = controller.select_created_between()
+        self.assertEqual(record_list, actual)
+
+    def test_assign_legacy_account(self):
+        controller = self.get_instance()
+        legacy_record_list = []
+        for i in range(1, 4):
+            record = self.get_record(i)
+            record.account = ""
+            legacy_record_list.append(record)
+        controller.upsert(legacy_record_list)
+        record3 = self.get_record(3)
+        record3.type = "new_type"
+        controller.upsert(record3)
+
+        # 記録済みのノートのものは記録済みのものを残す
+        actual = controller.assign_legacy_account("@user@misskey.io")
+        self.assertEqual(2, actual)
+        actual = controller.select()
+        self.assertEqual([self.get_record(1), self.get_record(2), record3], actual)
+        self.assertEqual("new_type", actual[2].type)
+
+        actual = controller.assign_legacy_account("@user@misskey.io")
+        self.assertEqual(0, actual)
 
     def test_upsert(self):
         controller = self.get_instance()
@@ -94,6 +147,17 @@ class TestReactionDB(unittest.TestCase):
         actual = controller.upsert([record1, record2])
         self.assertEqual([1, 1], actual)
 
+        # 同じノートへのリアクションもアカウントごとに記録する
+        other_record1 = self.get_record(1)
+        other_record1.account = "@other@misskey.io"
+        other_record1.type = "other_type"
+        actual = controller.upsert([other_record1])
+        self.assertEqual([0], actual)
+        actual = controller.select()
+        self.assertEqual([record1, record2, record3, other_record1], actual)
+        self.assertEqual("❤", actual[0].type)
+        self.assertEqual("other_type", actual[3].type)
+
         with self.assertRaises(TypeError):
             record1 = self.get_record(1)
             actual = controller.upsert([record1, 1])
@@ -5,6 +5,7 @@ from typing import Literal
 
 from misskey_crawler.db.model import User
 from misskey_crawler.db.user_db import UserDB
+from misskey_crawler.util import to_epoch_ms
 
 
 class TestUserDB(unittest.TestCase):
@@ -15,7 +16,7 @@ class TestUserDB(unittest.TestCase):
     def get_record(
         self, id_num: int, type_kind: Literal["record", "list", "dict"] = "record"
     ) -> User | list[User] | list[dict]:
-        now_date = datetime.now().isoformat()
+        now_date = to_epoch_ms(datetime.now())
         arg_dict = {
             "user_id": f"user_id_{id_num}",
             "name": "name",
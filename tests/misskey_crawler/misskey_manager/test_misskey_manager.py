@@ -1,12 +1,14 @@
+import asyncio
 import sys
 import unittest
 from contextlib import ExitStack
 from logging import getLogger
-from unittest.mock import MagicMock
 
+import httpx
+import orjson
 from mock import patch
 
-from misskey_crawler.misskey_manager.misskey_manager import MisskeyManager
+from misskey_crawler.misskey_manager.misskey_manager import MisskeyAPIError, MisskeyManager
 
 logger = getLogger("misskey_manager.misskey_manager")
 
@@ -16,43 +18,84 @@ class TestMisskey(unittest.TestCase):
         self.instance_name = "instance_name"
         self.token = "misskey_token"
 
-    def get_instance(self) -> MisskeyManager:
-        with ExitStack() as stack:
-            mock_logger_info = stack.enter_context(patch.object(logger, "info"))
-            mock_misskey = stack.enter_context(patch("misskey_crawler.misskey_manager.misskey_manager.Mk"))
-            misskey = MisskeyManager(self.instance_name, self.token)
-            return misskey
+    def get_instance(self, handler=None) -> MisskeyManager:
+        misskey = MisskeyManager(self.instance_name, self.token)
+        if handler:
+            misskey.client = httpx.AsyncClient(
+                base_url=f"https://{self.instance_name}/api/", transport=httpx.MockTransport(handler)
+            )
+        return misskey
 
     def test_init(self):
+        misskey = MisskeyManager(self.instance_name, self.token)
+        self.assertEqual(self.instance_name, misskey.instance_name)
+        self.assertEqual(self.token, misskey.token)
+        self.assertEqual(f"https://{self.instance_name}/api/", str(misskey.client.base_url))
+        self.assertEqual(120, misskey.client.timeout.read)
+        asyncio.run(misskey.aclose())
+        self.assertEqual(True, misskey.client.is_closed)
+
+    def test_i(self):
         with ExitStack() as stack:
-            mock_logger_info = stack.enter_context(patch.object(logger, "info"))
-            mock_misskey = stack.enter_context(patch("misskey_crawler.misskey_manager.misskey_manager.Mk"))
-            misskey = MisskeyManager(self.instance_name, self.token)
-            mock_misskey.assert_called_once_with(self.instance_name, i=self.token)
-            self.assertEqual(self.instance_name, misskey.instance_name)
-            self.assertEqual(self.token, misskey.token)
-            self.assertEqual(120, misskey.misskey.timeout)
-
-    def test_user_dict(self):
-        misskey = self.get_instance()
-        misskey.misskey.i = MagicMock(return_value={"id": "user1user1"})
-        actual = misskey.user_dict
-        self.assertEqual({"id": "user1user1"}, actual)
-        misskey.misskey.i.assert_called_once_with()
-        misskey.misskey.i.reset_mock()
-
-        actual = misskey.user_dict
-        self.assertEqual({"id": "user1user1"}, actual)
-        misskey.misskey.i.assert_not_called()
+            mock_run = stack.enter_context(
+                patch("misskey_crawler.misskey_manager.misskey_manager.MisskeyManager._run")
+            )
+            mock_run.return_value = {"id": "user1user1"}
+
+            misskey = self.get_instance()
+            actual = asyncio.run(misskey.i())
+            self.assertEqual({"id": "user1user1"}, actual)
+            mock_run.assert_awaited_once_with("i")
+            mock_run.reset_mock()
+
+            actual = asyncio.run(misskey.i())
+            self.assertEqual({"id": "user1user1"}, actual)
+            mock_run.assert_not_awaited()
 
     def test_run(self):
-        misskey = self.get_instance()
-        misskey.misskey._Misskey__request_api = MagicMock(return_value="__request_api_return")
+        request_list: list[httpx.Request] = []
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            request_list.append(request)
+            match request.url.path:
+                case "/api/users/reactions":
+                    return httpx.Response(200, json=[{"id": "reaction_id"}])
+                case "/api/no_content":
+                    return httpx.Response(204)
+                case _:
+                    return httpx.Response(400, json={"error": {"code": "INVALID_PARAM", "message": "Invalid param."}})
+
+        misskey = self.get_instance(handler)
         path = "users/reactions"
         params = {"userId": "user1user1"}
-        actual = misskey._run(path, params)
-        self.assertEqual("__request_api_return", actual)
-        misskey.misskey._Misskey__request_api.assert_called_once_with(path, **params)
+        actual = asyncio.run(misskey._run(path, params))
+        self.assertEqual([{"id": "reaction_id"}], actual)
+        self.assertEqual("POST", request_list[0].method)
+        self.assertEqual({"userId": "user1user1", "i": self.token}, orjson.loads(request_list[0].content))
+
+        actual = asyncio.run(misskey._run("no_content"))
+        self.assertEqual(True, actual)
+
+        with self.assertRaises(MisskeyAPIError) as context:
+            asyncio.run(misskey._run("invalid_path"))
+        self.assertEqual(400, context.exception.status_code)
+        self.assertEqual("INVALID_PARAM", context.exception.code)
+
+    def test_users_reactions(self):
+        with ExitStack() as stack:
+            mock_run = stack.enter_context(
+                patch("misskey_crawler.misskey_manager.misskey_manager.MisskeyManager._run")
+            )
+            mock_run.side_effect = lambda path, params: params
+
+            misskey = self.get_instance()
+            actual = asyncio.run(misskey.users_reactions("user1user1", 10))
+            self.assertEqual({"userId": "user1user1", "limit": 10}, actual)
+            mock_run.assert_awaited_once_with("users/reactions", {"userId": "user1user1", "limit": 10})
+
+            actual = asyncio.run(misskey.users_reactions("user1user1", 10, "since_id", "until_id"))
+            params = {"userId": "user1user1", "limit": 10, "sinceId": "since_id", "untilId": "until_id"}
+            self.assertEqual(params, actual)
 
     def test_notes_with_reactions(self):
         with ExitStack() as stack:
@@ -60,15 +103,21 @@ class TestMisskey(unittest.TestCase):
                 patch("misskey_crawler.misskey_manager.misskey_manager.MisskeyManager._run")
             )
             mock_run.side_effect = lambda path, params: params
+            mock_i = stack.enter_context(patch("misskey_crawler.misskey_manager.misskey_manager.MisskeyManager.i"))
+            mock_i.return_value = {"id": "user1user1"}
 
             misskey = self.get_instance()
-            misskey.misskey.i = MagicMock(return_value={"id": "user1user1"})
             limit = 10
             last_since_id = "last_since_id"
-            actual = misskey.notes_with_reactions(limit, last_since_id)
+            actual = asyncio.run(misskey.notes_with_reactions(limit, last_since_id))
             params = {"userId": "user1user1", "limit": int(limit), "sinceId": last_since_id}
             self.assertEqual(params, actual)
 
+            last_until_id = "last_until_id"
+            actual = asyncio.run(misskey.notes_with_reactions(limit, last_until_id=last_until_id))
+            params = {"userId": "user1user1", "limit": int(limit), "untilId": last_until_id}
+            self.assertEqual(params, actual)
+
 
 if __name__ == "__main__":
     if sys.argv:
@@ -0,0 +1,138 @@
+import asyncio
+import sys
+import unittest
+from contextlib import ExitStack
+from logging import getLogger
+
+import httpx
+from mock import AsyncMock, patch
+
+from misskey_crawler.misskey_manager.request_scheduler import EndpointStats, RequestScheduler, TokenBucket
+
+logger = getLogger("misskey_crawler.misskey_manager.request_scheduler")
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+    async def sleep(self, delay: float) -> None:
+        self.now += delay
+
+
+class TestRequestScheduler(unittest.TestCase):
+    def enter_fake_clock(self, stack: ExitStack) -> FakeClock:
+        clock = FakeClock()
+        stack.enter_context(patch("misskey_crawler.misskey_manager.request_scheduler.time.monotonic", clock.monotonic))
+        stack.enter_context(patch("misskey_crawler.misskey_manager.request_scheduler.asyncio.sleep", clock.sleep))
+        stack.enter_context(patch.object(logger, "warning"))
+        stack.enter_context(patch.object(logger, "info"))
+        return clock
+
+    def test_token_bucket(self):
+        with ExitStack() as stack:
+            clock = self.enter_fake_clock(stack)
+            bucket = TokenBucket(rate=2.0, capacity=2.0, max_rate=4.0)
+
+            # バースト分は待たずに取得できる
+            self.assertEqual(0.0, asyncio.run(bucket.acquire()))
+            self.assertEqual(0.0, asyncio.run(bucket.acquire()))
+            # 以降は rate に従って待つ
+            self.assertAlmostEqual(0.5, asyncio.run(bucket.acquire()))
+
+            bucket.pause(10.0)
+            self.assertAlmostEqual(10.0 + 0.5, asyncio.run(bucket.acquire()))
+
+            bucket.on_rate_limited()
+            self.assertEqual(1.0, bucket.rate)
+            for _ in range(100):
+                bucket.on_success()
+            self.assertEqual(4.0, bucket.rate)
+
+    def test_create(self):
+        scheduler = RequestScheduler.create({})
+        self.assertEqual(2.0, scheduler.rate)
+        self.assertEqual(5, scheduler.max_retries)
+
+        scheduler = RequestScheduler.create({"rate": 1.0, "max_retries": 3, "unknown_key": 0})
+        self.assertEqual(1.0, scheduler.rate)
+        self.assertEqual(3, scheduler.max_retries)
+
+    def test_parse_retry_after(self):
+        response = httpx.Response(429, headers={"Retry-After": "3"})
+        self.assertEqual(3.0, RequestScheduler.parse_retry_after(response))
+
+        response = httpx.Response(429, headers={"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"})
+        self.assertEqual(0.0, RequestScheduler.parse_retry_after(response))
+
+        response = httpx.Response(429, headers={"X-RateLimit-Reset": "1.5"})
+        self.assertEqual(1.5, RequestScheduler.parse_retry_after(response))
+
+        response = httpx.Response(429)
+        self.assertIsNone(RequestScheduler.parse_retry_after(response))
+
+    def test_request(self):
+        with ExitStack() as stack:
+            clock = self.enter_fake_clock(stack)
+            scheduler = RequestScheduler(rate=1.0, burst=1.0, max_retries=2)
+
+            response_list = [
+                httpx.Response(429, headers={"Retry-After": "5"}),
+                httpx.Response(503),
+                httpx.Response(200, json=[]),
+            ]
+            send = AsyncMock(side_effect=response_list)
+            actual = asyncio.run(scheduler.request("users/reactions", send))
+            self.assertEqual(200, actual.status_code)
+            self.assertEqual(3, send.await_count)
+
+            stats = scheduler.stats_dict["users/reactions"]
+            self.assertEqual(3, stats.request_num)
+            self.assertEqual(1, stats.success_num)
+            self.assertEqual(2, stats.retry_num)
+            self.assertEqual(1, stats.rate_limited_num)
+            self.assertGreaterEqual(stats.wait_time, 5.0)
+
+            # リトライ上限に達したらエラーレスポンスのまま返す
+            send = AsyncMock(return_value=httpx.Response(429))
+            actual = asyncio.run(scheduler.request("users/reactions", send))
+            self.assertEqual(429, actual.status_code)
+            self.assertEqual(3, send.await_count)
+
+            # トランスポートエラーはリトライ上限を超えたら送出する
+            send = AsyncMock(side_effect=httpx.ConnectError("connect error"))
+            with self.assertRaises(httpx.ConnectError):
+                asyncio.run(scheduler.request("i", send))
+            self.assertEqual(3, send.await_count)
+
+            scheduler.log_stats()
+
+    def test_observe_headers(self):
+        with ExitStack() as stack:
+            clock = self.enter_fake_clock(stack)
+            scheduler = RequestScheduler()
+            bucket = scheduler.get_bucket("users/reactions")
+
+            response = httpx.Response(200, headers={"X-RateLimit-Remaining": "1", "X-RateLimit-Reset": "30"})
+            scheduler.observe_headers(bucket, response)
+            self.assertEqual(0.0, bucket.pause_until)
+
+            response = httpx.Response(200, headers={"X-RateLimit-Remaining": "0", "X-RateLimit-Reset": "30"})
+            scheduler.observe_headers(bucket, response)
+            self.assertEqual(clock.now + 30.0, bucket.pause_until)
+
+    def test_throughput(self):
+        with ExitStack() as stack:
+            clock = self.enter_fake_clock(stack)
+            stats = EndpointStats(success_num=10)
+            clock.now += 5.0
+            self.assertEqual(2.0, stats.throughput())
+
+
+if __name__ == "__main__":
+    if sys.argv:
+        del sys.argv[1:]
+    unittest.main(warnings="ignore")
@@ -1,13 +1,36 @@
 import sys
 import unittest
 from contextlib import ExitStack
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
 
 import freezegun
 import orjson
 
-from misskey_crawler.util import find_values, to_jst
+from misskey_crawler.util import (
+    JST,
+    compile_key_path,
+    find_key_path,
+    find_values,
+    from_epoch_ms,
+    iter_key_path,
+    iter_values,
+    to_epoch_ms,
+    to_jst,
+)
+
+
+class UnreachableDict(dict):
+    """中をたどると例外を送出する辞書、値を見つけた時点で探索を打ち切っているかの確認に使う"""
+
+    def items(self):
+        raise AssertionError("unreachable")
+
+    def __contains__(self, key):
+        raise AssertionError("unreachable")
+
+    def __getitem__(self, key):
+        raise AssertionError("unreachable")
 
 
 class TestUtil(unittest.TestCase):
@@ -103,6 +126,70 @@ class TestUtil(unittest.TestCase):
         with self.assertRaises(ValueError):
             actual = find_values(sample_dict, "invalid_key", True)
 
+    def test_iter_values(self):
+        cache_filepath = Path("./tests/misskey_crawler/cache/test_notes_with_reactions.json")
+        sample_dict = orjson.loads(cache_filepath.read_bytes()).get("result")
+
+        # find_values と同じ順に返す
+        value_iter = iter_values(sample_dict, "username")
+        self.assertEqual("user1_username", next(value_iter))
+        self.assertEqual(find_values(sample_dict, "username")[1:], list(value_iter))
+        self.assertEqual(
+            find_values(sample_dict, "name", False, ["note", "files"]),
+            list(iter_values(sample_dict, "name", ["note", "files"])),
+        )
+        self.assertEqual([], list(iter_values("invalid_object", "username")))
+
+        # 必要な分だけたどる
+        value_iter = iter_values([{"id": 1}, UnreachableDict(id=2)], "id")
+        self.assertEqual(1, next(value_iter))
+
+        # 一意に確定する想定の指定では、2つ目が見つかった時点で打ち切る
+        with self.assertRaises(ValueError):
+            find_values([{"id": 1}, {"id": 2}, UnreachableDict(id=3)], "id", True)
+
+    def test_compile_key_path(self):
+        walk = compile_key_path("note.files[*].url")
+        self.assertIs(walk, compile_key_path("note.files[*].url"))
+        entry = {"note": {"files": [{"url": "url_1"}, {"name": "no_url"}, {"url": "url_2"}]}}
+        self.assertEqual(["url_1", "url_2"], list(walk(entry)))
+
+        for key_path in ["", "note..files", "note.", "note[x]", "note[*]files", "note]"]:
+            with self.assertRaises(ValueError):
+                compile_key_path(key_path)
+
+    def test_iter_key_path(self):
+        cache_filepath = Path("./tests/misskey_crawler/cache/test_notes_with_reactions.json")
+        sample_dict = orjson.loads(cache_filepath.read_bytes())
+
+        actual = list(iter_key_path(sample_dict, "result[*].note.files[*].name"))
+        self.assertEqual(find_values(sample_dict["result"], "name", False, ["note", "files"]), actual)
+        actual = list(iter_key_path(sample_dict, "result[-1].note.user.username"))
+        self.assertEqual([sample_dict["result"][-1]["note"]["user"]["username"]], actual)
+        actual = list(iter_key_path(sample_dict["result"], "[0].id"))
+        self.assertEqual([sample_dict["result"][0]["id"]], actual)
+
+        # たどれない枝は無視する
+        self.assertEqual([], list(iter_key_path(sample_dict, "result[99].id")))
+        self.assertEqual([], list(iter_key_path(sample_dict, "result.id")))
+        self.assertEqual([], list(iter_key_path(sample_dict, "result[*].invalid_key")))
+        self.assertEqual([], list(iter_key_path("invalid_object", "result[*]")))
+
+        # 必要な分だけたどる
+        value_iter = iter_key_path([{"id": 1}, UnreachableDict(id=2)], "[*].id")
+        self.assertEqual(1, next(value_iter))
+
+    def test_find_key_path(self):
+        entry = {"note": {"id": "note_id", "files": [{"url": "url_1"}, {"url": "url_2"}]}}
+        self.assertEqual(["url_1", "url_2"], find_key_path(entry, "note.files[*].url"))
+        self.assertEqual("note_id", find_key_path(entry, "note.id", True))
+        self.assertEqual("url_2", find_key_path(entry, "note.files[1].url", True))
+
+        with self.assertRaises(ValueError):
+            find_key_path(entry, "note.invalid_key", True)
+        with self.assertRaises(ValueError):
+            find_key_path({"files": [{"url": 1}, {"url": 2}, UnreachableDict(url=3)]}, "files[*].url", True)
+
     def test_to_jst(self):
         with ExitStack() as stack:
             freeze_gun = stack.enter_context(freezegun.freeze_time("2023/09/11 00:00:00"))
@@ -113,6 +200,26 @@ class TestUtil(unittest.TestCase):
             with self.assertRaises(ValueError):
                 actual = to_jst("gmt")
 
+    def test_to_epoch_ms(self):
+        expect = 1694318155054
+        self.assertEqual(expect, to_epoch_ms("2023-09-10T03:55:55.054Z"))
+        self.assertEqual(expect, to_epoch_ms(datetime(2023, 9, 10, 3, 55, 55, 54000, timezone.utc)))
+
+        # タイムゾーンのない日時は JST とみなす
+        self.assertEqual(expect, to_epoch_ms("2023-09-10T12:55:55.054"))
+        self.assertEqual(expect, to_epoch_ms("2023-09-10T12:55:55.054+09:00"))
+
+        with self.assertRaises(ValueError):
+            actual = to_epoch_ms(1694318155054)
+        with self.assertRaises(ValueError):
+            actual = to_epoch_ms("invalid_date")
+
+    def test_from_epoch_ms(self):
+        actual = from_epoch_ms(1694318155054)
+        self.assertEqual(datetime(2023, 9, 10, 12, 55, 55, 54000, JST), actual)
+        self.assertEqual(JST, actual.tzinfo)
+        self.assertEqual(1694318155054, to_epoch_ms(actual))
+
 
 if __name__ == "__main__":
     if sys.argv:
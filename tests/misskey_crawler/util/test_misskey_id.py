@@ -0,0 +1,101 @@
+import sys
+import unittest
+
+from misskey_crawler.util import to_epoch_ms
+from misskey_crawler.util.misskey_id import (
+    ID_FORMAT_LIST,
+    compare,
+    decode_time,
+    detect_format,
+    encode_boundary,
+    encode_boundary_list,
+    max_id,
+    min_id,
+    sort_key,
+)
+
+
+class TestMisskeyId(unittest.TestCase):
+    # 同じ日時 2023-10-11T03:55:33.734+09:00 に生成された各形式の ID
+    epoch_ms: int = to_epoch_ms("2023-10-11T03:55:33.734+09:00")
+    id_dict: dict[str, str] = {
+        "aid": "9ko8xyzq0a",
+        "aidx": "9ko8xyzq0a1b0001",
+        "meid": "818b1af1c366123456789abc",
+        "meidg": "g18b1af1c366123456789abc",
+        "objectid": "65259e250123456789abcdef",
+        "ulid": "01HCDF3GV6ABCDEFGHJKMNPQRS",
+    }
+
+    def test_detect_format(self):
+        for id_format, misskey_id in self.id_dict.items():
+            self.assertEqual(id_format, detect_format(misskey_id))
+        with self.assertRaises(ValueError):
+            detect_format("reaction_id_1")
+        with self.assertRaises(ValueError):
+            detect_format("")
+
+    def test_decode_time(self):
+        for id_format, misskey_id in self.id_dict.items():
+            expect = self.epoch_ms // 1000 * 1000 if id_format == "objectid" else self.epoch_ms
+            self.assertEqual(expect, decode_time(misskey_id), id_format)
+            self.assertEqual(expect, decode_time(misskey_id, id_format), id_format)
+
+        # ulid は大文字小文字を区別しない
+        self.assertEqual(self.epoch_ms, decode_time(self.id_dict["ulid"].lower()))
+        with self.assertRaises(ValueError):
+            decode_time("reaction_id_1")
+
+    def test_encode_boundary(self):
+        for id_format in ID_FORMAT_LIST:
+            lower = encode_boundary(self.epoch_ms, id_format)
+            upper = encode_boundary(self.epoch_ms, id_format, True)
+            self.assertEqual(id_format, detect_format(lower))
+            self.assertEqual(len(self.id_dict[id_format]), len(lower))
+            self.assertEqual(decode_time(self.id_dict[id_format]), decode_time(lower))
+            self.assertEqual(decode_time(self.id_dict[id_format]), decode_time(upper))
+
+            # 同じ形式なら文字列順で実在の ID を挟む
+            self.assertLessEqual(lower, self.id_dict[id_format])
+            self.assertGreaterEqual(upper, self.id_dict[id_format])
+            self.assertLess(upper, encode_boundary(self.epoch_ms + 1000, id_format))
+
+        self.assertEqual("9ko8xyzq00", encode_boundary(self.epoch_ms, "aid"))
+        self.assertEqual("9ko8xyzqzz", encode_boundary(self.epoch_ms, "aid", True))
+
+    def test_encode_boundary_list(self):
+        epoch_ms_list = [self.epoch_ms, self.epoch_ms + 1]
+        for id_format in ID_FORMAT_LIST:
+            actual = encode_boundary_list(epoch_ms_list, id_format, True)
+            expect = [encode_boundary(epoch_ms, id_format, True) for epoch_ms in epoch_ms_list]
+            self.assertEqual(expect, actual)
+
+    def test_compare(self):
+        older = self.id_dict["aid"]
+        newer = encode_boundary(self.epoch_ms + 1, "ulid")
+        # 文字列順とは逆になる
+        self.assertGreater(older, newer)
+        self.assertEqual(-1, compare(older, newer))
+        self.assertEqual(1, compare(newer, older))
+        self.assertEqual(0, compare(older, older))
+
+        # 復号できない ID は最も古いものとして文字列順で比較する
+        self.assertEqual(-1, compare("reaction_id_1", older))
+        self.assertEqual(-1, compare("reaction_id_1", "reaction_id_2"))
+        self.assertEqual((-1, "reaction_id_1"), sort_key("reaction_id_1"))
+
+    def test_max_min_id(self):
+        older = self.id_dict["aid"]
+        newer = encode_boundary(self.epoch_ms + 1, "ulid")
+        self.assertEqual(newer, max_id([older, newer, ""]))
+        self.assertEqual("", min_id([older, newer, ""]))
+        self.assertEqual(older, min_id([older, newer]))
+        self.assertEqual(older, max_id(["", older]))
+        self.assertEqual("", max_id([]))
+        self.assertEqual("", min_id([]))
+
+
+if __name__ == "__main__":
+    if sys.argv:
+        del sys.argv[1:]
+    unittest.main(warnings="ignore")